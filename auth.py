@@ -1,63 +1,62 @@
 # Import the necessary modules for the application
 import sqlite3  # Provides functions to interact with SQLite database
-import bcrypt  # Used for hashing and checking passwords
 import streamlit as st  # Main module for creating web application
-import os  # Provides functions to interact with the operating system
 from styles import apply_custom_css  # Custom function to apply CSS styles
-from utils import sector_attributes
-
-
-def get_db_connection():
-    # Create a database connection using the sqlite3 library
-    db_path = os.path.join(os.path.dirname(__file__), 'cvr_database.db')  # Determine the path of the database file
-    return sqlite3.connect(db_path)  # Connect to the SQLite database at the specified path
-
-def setup_database():
-    # Initialize the database and create tables if they don't exist
-    conn = get_db_connection()  # Establish a database connection
-    cursor = conn.cursor()  # Create a cursor object to execute SQL commands
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")  # Check if the 'users' table exists
-    table_exists = cursor.fetchone()  # Retrieve the result of the query
-
-    # If the 'users' table doesn't exist, create it
-    if not table_exists:
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                username TEXT PRIMARY KEY,
-                password TEXT NOT NULL,
-                sectors TEXT
-            )
-        """)  # Execute a SQL command to create the 'users' table
-    conn.commit()  # Commit the changes to the database
+from utils import sector_attributes, sector_codes
+from bootstrap import bootstrap, prewarm_sectors  # One-time schema setup, metadata discovery and cache warm-up
+from pool import read_connection, write_connection  # Shared SQLite connection pool
+# bcrypt on a bounded worker pool, rate limits and verified-session tokens
+from auth_service import AuthRejected, check_password, check_rate_limits, client_ip, issue_session_token, record_login_result
+from auth_service import hash_password as hash_password_on_workers
+
 
 def hash_password(password):
-    # Hash a password using bcrypt for secure storage
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())  # Encode and hash the password
+    # Hash a password using bcrypt (configurable cost factor) on the password workers
+    return hash_password_on_workers(password)
 
 def verify_password(stored_password, provided_password):
-    # Verify a provided password against the stored hashed password
-    return bcrypt.checkpw(provided_password.encode('utf-8'), stored_password)  # Check the provided password against the hashed version
+    # Verify a provided password against the stored hashed password on the password workers
+    return check_password(stored_password, provided_password)
+
+def login_user(username, password, ip=None):
+    # Refuse before any hashing when the username or client IP is over its limit (raises AuthRejected)
+    check_rate_limits(username, ip)
 
-def login_user(username, password):
     # Authenticate a user by checking their credentials against the database
-    conn = get_db_connection()  # Establish a database connection
-    cursor = conn.cursor()  # Create a cursor object to execute SQL commands
-    cursor.execute("SELECT password FROM users WHERE username = ?", (username,))  # Retrieve the hashed password for the given username
-    user_data = cursor.fetchone()  # Fetch the result of the query
+    with read_connection() as conn:  # Check out a pooled read-only connection
+        cursor = conn.cursor()  # Create a cursor object to execute SQL commands
+        cursor.execute("SELECT password FROM users WHERE username = ?", (username,))  # Retrieve the hashed password for the given username
+        user_data = cursor.fetchone()  # Fetch the result of the query
 
     # If user data is found and the password matches, return True, otherwise False
-    return user_data and verify_password(user_data[0], password)  # Verify the provided password against the stored hash
+    try:
+        success = bool(user_data) and verify_password(user_data[0], password)  # Verify the provided password against the stored hash
+    except AuthRejected:
+        # The password workers turned the check away; the attempt does not count against the username
+        record_login_result(username, None)
+        raise
+    # Failed logins stay counted towards the username's limit; a successful one clears it
+    record_login_result(username, success)
+    return success
+
+def load_user_sectors(username):
+    # Sector codes the user is interested in, in the order of sector_attributes
+    with read_connection() as conn:
+        codes = {row[0] for row in conn.execute("SELECT sector_code FROM user_sectors WHERE username = ?", (username,))}
+    return [code for code in sector_attributes if code in codes]
+
+def register_user(username, password, sectors, ip=None):
+    # Refuse before any hashing when the client IP is over its limit (raises AuthRejected)
+    check_rate_limits(None, ip)
 
-def register_user(username, password, sectors):
     # Register a new user with a hashed password and sectors of interest
-    conn = get_db_connection()  # Establish a database connection
-    cursor = conn.cursor()  # Create a cursor object to execute SQL commands
     hashed_password = hash_password(password)  # Hash the provided password
-    sectors_str = ';'.join(sectors)  # Convert the list of sectors into a semicolon-separated string
+    codes = [sector_codes[name] for name in sectors]  # Store sector codes, not display names
 
     try:
-        cursor.execute("INSERT INTO users (username, password, sectors) VALUES (?, ?, ?)", (username, hashed_password, sectors_str))  # Insert a new record into the 'users' table
-        conn.commit()  # Commit the changes to the database
+        with write_connection() as conn:  # Use the shared writer connection; commits when the block exits
+            conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed_password))  # Insert a new record into the 'users' table
+            conn.executemany("INSERT INTO user_sectors (username, sector_code) VALUES (?, ?)", [(username, code) for code in codes])  # One row per sector of interest
         return True  # Return True if registration is successful
     except sqlite3.IntegrityError:
         return False  # Return False if there is a database error (e.g., username already exists)
@@ -69,7 +68,7 @@ def toggle_view():
 def run_auth_page():
     # Main function to run the authentication page in the Streamlit app
     apply_custom_css()  # Apply custom CSS styles to the Streamlit interface
-    setup_database()  # Ensure the database is set up and ready to use
+    bootstrap()  # Ensure the database is set up; after the first run this only checks whether the database changed
 
     # Check if the login form should be shown or not
     if st.session_state.show_login:
@@ -81,13 +80,22 @@ def run_auth_page():
             submit_login = st.form_submit_button("Login")  # Login button
 
             # Process the login form
-            if submit_login and login_user(login_username, login_password):
-                st.session_state.logged_in = True  # Set the session state to logged in
-                st.session_state.username = login_username  # Store the username in the session state
-                st.success(f"Welcome back, {login_username}!")  # Welcome message
-                st.rerun()  # Rerun the app to update the state
-            elif submit_login:
-                st.error("Invalid username or password.")  # Show error on failed login
+            if submit_login:
+                try:
+                    logged_in = login_user(login_username, login_password, client_ip())
+                except AuthRejected as error:
+                    st.error(str(error))  # Rate limited or the password workers are busy
+                else:
+                    if logged_in:
+                        st.session_state.logged_in = True  # Set the session state to logged in
+                        st.session_state.username = login_username  # Store the username in the session state
+                        st.session_state.auth_token = issue_session_token(login_username)  # Reruns check this token instead of re-hashing
+                        st.session_state.sectors = load_user_sectors(login_username)  # Sector preferences, loaded once per login
+                        prewarm_sectors(st.session_state.sectors)  # Build the caches for those sectors in the background
+                        st.success(f"Welcome back, {login_username}!")  # Welcome message
+                        st.rerun()  # Rerun the app to update the state
+                    else:
+                        st.error("Invalid username or password.")  # Show error on failed login
 
         # Registration button to switch to the registration form
         if st.button("Register"):
@@ -106,10 +114,19 @@ def run_auth_page():
             submit_register = st.form_submit_button("Register")  # Registration button
 
             # Process the registration form
-            if submit_register and register_user(reg_username, reg_password, list(selected_sectors)):
-                st.session_state.logged_in = True  # Set the session state to logged in
-                st.session_state.username = reg_username  # Store the new username in the session state
-                st.success("Registration successful. Logging you in...")  # Success message
-                st.rerun()  # Rerun the app to update the state
-            elif submit_register:
-                st.error("Username already exists. Please try a different one.")  # Show error on failed registration
+            if submit_register:
+                try:
+                    registered = register_user(reg_username, reg_password, list(selected_sectors), client_ip())
+                except AuthRejected as error:
+                    st.error(str(error))  # Rate limited or the password workers are busy
+                else:
+                    if registered:
+                        st.session_state.logged_in = True  # Set the session state to logged in
+                        st.session_state.username = reg_username  # Store the new username in the session state
+                        st.session_state.auth_token = issue_session_token(reg_username)  # Reruns check this token instead of re-hashing
+                        st.session_state.sectors = [sector_codes[name] for name in selected_sectors]  # Sector preferences of the new user
+                        prewarm_sectors(st.session_state.sectors)  # Build the caches for those sectors in the background
+                        st.success("Registration successful. Logging you in...")  # Success message
+                        st.rerun()  # Rerun the app to update the state
+                    else:
+                        st.error("Username already exists. Please try a different one.")  # Show error on failed registration
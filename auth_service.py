@@ -0,0 +1,252 @@
+import collections
+import logging
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import bcrypt
+
+logger = logging.getLogger(__name__)
+
+# bcrypt cost factor for new hashes; existing hashes keep the cost they were created with
+BCRYPT_ROUNDS = int(os.environ.get('CVR_BCRYPT_ROUNDS', '12'))
+# Threads hashing and checking passwords; bcrypt releases the GIL, so these run beside the Streamlit sessions
+AUTH_WORKERS = int(os.environ.get('CVR_AUTH_WORKERS', '2'))
+# Most password operations queued or running at once; further requests are turned away instead of queuing
+AUTH_QUEUE_LIMIT = int(os.environ.get('CVR_AUTH_QUEUE_LIMIT', '16'))
+# Seconds a login waits for its password check
+AUTH_TIMEOUT = 10.0
+
+# Failed logins allowed per username within the window
+USERNAME_FAILURE_LIMIT = 5
+USERNAME_FAILURE_WINDOW = 15 * 60
+# Login and registration attempts allowed per client IP within the window
+IP_ATTEMPT_LIMIT = 20
+IP_ATTEMPT_WINDOW = 60
+# Attempts allowed within the same window to all clients whose IP is not known, together
+UNKNOWN_CLIENT_ATTEMPT_LIMIT = int(os.environ.get('CVR_UNKNOWN_CLIENT_ATTEMPT_LIMIT', '60'))
+# Reverse proxies in front of the application, each appending the address it received the request
+# from to X-Forwarded-For; set with CVR_TRUSTED_PROXIES (0 ignores the proxy headers)
+TRUSTED_PROXIES = int(os.environ.get('CVR_TRUSTED_PROXIES', '1'))
+
+# Seconds a verified session stays valid without activity; every rerun that checks it extends it
+SESSION_TOKEN_TTL = int(os.environ.get('CVR_SESSION_TOKEN_TTL', str(30 * 60)))
+
+
+class AuthRejected(Exception):
+    # Raised when a login or registration is refused before any password work is done
+    # (rate limit reached or the password workers are saturated)
+    pass
+
+
+class RateLimiter:
+    # Sliding-window counter of events per key
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._events = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def _prune(self, key, now):
+        events = self._events[key]
+        while events and events[0] <= now - self.window:
+            events.popleft()
+        if not events:
+            del self._events[key]
+        return events
+
+    # Count an event for key if it has fewer than limit events in the window; checking and counting
+    # under one lock, so concurrent callers cannot all pass before any of them is counted.
+    # Returns False, counting nothing, when key is at its limit.
+    def acquire(self, key):
+        with self._lock:
+            now = time.monotonic()
+            if len(self._prune(key, now)) >= self.limit:
+                return False
+            self._events[key].append(now)
+            return True
+
+    # Give back one event counted by acquire
+    def release(self, key):
+        with self._lock:
+            events = self._events.get(key)
+            if events:
+                events.pop()
+                if not events:
+                    del self._events[key]
+
+    def reset(self, key):
+        with self._lock:
+            self._events.pop(key, None)
+
+
+username_failures = RateLimiter(USERNAME_FAILURE_LIMIT, USERNAME_FAILURE_WINDOW)
+ip_attempts = RateLimiter(IP_ATTEMPT_LIMIT, IP_ATTEMPT_WINDOW)
+unknown_client_attempts = RateLimiter(UNKNOWN_CLIENT_ATTEMPT_LIMIT, IP_ATTEMPT_WINDOW)
+
+
+class PasswordWorkers:
+    # Bounded pool running bcrypt off the Streamlit script threads, with latency and queue depth metrics
+
+    def __init__(self, workers=AUTH_WORKERS, queue_limit=AUTH_QUEUE_LIMIT):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='auth')
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._lock = threading.Lock()
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.depth = 0
+        self.max_depth = 0
+        self.completed = 0
+        self.busy_rejections = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    # Free the slot of a finished job (also when the caller stopped waiting for it)
+    def _finished(self, started):
+        latency = time.perf_counter() - started
+        with self._lock:
+            self.depth -= 1
+            self.completed += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+        self._slots.release()
+
+    # Run func(*args) on a worker and wait for its result
+    def run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.busy_rejections += 1
+            raise AuthRejected("The server is busy signing people in. Please try again in a moment.")
+        started = time.perf_counter()
+        with self._lock:
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(lambda _: self._finished(started))
+        try:
+            return future.result(timeout=AUTH_TIMEOUT)
+        except FutureTimeoutError:
+            raise AuthRejected("Signing in is taking longer than usual. Please try again in a moment.")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_depth': self.depth,
+                'queue_depth_max': self.max_depth,
+                'queue_limit': self.queue_limit,
+                'completed': self.completed,
+                'busy_rejections': self.busy_rejections,
+                'latency_avg': self.latency_total / self.completed if self.completed else 0.0,
+                'latency_max': self.latency_max,
+            }
+
+
+password_workers = PasswordWorkers()
+
+
+def _hashpw(password):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+
+
+def _checkpw(stored_password, provided_password):
+    return bcrypt.checkpw(provided_password.encode('utf-8'), stored_password)
+
+
+# Hash a password on the password workers
+def hash_password(password):
+    return password_workers.run(_hashpw, password)
+
+
+# Check a password against its stored hash on the password workers
+def check_password(stored_password, provided_password):
+    return password_workers.run(_checkpw, stored_password, provided_password)
+
+
+# Client IP of the current Streamlit session from the proxy headers, or None when it is not known.
+# The leftmost X-Forwarded-For entries are whatever the client sent; only the entries appended by the
+# trusted proxies can be relied on, and the outermost of those is the address the client connected from.
+def client_ip():
+    if TRUSTED_PROXIES <= 0:
+        return None
+    try:
+        from streamlit.web.server.websocket_headers import _get_websocket_headers
+        headers = _get_websocket_headers() or {}
+    except Exception:
+        return None
+    forwarded = headers.get('X-Forwarded-For')
+    if forwarded:
+        hops = [hop.strip() for hop in forwarded.split(',') if hop.strip()]
+        # Fewer hops than trusted proxies: the header did not come through all of them
+        return hops[-TRUSTED_PROXIES] if len(hops) >= TRUSTED_PROXIES else None
+    return headers.get('X-Real-Ip')
+
+
+# Refuse the attempt if the client IP or the username is over its limit; otherwise count it.
+# Clients without a known IP share one bucket, so they are limited together rather than not at all.
+def check_rate_limits(username, ip):
+    limiter, key = (ip_attempts, ip) if ip is not None else (unknown_client_attempts, None)
+    if not limiter.acquire(key):
+        logger.warning("Rate limited authentication attempt from %s", ip or 'an unknown client')
+        raise AuthRejected("Too many attempts from your network. Please wait a minute and try again.")
+    # A login is counted as a failure of the username up front, before its password is checked
+    if username is not None and not username_failures.acquire(username):
+        logger.warning("Rate limited login for user %r", username)
+        raise AuthRejected("Too many failed logins for this account. Please try again later.")
+
+
+# Settle the failure counted by check_rate_limits: a successful login clears the username's failures,
+# a login whose password was never checked gives its attempt back, and a failed one keeps it counted
+def record_login_result(username, success):
+    if success:
+        username_failures.reset(username)
+    elif success is None:
+        username_failures.release(username)
+
+
+# Verified sessions: token -> (username, expiry)
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+# Issue a short-lived token proving that username has logged in
+def issue_session_token(username):
+    token = secrets.token_urlsafe(32)
+    with _sessions_lock:
+        now = time.monotonic()
+        # Drop expired tokens while we are here
+        for expired in [key for key, (_, expiry) in _sessions.items() if expiry <= now]:
+            del _sessions[expired]
+        _sessions[token] = (username, now + SESSION_TOKEN_TTL)
+    return token
+
+
+# Username of a valid token, or None when the token is unknown or expired. A valid token is extended
+# by SESSION_TOKEN_TTL from now, so only an idle session expires.
+def session_user(token):
+    if not token:
+        return None
+    with _sessions_lock:
+        entry = _sessions.get(token)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if entry[1] <= now:
+            del _sessions[token]
+            return None
+        _sessions[token] = (entry[0], now + SESSION_TOKEN_TTL)
+        return entry[0]
+
+
+def revoke_session_token(token):
+    with _sessions_lock:
+        _sessions.pop(token, None)
+
+
+def auth_stats():
+    stats = password_workers.stats()
+    with _sessions_lock:
+        stats['active_sessions'] = len(_sessions)
+    return stats
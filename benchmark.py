@@ -0,0 +1,266 @@
+# Time every db.py fetcher and metrics.py data/view function against a database (usually one written by
+# synthetic_data.py) and store the results as JSON. Given a baseline results file, compare the medians and
+# exit with status 1 when a benchmark got slower than the tolerance allows.
+# Streamlit rendering is left out: the views run with show_figure replaced by prepare_figure, so the
+# figures are built and prepared for display but never handed to st.plotly_chart.
+#
+# Usage: python synthetic_data.py bench.db --scale 100k
+#        python benchmark.py --db bench.db --output baseline.json
+#        python benchmark.py --db bench.db --output current.json --baseline baseline.json
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import warnings
+from unittest import mock
+import pandas as pd
+from pool import configure_pool, read_connection
+
+# Runs per benchmark; the median is compared against the baseline
+DEFAULT_REPEAT = 5
+# A benchmark regresses when its median is this much slower than the baseline median ...
+DEFAULT_TOLERANCE = 0.25
+# ... and at least this many seconds slower, so sub-millisecond noise never fails a run
+DEFAULT_MIN_DELTA = 0.005
+# Companies in the multi-company comparison benchmark
+PEER_GROUP_SIZE = 100
+# Sector used by the sector-specific benchmarks; the largest one in synthetic databases
+BENCHMARK_SECTOR = 'G'
+# The data functions also run for a window of the most recent years, as picked in the sidebar
+RECENT_YEARS = 3
+
+# Sample CVR numbers for the company benchmarks, taken from the benchmark sector
+SAMPLE_CVRS_QUERY = "SELECT cvr_number FROM company WHERE industry_sector = ? ORDER BY cvr_number LIMIT ?"
+
+
+# Rows in a benchmark's result, where there is an obvious count
+def _rows(result):
+    if isinstance(result, (pd.DataFrame, list, tuple)):
+        return len(result)
+    if isinstance(result, dict) and 'history' in result:
+        return len(result['history'])
+    return None
+
+
+# Clear every result cache so each run measures the work itself rather than a cache hit
+def _clear_caches():
+    from cache import query_cache
+    from company_profile import profile_cache
+    query_cache.clear()
+    profile_cache.clear()
+
+
+# Stand-in for charts.show_figure: everything it does except st.plotly_chart
+def _prepare_only(fig, info=None, **kwargs):
+    from charts import prepare_figure
+    if info is None:
+        fig, info = prepare_figure(fig)
+    return info
+
+
+# The benchmarks as (name, function) pairs, in the order they run
+def collect_benchmarks(backends):
+    import db
+    import metrics
+    from company_profile import get_company_profile
+    from sector_rebuild import build_frames_parallel
+    from store import build_frames
+
+    with read_connection() as conn:
+        cvrs = [row[0] for row in conn.execute(SAMPLE_CVRS_QUERY, (BENCHMARK_SECTOR, PEER_GROUP_SIZE))]
+    if len(cvrs) < 2:
+        raise ValueError(f"Sector {BENCHMARK_SECTOR} needs at least two companies to benchmark")
+    year_range = db.get_year_range()
+    cvr, other = cvrs[0], cvrs[1]
+
+    benchmarks = [
+        ('db.get_year_range', db.get_year_range),
+        ('db.fetch_companies_in_sector', lambda: db.fetch_companies_in_sector(BENCHMARK_SECTOR)),
+        ('db.fetch_company_financial_history', lambda: db.fetch_company_financial_history(cvr, year_range)),
+        ('company_profile.get_company_profile', lambda: get_company_profile(cvr)),
+        ('db.fetch_financial_data_for_companies',
+         lambda: db.fetch_financial_data_for_companies(cvrs, year_range)),
+        ('db.fetch_financial_data_for_two_companies',
+         lambda: db.fetch_financial_data_for_two_companies(cvr, other, year_range)),
+        ('store.build_frames', build_frames),
+        # Same frames built per sector in worker processes (CVR_REBUILD_WORKERS, default one per CPU)
+        ('sector_rebuild.build_frames_parallel', build_frames_parallel),
+    ]
+
+    # Data functions once per backend, for every year and for the most recent years
+    recent = (year_range[1] - RECENT_YEARS + 1, year_range[1])
+    for backend in backends:
+        for window, suffix in ((metrics.ALL_YEARS, ''), (recent, f':last{RECENT_YEARS}')):
+            benchmarks += [
+                (f'metrics.fetch_sector_performance_data[{backend}{suffix}]',
+                 lambda backend=backend, window=window: metrics.fetch_sector_performance_data(window, backend)),
+                (f'metrics.fetch_company_growth_data[{backend}{suffix}]',
+                 lambda backend=backend, window=window: metrics.fetch_company_growth_data(window, backend)),
+                (f'metrics.fetch_investment_opportunities_data[{backend}{suffix}]',
+                 lambda backend=backend, window=window: metrics.fetch_investment_opportunities_data(
+                     **metrics.INVESTMENT_THRESHOLDS, year_range=window, backend=backend)),
+                (f'metrics.fetch_operational_efficiency_data[{backend}{suffix}]',
+                 lambda backend=backend, window=window: metrics.fetch_operational_efficiency_data(window, backend)),
+                (f'metrics.fetch_liquidity_and_solvency_data[{backend}{suffix}]',
+                 lambda backend=backend, window=window: metrics.fetch_liquidity_and_solvency_data(window, backend)),
+            ]
+        for metric in metrics.FINANCIAL_HEALTH_METRICS:
+            benchmarks.append((f'metrics.fetch_financial_health_data[{backend}:{metric}]',
+                               lambda backend=backend, metric=metric:
+                               metrics.fetch_financial_health_data(metric, metrics.ALL_YEARS, backend=backend)))
+
+    # Views end to end (default backend), up to but excluding st.plotly_chart
+    benchmarks += [
+        ('metrics.sector_performance_overview', metrics.sector_performance_overview),
+        ('metrics.investment_opportunity_identification', metrics.investment_opportunity_identification),
+        ('metrics.company_level_comparison',
+         lambda: metrics.visualize_company_comparison(metrics.company_level_comparison())),
+        ('metrics.operational_efficiency_analysis',
+         lambda: metrics.operational_efficiency_analysis(BENCHMARK_SECTOR)),
+        ('metrics.liquidity_and_solvency_trend_analysis',
+         lambda: metrics.liquidity_and_solvency_trend_analysis(BENCHMARK_SECTOR)),
+    ]
+    for metric in metrics.FINANCIAL_HEALTH_METRICS:
+        benchmarks.append((f'metrics.financial_health_dashboard[{metric}]',
+                           lambda metric=metric: metrics.financial_health_dashboard(metric)))
+    return benchmarks
+
+
+# Run func repeat times with cold caches and summarize the wall times
+def time_benchmark(func, repeat):
+    seconds = []
+    rows = None
+    for _ in range(repeat):
+        _clear_caches()
+        started = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - started)
+        rows = _rows(result)
+    return {
+        'min': min(seconds),
+        'median': statistics.median(seconds),
+        'mean': statistics.fmean(seconds),
+        'max': max(seconds),
+        'runs': repeat,
+        'rows': rows,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Run the benchmarks against db_path; only names containing one of the selected substrings run
+def run_benchmarks(db_path, repeat=DEFAULT_REPEAT, backends=('sqlite', 'store'), selected=None):
+    configure_pool(db_path)
+    # Imported after the pool points at the benchmark database
+    import metrics
+    from bootstrap import bootstrap
+    from store import analytics_store
+
+    # Migrations, rollup and the shared store, as on a server start; not part of any timing
+    metadata = bootstrap()
+    analytics_store.warm()
+
+    results = {}
+    with mock.patch.object(metrics, 'show_figure', _prepare_only):
+        for name, func in collect_benchmarks(backends):
+            if selected and not any(part in name for part in selected):
+                continue
+            results[name] = time_benchmark(func, repeat)
+            logging.info("%-70s %9.2f ms", name, results[name]['median'] * 1000)
+
+    return {
+        'meta': {
+            'db': os.path.abspath(db_path),
+            'company_count': metadata['company_count'],
+            'financials_count': metadata['financials_count'],
+            'repeat': repeat,
+            'backends': list(backends),
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'benchmarks': results,
+    }
+
+
+# Compare the medians of results against baseline; returns the list of regressions as
+# (name, baseline seconds, current seconds) and prints a comparison table
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE, min_delta=DEFAULT_MIN_DELTA):
+    if (results['meta']['company_count'], results['meta']['financials_count']) != \
+            (baseline['meta']['company_count'], baseline['meta']['financials_count']):
+        logging.warning("Baseline was measured on a different database (%s companies, %s rows)",
+                        baseline['meta']['company_count'], baseline['meta']['financials_count'])
+
+    regressions = []
+    print(f"{'benchmark':70} {'baseline ms':>12} {'current ms':>12} {'ratio':>7}")
+    for name, current in results['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if before is None:
+            print(f"{name:70} {'-':>12} {current['median'] * 1000:12.2f} {'new':>7}")
+            continue
+        ratio = current['median'] / before['median'] if before['median'] else float('inf')
+        regressed = (current['median'] > before['median'] * (1 + tolerance)
+                     and current['median'] - before['median'] > min_delta)
+        if regressed:
+            regressions.append((name, before['median'], current['median']))
+        print(f"{name:70} {before['median'] * 1000:12.2f} {current['median'] * 1000:12.2f} {ratio:6.2f}x"
+              f"{'  REGRESSION' if regressed else ''}")
+    missing = baseline['benchmarks'].keys() - results['benchmarks'].keys()
+    if missing:
+        print(f"{len(missing)} benchmark(s) of the baseline were not run")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the data fetchers and views against a database.")
+    parser.add_argument('--db', required=True, help="database file to benchmark (see synthetic_data.py)")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="results JSON of an earlier run to compare against")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="runs per benchmark (default %(default)s)")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed slowdown of a median as a fraction (default %(default)s)")
+    parser.add_argument('--min-delta', type=float, default=DEFAULT_MIN_DELTA,
+                        help="slowdowns below this many seconds are never regressions (default %(default)s)")
+    parser.add_argument('--backends', default='sqlite,store',
+                        help="comma-separated metrics backends to benchmark (default %(default)s)")
+    parser.add_argument('--only', action='append', help="run only benchmarks whose name contains this (repeatable)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # Streamlit warns about running without 'streamlit run' on every st call outside a session
+    warnings.filterwarnings('ignore')
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    # Copy-on-write over the shared store frames, as in the dashboard (see main.py)
+    pd.set_option('mode.copy_on_write', True)
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} does not exist; create one with synthetic_data.py")
+
+    results = run_benchmarks(args.db, args.repeat, tuple(args.backends.split(',')), args.only)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_delta)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
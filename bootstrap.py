@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+from cache import db_version
+from db import YEAR_RANGE_QUERY, setup_database
+from pool import read_connection
+from rollup import ensure_sector_year_rollup
+from search import get_search_index
+from store import analytics_store, start_store
+from utils import sector_attributes
+
+logger = logging.getLogger(__name__)
+
+# Metadata read once per database version
+SECTOR_CODES_QUERY = "SELECT DISTINCT industry_sector FROM company WHERE industry_sector IS NOT NULL"
+COMPANY_COUNT_QUERY = "SELECT COUNT(*) FROM company"
+FINANCIALS_COUNT_QUERY = "SELECT COUNT(*) FROM financials"
+
+_lock = threading.Lock()
+# Set once the schema has been set up in this process
+_setup_done = False
+# (database version, metadata) of the last metadata discovery
+_metadata = None
+
+
+# Discover the year range, the sectors that have companies and the table sizes
+def _discover_metadata():
+    with read_connection() as conn:
+        min_year, max_year = conn.execute(YEAR_RANGE_QUERY).fetchone()
+        codes = {row[0] for row in conn.execute(SECTOR_CODES_QUERY)}
+        companies = conn.execute(COMPANY_COUNT_QUERY).fetchone()[0]
+        financial_rows = conn.execute(FINANCIALS_COUNT_QUERY).fetchone()[0]
+    return {
+        'year_range': (min_year, max_year),
+        # Sector codes with at least one company, in the order of utils.sector_attributes
+        'sector_codes': [code for code in sector_attributes if code in codes],
+        'company_count': companies,
+        'financials_count': financial_rows,
+    }
+
+
+# One-time application bootstrap, safe to call on every rerun.
+# The first call in a process applies schema migrations, builds the sector/year rollup, starts loading
+# the shared analytics store and discovers the metadata. Later calls only compare the data version
+# (cache.db_version) and return the cached metadata; when the data has changed, the rollup is brought
+# up to date and the metadata discovered again.
+def bootstrap():
+    global _setup_done, _metadata
+    metadata = _metadata
+    if metadata is not None and metadata[0] == db_version():
+        return metadata[1]
+
+    with _lock:
+        # Another session may have finished the bootstrap while this one was waiting
+        if _metadata is not None and _metadata[0] == db_version():
+            return _metadata[1]
+        started = time.perf_counter()
+        if not _setup_done:
+            setup_database()
+            start_store()
+            _setup_done = True
+        else:
+            ensure_sector_year_rollup()
+        # Read the version after the setup so the bootstrap's own rollup refresh does not count as a change
+        version = db_version()
+        _metadata = (version, _discover_metadata())
+        logger.info("Bootstrapped in %.3f s: %s", time.perf_counter() - started, _metadata[1])
+        return _metadata[1]
+
+
+# Build what the views of the given sectors need (the shared analytics frames and each sector's
+# company search index) so the user's first views are served from memory
+def _prewarm(sector_codes):
+    analytics_store.warm()
+    for code in sector_codes:
+        get_search_index(code)
+
+
+# Prewarm the caches for a user's sectors in a background thread; returns immediately
+def prewarm_sectors(sector_codes):
+    if sector_codes:
+        threading.Thread(target=_prewarm, args=(list(sector_codes),), name='prewarm-sectors', daemon=True).start()
@@ -0,0 +1,119 @@
+import functools
+import inspect
+import sqlite3
+import threading
+from cachetools import TTLCache
+from pool import read_connection
+from schema import DATA_VERSION_QUERY
+
+# Maximum number of results kept before the least recently used one is evicted
+CACHE_MAX_ENTRIES = 32
+# Seconds a cached result stays valid even if the database has not changed
+CACHE_TTL = 15 * 60
+
+
+# Version of the analytics data: a counter in the database bumped in the same transaction as every
+# change of the analytics data, by its writers (ingest.py, the derived column backfill and the
+# sector/year rollup refresh and rebuild) and by the rollup triggers for any other write to company or
+# financials. Writes to other tables, such as users registering, and WAL checkpoints leave it alone, so
+# they keep the caches, the analytics store, the snapshot and the reports. None until the migrations
+# have created the counter.
+def db_version():
+    try:
+        with read_connection() as conn:
+            row = conn.execute(DATA_VERSION_QUERY).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+class QueryCache:
+    # Size-bounded LRU with a TTL for query results, keyed on the query, its parameters
+    # and the data version so that changed data never serves stale frames.
+    # Cached objects are shared between sessions and must be treated as read-only.
+
+    def __init__(self, maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        # One lock per key being computed so concurrent misses run the query only once
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                return False, None
+            self.hits += 1
+            return True, value
+
+    # Return the cached value for key, computing and storing it on a miss
+    def get_or_compute(self, key, compute):
+        found, value = self._lookup(key)
+        if found:
+            return value
+
+        with self._lock:
+            key_lock = self._inflight.setdefault(key, threading.Lock())
+        with key_lock:
+            # Another thread may have filled the entry while this one was waiting
+            found, value = self._lookup(key)
+            if found:
+                return value
+            with self._lock:
+                self.misses += 1
+            try:
+                value = compute()
+                with self._lock:
+                    self._entries[key] = value
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # Snapshot of the cached values (expired entries left out)
+    def values(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'entries': self._entries.currsize,
+                'max_entries': self._entries.maxsize,
+                'ttl': self._entries.ttl,
+            }
+
+
+# Process-wide cache shared by every Streamlit session
+query_cache = QueryCache()
+
+
+# Decorator caching a data function's result in the shared query cache.
+# The function stands for its query, so the key is the function name, its arguments
+# and the data version. Arguments are bound to the signature with defaults
+# applied, so f(x), f(x, default) and f(x=x) share one entry.
+def cached_query(func):
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = (func.__module__, func.__qualname__, tuple(bound.arguments.items()), db_version())
+        return query_cache.get_or_compute(key, lambda: func(*args, **kwargs))
+    return wrapper
+
+
+def cache_stats():
+    return query_cache.stats()
@@ -0,0 +1,340 @@
+import logging
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+from plotly.io.json import to_json_plotly
+import streamlit as st
+from instrumentation import instrumented, stage
+
+logger = logging.getLogger(__name__)
+
+# Most per-company traces a chart may draw before switching to the aggregated view
+MAX_TRACES = 25
+# Most data points a single chart may carry
+MAX_POINTS = 20000
+# Above this many points the chart is drawn with WebGL (scattergl) instead of SVG
+WEBGL_POINT_THRESHOLD = 1000
+# Companies highlighted on top of the percentile bands in the aggregated view
+TOP_K = 10
+# Percentiles drawn as the band (lower, middle, upper)
+PERCENTILES = (0.1, 0.5, 0.9)
+
+
+# Plotly Express builds one group per category, including categories with no rows;
+# drop those before handing a frame with categorical columns to px
+def drop_unused_categories(df):
+    categorical = [column for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)]
+    if not categorical:
+        return df
+    return df.assign(**{column: df[column].cat.remove_unused_categories() for column in categorical})
+
+
+# Choose the trace class for a chart with the given number of points
+def _scatter_class(point_count):
+    return go.Scattergl if point_count > WEBGL_POINT_THRESHOLD else go.Scatter
+
+
+# Line chart of one value per company over time that never exceeds the trace and point budget.
+# Small frames get one line per company; larger ones get p10/p50/p90 bands across all companies
+# in the frame plus the top_k companies with the highest most recent value.
+# Companies are told apart by entity (their CVR number) and labelled with label.
+@instrumented
+def company_trend_figure(df, y, title, x='year', entity='cvr', label='company_name',
+                         max_traces=MAX_TRACES, max_points=MAX_POINTS, top_k=TOP_K,
+                         width=1000, height=600):
+    # Ratios divide by revenue and friends, so infinities are common; treat them as missing
+    data = drop_unused_categories(df[[entity, label, x, y]].replace([np.inf, -np.inf], np.nan).dropna(subset=[y]))
+
+    if data[entity].nunique() <= max_traces and len(data) <= max_points:
+        render_mode = 'webgl' if len(data) > WEBGL_POINT_THRESHOLD else 'svg'
+        fig = px.line(data, x=x, y=y, color=label, line_group=entity, title=title, render_mode=render_mode)
+        fig.update_layout(width=width, height=height)
+        return fig
+
+    # Percentile bands per year across every company in the frame
+    bands = data.groupby(x)[y].quantile(list(PERCENTILES)).unstack()
+    low, mid, high = (bands[p] for p in PERCENTILES)
+
+    # Three band traces are always drawn, so the highlighted companies share what is left
+    periods = max(len(bands), 1)
+    top_k = max(0, min(top_k, max_traces - 3, (max_points - 3 * periods) // periods))
+    # Rank companies by their most recent value
+    latest = data.sort_values(x).groupby(entity).tail(1)
+    top_entities = latest.nlargest(top_k, y)[entity]
+    highlighted = data[data[entity].isin(top_entities)].sort_values([entity, x])
+
+    scatter = _scatter_class(3 * periods + len(highlighted))
+    fig = go.Figure()
+    fig.add_trace(scatter(x=bands.index, y=high, mode='lines', line=dict(width=0),
+                          name=f'p{int(PERCENTILES[2] * 100)}', hoverinfo='x+y+name', showlegend=False))
+    fig.add_trace(scatter(x=bands.index, y=low, mode='lines', line=dict(width=0), fill='tonexty',
+                          fillcolor='rgba(79, 139, 249, 0.25)',
+                          name=f'p{int(PERCENTILES[0] * 100)}-p{int(PERCENTILES[2] * 100)} band',
+                          hoverinfo='x+y+name'))
+    fig.add_trace(scatter(x=bands.index, y=mid, mode='lines', line=dict(color='#4F8BF9', width=3),
+                          name='Median'))
+    for _, company in highlighted.groupby(entity, sort=False):
+        fig.add_trace(scatter(x=company[x], y=company[y], mode='lines+markers', line=dict(width=1.5),
+                              name=str(company[label].iloc[0])))
+
+    companies = data[entity].nunique()
+    fig.update_layout(title=f"{title} ({companies} companies; percentile band and top {len(top_entities)})",
+                      xaxis_title=x, yaxis_title=y, width=width, height=height)
+    return fig
+
+
+# Scatter (marker-only) traces with more points than this are thinned by 2-D binning
+SCATTER_POINT_THRESHOLD = 5000
+# Grid cells per axis used when binning scatter points; at most one point is kept per cell
+SCATTER_BINS = 150
+# Line traces with more points than this are downsampled with LTTB
+LINE_POINT_THRESHOLD = 2000
+# Largest serialized figure, in bytes, sent to the browser before the figure is degraded
+FIGURE_SIZE_BUDGET = 2 * 1024 * 1024
+# An over-budget figure with more traces than this has its marker-only traces merged into one per
+# trace type; a trace holding a handful of points costs more in trace overhead than in data
+MAX_FIGURE_TRACES = 100
+# Per-point attributes that have to be subset together with x and y
+POINT_ATTRIBUTES = ('x', 'y', 'customdata', 'text', 'hovertext', 'ids')
+POINT_MARKER_ATTRIBUTES = ('size', 'color', 'symbol', 'opacity')
+
+
+# Convert a coordinate array to floats; dates become nanoseconds and anything else its position
+def _numeric(values):
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[ns]').astype(np.int64).astype(float)
+    try:
+        return values.astype(float)
+    except (TypeError, ValueError):
+        return np.arange(len(values), dtype=float)
+
+
+# Indices of the points kept by Largest-Triangle-Three-Buckets downsampling to threshold points
+def lttb_indices(x, y, threshold):
+    count = len(x)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+    x = _numeric(x)
+    y = _numeric(y)
+    # First and last points are always kept; the rest is split into threshold - 2 buckets
+    edges = np.linspace(1, count - 1, threshold - 1).astype(int)
+    keep = np.empty(threshold, dtype=int)
+    keep[0] = 0
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # Average of the next bucket (or the last point) is the third corner of the triangle
+        next_start, next_end = edges[bucket + 1], edges[bucket + 2] if bucket + 2 < len(edges) else count
+        avg_x = np.nanmean(x[next_start:next_end])
+        avg_y = np.nanmean(y[next_start:next_end])
+        areas = np.abs((x[previous] - avg_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (avg_y - y[previous]))
+        previous = start + int(np.nanargmax(areas)) if np.isfinite(areas).any() else start
+        keep[bucket + 1] = previous
+    keep[-1] = count - 1
+    return keep
+
+
+# Indices of the points kept when thinning a scatter to one point per cell of a bins x bins grid
+def binned_scatter_indices(x, y, bins=SCATTER_BINS):
+    x = _numeric(x)
+    y = _numeric(y)
+    valid = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if not len(valid):
+        return valid
+
+    def cell(values):
+        low, high = values.min(), values.max()
+        span = high - low or 1.0
+        return np.minimum(((values - low) / span * bins).astype(int), bins - 1)
+
+    cells = cell(x[valid]) * bins + cell(y[valid])
+    _, first = np.unique(cells, return_index=True)
+    return valid[np.sort(first)]
+
+
+# Keep only the points at idx in every per-point attribute of a trace
+def _subset_trace(trace, idx):
+    count = len(trace.x)
+    updates = {}
+    for name in POINT_ATTRIBUTES:
+        values = trace[name]
+        if values is not None and not isinstance(values, str) and np.ndim(values) and len(values) == count:
+            updates[name] = np.asarray(values)[idx]
+    for name in POINT_MARKER_ATTRIBUTES:
+        values = trace.marker[name] if 'marker' in trace else None
+        if values is not None and not isinstance(values, str) and np.ndim(values) and len(values) == count:
+            updates[f'marker_{name}'] = np.asarray(values)[idx]
+    trace.update(updates, overwrite=True)
+
+
+# Downsample every trace above its point threshold; returns the number of points removed
+def downsample_figure(fig, scatter_threshold=SCATTER_POINT_THRESHOLD, line_threshold=LINE_POINT_THRESHOLD,
+                      bins=SCATTER_BINS):
+    removed = 0
+    for trace in fig.data:
+        if trace.type not in ('scatter', 'scattergl') or trace.x is None or trace.y is None:
+            continue
+        count = len(trace.x)
+        lines = 'lines' in (trace.mode or 'lines')
+        if lines and count > line_threshold:
+            idx = lttb_indices(trace.x, trace.y, line_threshold)
+        elif not lines and count > scatter_threshold:
+            idx = binned_scatter_indices(trace.x, trace.y, bins)
+        else:
+            continue
+        _subset_trace(trace, idx)
+        removed += count - len(idx)
+    return removed
+
+
+# Remove all hover payload, keeping plain x/y/name hover labels. Returns the positions of the
+# traces that had any.
+def _drop_hover_data(fig):
+    changed = []
+    for position, trace in enumerate(fig.data):
+        names = [name for name in ('customdata', 'hovertemplate', 'text', 'hovertext')
+                 if name in trace and trace[name] is not None
+                 and (name == 'hovertemplate' or not isinstance(trace[name], str))]
+        if names:
+            trace.update({name: None for name in names}, overwrite=True)
+            changed.append(position)
+    return changed
+
+
+# Merge the marker-only scatter traces among data (plotly JSON trace dicts) into one trace per trace
+# type and marker style (the colour plotly.express gives each company, say) when there are more than
+# max_traces traces. Points keep their per-point marker sizes and are labelled with the name of their
+# trace on hover; the per-trace legend entries are dropped. Returns the remaining traces followed by
+# the merged ones, and the positions the merged traces had.
+def merge_marker_traces(data, max_traces=MAX_FIGURE_TRACES):
+    if len(data) <= max_traces:
+        return data, []
+    groups = {}
+    for position, trace in enumerate(data):
+        if trace.get('type', 'scatter') not in ('scatter', 'scattergl') or trace.get('mode') != 'markers' \
+                or trace.get('x') is None:
+            continue
+        marker = trace.get('marker', {})
+        style = tuple((name, marker[name]) for name in POINT_MARKER_ATTRIBUTES
+                      if isinstance(marker.get(name), (str, int, float)))
+        groups.setdefault((trace.get('type', 'scatter'), style), []).append(position)
+    groups = {key: positions for key, positions in groups.items() if len(positions) > 1}
+    if not groups:
+        return data, []
+
+    merged = []
+    for (kind, style), positions in groups.items():
+        traces = [data[position] for position in positions]
+        marker = dict(traces[0].get('marker', {}))
+        for name in POINT_MARKER_ATTRIBUTES:
+            if name in dict(style) or marker.get(name) is None:
+                continue
+            # Per-point values; dropped when some trace has none
+            values = [trace.get('marker', {}).get(name) for trace in traces]
+            if any(value is None or np.ndim(value) == 0 for value in values):
+                marker.pop(name)
+            else:
+                marker[name] = np.concatenate([np.asarray(value) for value in values])
+        counts = [len(trace['x']) for trace in traces]
+        merged.append({
+            'type': kind, 'mode': 'markers', 'marker': marker, 'showlegend': False, 'name': '',
+            'x': np.concatenate([np.asarray(trace['x']) for trace in traces]),
+            'y': np.concatenate([np.asarray(trace['y']) for trace in traces]),
+            'hovertext': np.repeat([str(trace.get('name') or '') for trace in traces], counts),
+            'hoverinfo': 'x+y+text',
+        })
+
+    removed = sorted(position for positions in groups.values() for position in positions)
+    kept = [trace for position, trace in enumerate(data) if position not in set(removed)]
+    return kept + merged, removed
+
+
+# Serialized size of a trace or layout (or of its plotly JSON dict), in bytes
+def _json_size(obj):
+    return len(to_json_plotly(obj if isinstance(obj, dict) else obj.to_plotly_json()))
+
+
+# Size of a figure as sent to the browser, {"data":[...],"layout":...}, from the sizes of its
+# serialized layout and traces
+def _figure_bytes(layout_size, trace_sizes):
+    return len('{"data":[],"layout":}') + layout_size + sum(trace_sizes) + max(len(trace_sizes) - 1, 0)
+
+
+# downsample_figure, updating the serialized sizes of the traces it thinned; returns the points removed
+def _downsample_measured(fig, sizes, scatter_threshold, line_threshold, bins=SCATTER_BINS):
+    counts = [len(trace.x) if trace.x is not None else 0 for trace in fig.data]
+    removed = downsample_figure(fig, scatter_threshold, line_threshold, bins)
+    for position, trace in enumerate(fig.data):
+        if trace.x is not None and len(trace.x) != counts[position]:
+            sizes[position] = _json_size(trace)
+    return removed
+
+
+# Prepare a figure for st.plotly_chart: downsample large traces and, if the serialized figure is
+# still over size_budget, degrade it step by step (merge the marker traces of figures with more than
+# max_traces traces, drop hover data, then halve the point thresholds) until it fits or cannot shrink
+# any further. The figure is serialized once, trace by trace; each step re-measures only the traces
+# it changed. Returns the figure and a dict describing what was done.
+def prepare_figure(fig, size_budget=FIGURE_SIZE_BUDGET, scatter_threshold=SCATTER_POINT_THRESHOLD,
+                   line_threshold=LINE_POINT_THRESHOLD, max_traces=MAX_FIGURE_TRACES):
+    removed = downsample_figure(fig, scatter_threshold, line_threshold)
+    serialized = fig.to_plotly_json()
+    layout_size = _json_size(serialized['layout'])
+    sizes = [_json_size(trace) for trace in serialized['data']]
+    size = _figure_bytes(layout_size, sizes)
+    info = {'points_removed': removed, 'traces_merged': 0, 'bytes': size, 'degraded': False}
+    if size <= size_budget:
+        return fig, info
+
+    logger.warning("Figure %r is %d bytes, over the %d byte budget; degrading it",
+                   fig.layout.title.text, size, size_budget)
+    info['degraded'] = True
+    # Merged traces carry only their trace names as hover data, so they go before the hover step
+    data, merged = merge_marker_traces(serialized['data'], max_traces)
+    if merged:
+        info['traces_merged'] = len(merged)
+        sizes = [size for position, size in enumerate(sizes) if position not in set(merged)]
+        sizes += [_json_size(trace) for trace in data[len(sizes):]]
+        size = _figure_bytes(layout_size, sizes)
+        # Rebuilt from the plotly JSON of the old figure, whose values plotly has already validated
+        fig = go.Figure(data=data, layout=serialized['layout'], _validate=False)
+        # The merged traces get the downsampling the separate ones were too small for
+        info['points_removed'] += _downsample_measured(fig, sizes, scatter_threshold, line_threshold)
+        size = _figure_bytes(layout_size, sizes)
+
+    if size > size_budget:
+        for position in _drop_hover_data(fig):
+            sizes[position] = _json_size(fig.data[position])
+        size = _figure_bytes(layout_size, sizes)
+
+    bins = SCATTER_BINS
+    while size > size_budget and (scatter_threshold > 100 or line_threshold > 100):
+        scatter_threshold = max(100, scatter_threshold // 2)
+        line_threshold = max(100, line_threshold // 2)
+        bins = max(10, bins // 2)
+        info['points_removed'] += _downsample_measured(fig, sizes, scatter_threshold, line_threshold, bins)
+        size = _figure_bytes(layout_size, sizes)
+    info['bytes'] = size
+    if size > size_budget:
+        logger.warning("Figure %r is still %d bytes after degrading", fig.layout.title.text, size)
+    return fig, info
+
+
+# Prepare a figure and hand it to st.plotly_chart; all dashboard charts go through here.
+# Pass the info returned by prepare_figure for figures that were already prepared (e.g. cached ones).
+def show_figure(fig, info=None, **kwargs):
+    # Preparation (downsampling, size checks) and st.plotly_chart (serialization) are timed separately
+    with stage('charts.show_figure') as event:
+        if info is None:
+            with stage('charts.prepare_figure'):
+                fig, info = prepare_figure(fig)
+        with stage('st.plotly_chart'):
+            st.plotly_chart(fig, **kwargs)
+        event.update(title=fig.layout.title.text, figure_bytes=info['bytes'], points_removed=info['points_removed'])
+    if info['degraded']:
+        st.caption("This chart was simplified (series merged, hover details removed or points thinned) "
+                   "to keep it fast to load.")
+    return info
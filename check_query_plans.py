@@ -0,0 +1,151 @@
+# Run EXPLAIN QUERY PLAN for every SQL query defined in the db, metrics, search, company_profile, bootstrap,
+# sector_rebuild and snapshot modules, and for the write statements of the rollup refresh, the bulk load
+# and the derived column backfill, and fail when one of them falls back to a full table scan.
+#
+# Usage: python check_query_plans.py [--db path/to/cvr_database.db] [--migrate]
+import argparse
+import re
+import sys
+import db
+import metrics
+import search
+import company_profile
+import bootstrap
+import sector_rebuild
+import snapshot
+import ingest
+import rollup
+import schema
+from pool import configure_pool, connect_read_only, get_pool, write_connection
+from schema import migrate
+from rollup import ensure_sector_year_rollup
+
+# Modules whose *_QUERY constants are checked
+QUERY_MODULES = [db, metrics, search, company_profile, bootstrap, sector_rebuild, snapshot]
+
+# Queries whose plans contain a full scan on purpose. Every metrics query is bounded by the year
+# window unless it covers every year, so keep this list short: anything added here should be a
+# deliberate whole-table read.
+FULL_SCAN_ALLOWED = {
+    # The snapshot export and the store build read every company-year
+    'snapshot.SNAPSHOT_QUERY',
+    # A year window covering every year reads every company-year, in (cvr, year) key order
+    'metrics.all_years_query(metrics.COMPANY_GROWTH_QUERY)',
+    'metrics.all_years_query(metrics.INVESTMENT_OPPORTUNITIES_QUERY)',
+    # Explicit maintenance steps of ingest.py that read or rewrite the whole table
+    'ingest.DEDUPE_STATEMENTS[0]',
+    'ingest.DEDUPE_STATEMENTS[1]',
+    'schema.DERIVED_RATIOS_UPDATE',
+    "schema.GROWTH_UPDATE.format(where='')",
+}
+
+# Small derived tables that are meant to be read whole (about 20 sectors x N years)
+SCAN_ALLOWED_TABLES = {'sector_year_rollup'}
+
+# A plan step such as "SCAN f" or "SCAN financials" is a full table scan, and so is
+# "SCAN f USING INDEX ...": it walks every index entry and looks up each row in the table.
+# Only "SCAN f USING COVERING INDEX ..." reads nothing but the (smaller) index and is accepted.
+FULL_SCAN_PATTERN = re.compile(r'^SCAN (\w+)(?: AS (\w+))?(?: USING INDEX \w+)?$')
+# Plan steps naming a subquery or CTE; scanning their materialized rows is not a table scan
+SUBQUERY_PATTERN = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\w+)$')
+
+
+# Collect (name, sql) pairs for every *_QUERY constant in the checked modules
+def collect_queries():
+    queries = []
+    seen = set()
+    for module in QUERY_MODULES:
+        for attribute in sorted(vars(module)):
+            sql = getattr(module, attribute)
+            # Queries imported from another checked module are only checked once
+            if attribute.endswith('_QUERY') and isinstance(sql, str) and sql not in seen:
+                seen.add(sql)
+                queries.append((f"{module.__name__}.{attribute}", sql))
+    # Per-metric financial health queries are generated from the metric registry
+    for metric in metrics.FINANCIAL_HEALTH_METRICS:
+        queries.append((f"metrics.financial_health_query({metric!r})", metrics.financial_health_query(metric)))
+        queries.append((f"metrics.financial_health_query({metric!r}, fallback=True)",
+                        metrics.financial_health_query(metric, fallback=True)))
+    # Company-year queries run without their year window when it covers every year
+    for name, sql in list(queries):
+        if name.startswith('metrics.') and metrics.YEAR_CONDITION in sql:
+            queries.append((f"metrics.all_years_query({name})", metrics.all_years_query(sql)))
+    # Company comparison queries are generated for the size of the peer group
+    queries.append(("db.companies_financials_query(2)", db.companies_financials_query(2)))
+    # Write statements of the rollup refresh, the bulk load and the backfill
+    queries += [
+        ('rollup.FULL_REFRESH_SQL', rollup.FULL_REFRESH_SQL),
+        ('rollup.DIRTY_DELETE_SQL', rollup.DIRTY_DELETE_SQL),
+        ('rollup.DIRTY_REFRESH_SQL', rollup.DIRTY_REFRESH_SQL),
+        ('ingest.UPSERT_COMPANY', ingest.UPSERT_COMPANY),
+        ('ingest.UPSERT_FINANCIALS', ingest.UPSERT_FINANCIALS),
+        ('ingest.TOUCHED_GROWTH_UPDATE', ingest.TOUCHED_GROWTH_UPDATE),
+        *((f"ingest.DEDUPE_STATEMENTS[{position}]", sql) for position, sql in enumerate(ingest.DEDUPE_STATEMENTS)),
+        ('schema.DERIVED_RATIOS_UPDATE', schema.DERIVED_RATIOS_UPDATE),
+        ("schema.GROWTH_UPDATE.format(where='')", schema.GROWTH_UPDATE.format(where='')),
+    ]
+    return queries
+
+
+# Return the EXPLAIN QUERY PLAN detail lines for a query, binding a dummy value to every parameter
+def explain(conn, sql):
+    params = (1,) * sql.count('?')
+    return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+
+
+# Return the plan steps that are full table scans of tables outside SCAN_ALLOWED_TABLES
+def full_scans(plan):
+    scans = []
+    subqueries = set()
+    for detail in plan:
+        subquery = SUBQUERY_PATTERN.match(detail.strip())
+        if subquery:
+            subqueries.add(subquery.group(1))
+        match = FULL_SCAN_PATTERN.match(detail.strip())
+        if match and match.group(1) not in SCAN_ALLOWED_TABLES | subqueries:
+            scans.append(detail.strip())
+    return scans
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fail when an application query or statement needs a full table scan.")
+    parser.add_argument('--db', help="database file to check (defaults to the application database)")
+    parser.add_argument('--migrate', action='store_true', help="apply pending schema migrations before checking")
+    args = parser.parse_args(argv)
+
+    if args.db:
+        configure_pool(args.db)
+    if args.migrate:
+        with write_connection() as conn:
+            migrate(conn)
+        ensure_sector_year_rollup()
+
+    failures = 0
+    conn = connect_read_only(get_pool().db_path)
+    # The file stays read-only (mode=ro); query_only is lifted so the temp table of ingest.py can be created
+    conn.execute("PRAGMA query_only = OFF")
+    conn.execute(ingest.CREATE_TOUCHED_TABLE)
+    try:
+        for name, sql in collect_queries():
+            plan = explain(conn, sql)
+            scans = full_scans(plan)
+            if scans and name not in FULL_SCAN_ALLOWED:
+                status = 'FULL SCAN'
+                failures += 1
+            elif scans:
+                status = 'ok (full scan allowed)'
+            else:
+                status = 'ok'
+            print(f"{status:24} {name}")
+            for detail in plan:
+                print(f"{'':24}   {detail}")
+    finally:
+        conn.close()
+
+    print(f"\n{failures} quer{'y' if failures == 1 else 'ies'} fell back to a full table scan "
+          f"(database: {get_pool().db_path})")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
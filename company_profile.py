@@ -0,0 +1,52 @@
+from cache import CACHE_TTL, QueryCache, db_version
+from pool import read_connection
+
+# Companies whose profiles are kept in memory; flipping between recently viewed companies never queries the database
+PROFILE_CACHE_SIZE = 64
+
+# Company details together with every year of financials, in a single round trip. The details repeat on
+# each year row; a company without financials still returns one row whose financial columns are NULL.
+COMPANY_PROFILE_QUERY = """
+    SELECT c.name, c.industry_sector, c.email, c.phone_number, c.establishment_date, c.purpose,
+           f.year, f.profit_loss, f.equity, f.return_on_assets, f.solvency_ratio
+    FROM company c
+    LEFT JOIN financials f ON f.cvr = c.cvr_number
+    WHERE c.cvr_number = ?
+    ORDER BY f.year
+"""
+
+DETAIL_COLUMNS = ('name', 'industry_sector', 'email', 'phone_number', 'establishment_date', 'purpose')
+FINANCIAL_COLUMNS = ('year', 'profit_loss', 'equity', 'return_on_assets', 'solvency_ratio')
+
+# Per-CVR LRU of profiles, keyed on the CVR number and the database version
+profile_cache = QueryCache(maxsize=PROFILE_CACHE_SIZE, ttl=CACHE_TTL)
+
+
+# Run the profile query and split its rows into details, the latest year and the full history
+def _load_profile(cvr_number):
+    with read_connection() as conn:
+        rows = conn.execute(COMPANY_PROFILE_QUERY, (cvr_number,)).fetchall()
+    if not rows:
+        return {'details': None, 'latest': None, 'history': ()}
+
+    details = dict(zip(DETAIL_COLUMNS, rows[0][:len(DETAIL_COLUMNS)]))
+    history = tuple(row[len(DETAIL_COLUMNS):] for row in rows if row[len(DETAIL_COLUMNS)] is not None)
+    latest = dict(zip(FINANCIAL_COLUMNS, history[-1])) if history else None
+    return {'details': details, 'latest': latest, 'history': history}
+
+
+# Profile of one company: its details, its most recent year of financials and every year of history
+# as (year, profit_loss, equity, return_on_assets, solvency_ratio) tuples. Shared between sessions; read-only.
+def get_company_profile(cvr_number):
+    cvr_number = int(cvr_number)
+    return profile_cache.get_or_compute((cvr_number, db_version()), lambda: _load_profile(cvr_number))
+
+
+# Years of a profile's history within year_range as (year, profit_loss, equity, return_on_assets) tuples
+def profile_history(profile, year_range):
+    start, end = year_range
+    return [row[:4] for row in profile['history'] if start <= row[0] <= end]
+
+
+def profile_cache_stats():
+    return profile_cache.stats()
@@ -6,21 +6,52 @@ import pandas as pd  # Used for data manipulation and analysis
 from styles import apply_custom_css  # Custom function to apply CSS styling
 import os  
 from utils import sector_attributes, get_company_codes
-from metrics import sector_performance_overview, financial_health_dashboard, investment_opportunity_identification, company_level_comparison, visualize_company_comparison, operational_efficiency_analysis, liquidity_and_solvency_trend_analysis
-from db import get_year_range, get_sector_choices, fetch_companies_in_sector, fetch_company_financial_history, fetch_financial_data_for_two_companies, display_company_info
+from metrics import FINANCIAL_HEALTH_METRICS, INVESTMENT_THRESHOLDS, sector_performance_overview, financial_health_dashboard, investment_opportunity_identification, company_level_comparison, visualize_company_comparison, operational_efficiency_analysis, liquidity_and_solvency_trend_analysis
+from charts import company_trend_figure, show_figure
+from bootstrap import bootstrap
+from db import COMPARISON_METRICS, get_sector_choices, fetch_company_financial_history, fetch_financial_data_for_companies, display_company_info
+from search import company_picker, search_companies
+from auth_service import auth_stats, revoke_session_token
+from instrumentation import instrumented_rerun, is_admin, render_timing_panel, set_rerun_view
+from cache import cache_stats
+from pool import pool_stats
+from store import store_stats
+from prefetch import cancel_prefetch, prefetch_adjacent_views, prefetch_stats
+from reports import show_report
+import secrets
+
+# Views of the "View Data" selectbox, in order; the prefetcher warms the neighbours of the current one
+VIEWS = ["Sector Performance Overview","Financial Health Dashboard", "Investment Opportunity Identification", "Company Comparison", "Operational Efficiency Analysis", "Liquidity and Solvency Trend Analysis", "Capital Structure and Financing Insights", "Company Analysis", "Company to Company Comparison", "Company Information"]
 
 
 # Main function to run the Streamlit dashboard
 def run_dashboard():
+    username = st.session_state.get('username')
+    # Time every instrumented fetch, view and chart of this rerun and append them to the timing log
+    with instrumented_rerun(username):
+        render_dashboard()
+    # Admins get the timings of the rerun that just finished, plus the shared caches and pools
+    if is_admin(username):
+        render_timing_panel({'Query cache': cache_stats(), 'Connection pool': pool_stats(),
+                             'Analytics store': store_stats(), 'Authentication': auth_stats(),
+                             'Prefetch': prefetch_stats()})
+
+
+def render_dashboard():
     # Apply custom CSS styles to the Streamlit app
     apply_custom_css()
     st.sidebar.header("Filters")
-    # Retrieve and display sector choices in the sidebar
-    sectors = get_sector_choices()
+    # Metadata discovered once per database version by the bootstrap
+    metadata = bootstrap()
+    # Retrieve and display sector choices in the sidebar; only sectors with companies are listed,
+    # the user's preferred sectors (loaded at login) first
+    sectors = [sector_attributes[code] for code in metadata['sector_codes']] or get_sector_choices()
+    preferred = [sector_attributes[code] for code in st.session_state.get('sectors', []) if sector_attributes[code] in sectors]
+    sectors = preferred + [name for name in sectors if name not in preferred]
     sector_choice = st.sidebar.selectbox("Select Sector", sectors, format_func=lambda x: sector_attributes.get(x, x))
 
-    # Get the available year range from the database
-    min_year, max_year = get_year_range()
+    # Get the available year range of the database
+    min_year, max_year = metadata['year_range']
     # Allow the user to select a start year within the range
     start_year = st.sidebar.text_input("Start Year", value=str(min_year))
     # Allow the user to select an end year within the range
@@ -34,60 +65,72 @@ def run_dashboard():
         # Display an error message if the conversion fails and revert to the full range
         st.sidebar.error("Please enter valid years")
         selected_start_year, selected_end_year = min_year, max_year
+    # Accept the years in either order
+    if selected_start_year > selected_end_year:
+        selected_start_year, selected_end_year = selected_end_year, selected_start_year
+    # Every view reads only the selected years; the caches are keyed on this window
+    year_range = (selected_start_year, selected_end_year)
 
     # Display the main header for the dashboard
     st.header("Investor Dashboard")
     # Create a sidebar selection box for different data views
-    view_data = st.sidebar.selectbox("View Data", ["Sector Performance Overview","Financial Health Dashboard", "Investment Opportunity Identification", "Company Comparison", "Operational Efficiency Analysis", "Liquidity and Solvency Trend Analysis", "Capital Structure and Financing Insights", "Company Analysis", "Company to Company Comparison", "Company Information"])
+    view_data = st.sidebar.selectbox("View Data", VIEWS)
 
     sector_code = get_company_codes(sector_choice)
+    set_rerun_view(view_data)
+    # The sector overview, financial health and trend views are served from the pre-rendered reports
+    # (reports.py) when they are current for the database and the selected years, otherwise rendered live
     if view_data == "Sector Performance Overview":
-        sector_performance_overview()
+        if not show_report('sector_performance', year_range):
+            sector_performance_overview(year_range)
     elif view_data == "Financial Health Dashboard":
-        # once clicked show a select box
-        more_data = st.sidebar.selectbox("Select Financial Health Metrics", ['Average Solvency Ratio by Sector Over Time', 'Average ROA by Sector Over Time', 'Average ROI by Sector Over Time', 'Average Current Ratio by Sector Over Time'])
-        # call financial health dashboard function with an argument depending on the selection
-        if more_data == 'Average Solvency Ratio by Sector Over Time':
-            financial_health_dashboard('avg_solvency_ratio')
-        elif more_data == 'Average ROA by Sector Over Time':
-            financial_health_dashboard('avg_return_on_assets')
-        elif more_data == 'Average ROI by Sector Over Time':
-            financial_health_dashboard('avg_return_on_investment')
-        elif more_data == 'Average Current Ratio by Sector Over Time':
-            financial_health_dashboard('avg_current_ratio')
+        # once clicked show a select box listing the registered financial health metrics
+        metric = st.sidebar.selectbox("Select Financial Health Metrics", list(FINANCIAL_HEALTH_METRICS), format_func=lambda key: FINANCIAL_HEALTH_METRICS[key]['label'])
+        # call financial health dashboard function for the selected metric and year range
+        if not show_report('financial_health', year_range, metric=metric):
+            financial_health_dashboard(metric, year_range)
     elif view_data == "Investment Opportunity Identification":
-        investment_opportunity_identification()
+        # Let the user tune the screening thresholds; the sqlite backend applies them in the SQL query,
+        # the store and snapshot backends to their company-year frame (see fetch_investment_opportunities_data)
+        with st.sidebar.expander("Investment filters"):
+            thresholds = {
+                'min_profit_margin': st.number_input("Minimum profit margin", value=INVESTMENT_THRESHOLDS['min_profit_margin'], step=0.01),
+                'min_return_on_investment': st.number_input("Minimum return on investment", value=INVESTMENT_THRESHOLDS['min_return_on_investment'], step=0.01),
+                'min_equity_growth': st.number_input("Minimum equity growth", value=INVESTMENT_THRESHOLDS['min_equity_growth'], step=0.01),
+                'min_assets_growth': st.number_input("Minimum assets growth", value=INVESTMENT_THRESHOLDS['min_assets_growth'], step=0.01),
+            }
+        investment_opportunity_identification(thresholds, year_range)
     elif view_data == "Operational Efficiency Analysis":
-        operational_efficiency_analysis()
+        if not show_report('operational_efficiency', year_range, sector_code):
+            operational_efficiency_analysis(sector_code, year_range)
     elif view_data == "Liquidity and Solvency Trend Analysis":
-        liquidity_and_solvency_trend_analysis()
+        if not show_report('liquidity_and_solvency', year_range, sector_code):
+            liquidity_and_solvency_trend_analysis(sector_code, year_range)
     elif view_data == "Company Analysis":
-        # Fetch and display a list of companies in the selected sector for analysis
-        companies = fetch_companies_in_sector(sector_code)
-        if companies:
-            # Allow the user to select a company from the list for analysis
-            selected_company = st.sidebar.selectbox("Select a Company for Analysis", companies, format_func=lambda x: x[1])
+        # Search the companies in the selected sector; only one page of matches is sent to the sidebar
+        selected_company = company_picker("Search for a Company to Analyse", sector_code, key="company_analysis")
+        if selected_company:
             # Extract the CVR number of the selected company
             cvr_number = selected_company[0]
             
             # Display financial data for the selected company when the user clicks the 'Show Financial Data' button
             if st.sidebar.button('Show Financial Data'):
-                company_data = fetch_company_financial_history(cvr_number, (selected_start_year, selected_end_year))
+                company_data = fetch_company_financial_history(cvr_number, year_range)
                 if company_data:
                     # Convert the fetched data into a DataFrame
                     df = pd.DataFrame(company_data, columns=['Year', 'Profit/Loss (DKK)', 'Equity', 'ROA'])
                     
                     # Create and display a line chart for the company's profit/loss history
                     profit_loss_fig = px.line(df, x='Year', y='Profit/Loss (DKK)', title=f'Profit/Loss of {selected_company[1]}')
-                    st.plotly_chart(profit_loss_fig, use_container_width=True)
+                    show_figure(profit_loss_fig, use_container_width=True)
 
                     # Create and display a line chart for the company's equity history
                     equity_fig = px.line(df, x='Year', y='Equity', title=f'Equity of {selected_company[1]}')
-                    st.plotly_chart(equity_fig, use_container_width=True)
+                    show_figure(equity_fig, use_container_width=True)
 
                     # Create and display a line chart for the company's ROA history
                     roa_fig = px.line(df, x='Year', y='ROA', title=f'Return on Assets (ROA) of {selected_company[1]}')
-                    st.plotly_chart(roa_fig, use_container_width=True)
+                    show_figure(roa_fig, use_container_width=True)
                     
                     # Display a detailed explanation of the company's financial analysis
                     st.markdown(f"""
@@ -104,34 +147,41 @@ def run_dashboard():
                     st.write("No financial data available for the selected company.")
                 
     elif view_data == "Company to Company Comparison":
-        # Fetch and display a list of companies in the selected sector for comparison
-        companies = fetch_companies_in_sector(sector_code)
-        if companies:
-            # Create a list of company options for comparison
-            company_options = [(cvr, name) for cvr, name in companies]
-            # Allow the user to select the first company for comparison
-            cvr_number1, company_name1 = st.sidebar.selectbox("Select the first company for comparison", company_options, format_func=lambda x: x[1])
-            # Allow the user to select the second company for comparison
-            cvr_number2, company_name2 = st.sidebar.selectbox("Select the second company for comparison", company_options, format_func=lambda x: x[1])
+        # Build a peer group: search the selected sector and add companies one by one or a page at a time
+        peer_group = st.session_state.setdefault('peer_group', {})
+        candidate = company_picker("Search for companies to compare", sector_code, key="compare")
+        add_col, add_page_col = st.sidebar.columns(2)
+        if candidate and add_col.button("Add company"):
+            peer_group[candidate[0]] = candidate[1]
+        if add_page_col.button("Add page"):
+            peer_group.update(search_companies(st.session_state.get("compare_query", ""), sector_code,
+                                               st.session_state.get("compare_page", 0))[0])
 
+        # The multi-select lists the peer group; removing a company here drops it from the group
+        selected = st.sidebar.multiselect("Companies to compare", list(peer_group), default=list(peer_group),
+                                          format_func=lambda cvr: peer_group.get(cvr, str(cvr)))
+        for cvr in set(peer_group) - set(selected):
+            del peer_group[cvr]
+
+        if len(selected) >= 2:
             # Display comparison data when the user clicks the 'Compare Companies' button
             if st.sidebar.button('Compare Companies'):
-                comparison_data = fetch_financial_data_for_two_companies(cvr_number1, cvr_number2, (selected_start_year, selected_end_year))
-                if comparison_data:
-                    # Convert the fetched data into a DataFrame and add a 'Company' column for identification
-                    df = pd.DataFrame(comparison_data, columns=['CVR', 'Year', 'Profit/Loss (DKK)', 'Equity', 'ROA'])
-                    df['Company'] = df['CVR'].map({cvr_number1: company_name1, cvr_number2: company_name2})
-                    
-                    # Create and display bar charts for financial comparison between the two companies
-                    for metric in ['Profit/Loss (DKK)', 'Equity', 'ROA']:
-                        fig = px.bar(df, x='Company', y=metric, barmode='group', color='Company', title=f'{metric} Comparison for {company_name1} vs {company_name2}')
-                        fig.update_xaxes(title_text='Company')
-                        fig.update_yaxes(title_text=metric)
-                        st.plotly_chart(fig, use_container_width=True)
-                        
-                    # Display a detailed explanation of the company-to-company financial comparison
+                # One chunked, parameterized query for the whole peer group
+                df = fetch_financial_data_for_companies(selected, year_range, COMPARISON_METRICS)
+                if not df.empty:
+                    df = df.reset_index()
+                    # Create and display one chart per metric; large peer groups switch to percentile bands
+                    for metric, label in [('profit_loss', 'Profit/Loss (DKK)'), ('equity', 'Equity'), ('return_on_assets', 'ROA')]:
+                        fig = company_trend_figure(df, metric, f'{label} Comparison of {len(selected)} Companies')
+                        fig.update_yaxes(title_text=label)
+                        show_figure(fig, use_container_width=True)
+
+                    # Show the compared values side by side, one row per company and year
+                    st.dataframe(df, hide_index=True)
+
+                    # Display a detailed explanation of the company comparison
                     st.markdown(f"""
-                    Comparing **{company_name1}** and **{company_name2}** provides a side-by-side view of their financial performance. This comparison includes Profit/Loss, Equity, and Return on Assets (ROA), key metrics that highlight each company's financial strengths and weaknesses.
+                    Comparing **{len(selected)}** companies provides a side-by-side view of their financial performance. This comparison includes Profit/Loss, Equity, and Return on Assets (ROA), key metrics that highlight each company's financial strengths and weaknesses.
                     - **Profit/Loss** comparison reveals which company is more profitable.
                     - **Equity** comparison shows the financial stability and net value of each company.
                     - **ROA** comparison indicates how effectively each company uses its assets to generate profit.
@@ -141,28 +191,32 @@ def run_dashboard():
                 else:
                     # Display a message if no data is available for the selected companies
                     st.write("No data available for the selected companies.")
+        else:
+            st.write("Add at least two companies to compare.")
                     
     elif view_data == "Company Information":
-        # Fetch and display a list of companies in the selected sector for information viewing
-        companies = fetch_companies_in_sector(sector_code)
-        if companies:
-            # Create a list of company options for information viewing
-            company_options = [(cvr, name) for cvr, name in companies]
-            # Allow the user to select a company for viewing its information
-            selected_company = st.sidebar.selectbox("Select a company", company_options, format_func=lambda x: x[1], key="company_info")
+        # Search the companies in the selected sector for information viewing
+        selected_company = company_picker("Search for a company", sector_code, key="company_info")
+        if selected_company:
             # Extract the CVR number of the selected company
             selected_cvr = selected_company[0]
 
             # Display the information for the selected company
             display_company_info(selected_cvr)
         else:
-            # Display a message if no companies are available in the selected sector
-            st.write("No companies available in the selected sector.")
+            # Display a message if no company in the selected sector matches the search
+            st.write("No matching companies in the selected sector.")
 
     else:
         st.write("Hello world")
 
+    # The view has rendered; warm the views next to it for this sector and year window in the background
+    prefetch_owner = st.session_state.setdefault('prefetch_owner', secrets.token_hex(8))
+    prefetch_adjacent_views(prefetch_owner, VIEWS, view_data, sector_code, year_range)
+
     # add logout button
     if st.sidebar.button("Logout"):
+        cancel_prefetch(prefetch_owner)
+        revoke_session_token(st.session_state.get('auth_token'))
         st.session_state.show_login = True
         st.session_state.logged_in = False
\ No newline at end of file
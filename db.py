@@ -1,112 +1,109 @@
-import sqlite3
-import os
+import logging
 from utils import sector_attributes
+from pool import read_connection, write_connection
+from rollup import ensure_sector_year_rollup
+from schema import derived_columns_pending, migrate
+from cache import cached_query
+from company_profile import DETAIL_COLUMNS, get_company_profile, profile_history
+from loader import load_frame
+from instrumentation import instrumented
+import pandas as pd
 import streamlit as st
 
+logger = logging.getLogger(__name__)
 
-# Function to establish a connection with the SQLite database
-def get_db_connection():
-    # Build the path to the database file using the current file location
-    db_path = os.path.join(os.path.dirname(__file__), 'cvr_database.db')
-    # Connect to the SQLite database and return the connection object
-    return sqlite3.connect(db_path)
 
-# Function to set up the database by creating necessary tables if they don't exist
+# SQL queries used by the functions below; kept at module level so check_query_plans.py can inspect them
+# Two scalar subqueries so SQLite can answer MIN and MAX each from one end of the year index
+# instead of walking the whole index for a combined MIN/MAX aggregate
+YEAR_RANGE_QUERY = "SELECT (SELECT MIN(year) FROM financials), (SELECT MAX(year) FROM financials)"
+
+COMPANIES_IN_SECTOR_QUERY = """
+    SELECT cvr_number, name
+    FROM company
+    WHERE industry_sector = ?
+    ORDER BY name
+    """
+
+# Metrics compared between companies by default
+COMPARISON_METRICS = ('profit_loss', 'equity', 'return_on_assets')
+# 'financials' columns that may be requested in a company comparison
+COMPARABLE_COLUMNS = {
+    'profit_loss', 'equity', 'assets', 'revenue', 'gross_profit_loss', 'return_on_assets',
+    'return_on_investment', 'solvency_ratio', 'current_ratio', 'profit_margin', 'cash_and_cash_equivalents',
+}
+# Most CVR numbers bound in one comparison query, safely below SQLite's variable limit
+# (999 in builds before 3.32); larger peer groups are fetched in several chunks
+MAX_CVRS_PER_QUERY = 900
+
+
+# SQL query for the given metrics of count companies within a year window
+def companies_financials_query(count, metrics=COMPARISON_METRICS):
+    unknown = set(metrics) - COMPARABLE_COLUMNS
+    if unknown:
+        raise ValueError(f"Cannot compare companies on {sorted(unknown)}")
+    return f"""
+    SELECT f.cvr, c.name AS company_name, f.year, {', '.join('f.' + metric for metric in metrics)}
+    FROM financials f
+    JOIN company c ON f.cvr = c.cvr_number
+    WHERE f.cvr IN ({', '.join('?' * count)}) AND f.year BETWEEN ? AND ?
+    """
+
+
+# Function to set up the database by applying any pending schema migrations
 def setup_database():
-    # Establish a connection to the database
-    conn = get_db_connection()
-    # Create a cursor object to execute SQL queries
-    cursor = conn.cursor()
-
-    # SQL query to check if the 'users' table exists in the database
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
-    # Fetch the result of the query
-    table_exists = cursor.fetchone()
-
-    # Uncomment below lines to drop the 'users' table if it exists (optional, based on requirements)
-    # if table_exists:
-    #     cursor.execute("DROP TABLE users")
-
-    # SQL query to create the 'users' table if it does not already exist
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY,
-            password TEXT NOT NULL,
-            sectors TEXT
-        )
-    """)
-    # Commit the changes to the database
-    conn.commit()
+    # Use the shared writer connection; it commits the changes when the block exits
+    with write_connection() as conn:
+        # Create the 'users' table and the indexes behind the hot queries if they don't exist yet
+        migrate(conn)
+        # Backfilling reads every financials row, which is too slow for startup; it is an explicit step
+        if derived_columns_pending(conn):
+            logger.warning("The stored derived columns of financials are empty until "
+                           "'python ingest.py --backfill' has been run; until then the sqlite backend shows "
+                           "no growth or efficiency ratios and the snapshot no growth")
+
+    # Build the sector/year rollup on first start and refresh any (sector, year) pairs that changed since
+    ensure_sector_year_rollup()
 
 def get_sector_choices():
     return list(sector_attributes.values())
 
 
 # Function to get the range of years from the 'financials' table in the database
+@instrumented
 def get_year_range():
-    # Establish a connection to the database
-    conn = get_db_connection()
-    # Create a cursor object to execute SQL queries
-    cursor = conn.cursor()
-    # Execute a SQL query to find the minimum and maximum year in the 'financials' table
-    cursor.execute("SELECT MIN(year), MAX(year) FROM financials")
-    # Fetch the result of the query
-    min_year, max_year = cursor.fetchone()
+    # Check out a pooled read-only connection for the duration of the query
+    with read_connection() as conn:
+        # Create a cursor object to execute SQL queries
+        cursor = conn.cursor()
+        # Execute a SQL query to find the minimum and maximum year in the 'financials' table
+        cursor.execute(YEAR_RANGE_QUERY)
+        # Fetch the result of the query
+        min_year, max_year = cursor.fetchone()
     # Return the minimum and maximum year
     return min_year, max_year
 
+@instrumented
 def fetch_companies_in_sector(sector_code):
-    # Establish a connection to the database
-    conn = get_db_connection()
-    # Create a cursor object to execute SQL queries
-    cursor = conn.cursor()
-    # SQL query to select companies from a specific sector, ordered by name
-    query = """
-    SELECT cvr_number, name
-    FROM company
-    WHERE industry_sector = ?
-    ORDER BY name
-    """
-    # Execute the query with the sector_code as a parameter
-    cursor.execute(query, (sector_code,))
-    # Fetch all rows of the query result
-    return cursor.fetchall()
+    # Check out a pooled read-only connection for the duration of the query
+    with read_connection() as conn:
+        # Execute the query with the sector_code as a parameter and fetch all rows of the result
+        return conn.execute(COMPANIES_IN_SECTOR_QUERY, (sector_code,)).fetchall()
 
+@instrumented
 def fetch_company_financial_history(cvr_number, year_range):
-    # Establish a connection to the database
-    conn = get_db_connection()
-    # Create a cursor object to execute SQL queries
-    cursor = conn.cursor()
-    # SQL query to select year, profit/loss, equity, and return on assets for the given company and year range
-    query = """
-    SELECT year, profit_loss, equity, return_on_assets
-    FROM financials
-    WHERE cvr = ? AND year BETWEEN ? AND ?
-    ORDER BY year
-    """
-    # Combine the CVR number and year range into a single tuple for the query parameters
-    params = (cvr_number,) + year_range
-    # Execute the query with the parameters
-    cursor.execute(query, params)
-    # Fetch all rows of the query result
-    return cursor.fetchall()
+    # The company profile holds every year of history; it is cached per CVR number, so changing
+    # the year range or coming back to a company does not query the database again
+    return profile_history(get_company_profile(cvr_number), year_range)
 
 # Function to display detailed information for a selected company using its CVR number
+@instrumented
 def display_company_info(cvr_number):
-    # Establish a connection to the database
-    conn = get_db_connection()
-    # Create a cursor object to execute SQL queries
-    cursor = conn.cursor()
-    # SQL queries to select basic and financial information for the given company
-    company_query = "SELECT name, industry_sector, email, phone_number, establishment_date, purpose FROM company WHERE cvr_number = ?"
-    financial_query = "SELECT profit_loss, equity, return_on_assets, solvency_ratio FROM financials WHERE cvr = ? ORDER BY year DESC LIMIT 1"
-    
-    # Execute the queries
-    cursor.execute(company_query, (cvr_number,))
-    company_data = cursor.fetchone()
-    
-    cursor.execute(financial_query, (cvr_number,))
-    financial_data = cursor.fetchone()
+    # Details and the most recent year of financials come from the cached company profile (one query on a miss)
+    profile = get_company_profile(cvr_number)
+    company_data = profile['details'] and tuple(profile['details'][column] for column in DETAIL_COLUMNS)
+    latest = profile['latest']
+    financial_data = latest and (latest['profit_loss'], latest['equity'], latest['return_on_assets'], latest['solvency_ratio'])
     
     # Check and display company data if available
     if company_data:
@@ -138,21 +135,35 @@ def display_company_info(cvr_number):
         # Display error message if financial data is not available
         st.error("Financial information not available.")
 
+# Load the comparison metrics of many companies; cached per peer group, window and database version
+@cached_query
+def _fetch_companies_frame(cvr_numbers, year_range, metrics):
+    chunks = []
+    for start in range(0, len(cvr_numbers), MAX_CVRS_PER_QUERY):
+        chunk = cvr_numbers[start:start + MAX_CVRS_PER_QUERY]
+        # One parameterized query per chunk: the CVR numbers followed by the year window
+        chunks.append(load_frame(companies_financials_query(len(chunk), metrics), params=chunk + tuple(year_range)))
+    df = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+    # Company names may be categoricals with different categories per chunk; plain strings concatenate cleanly
+    df['company_name'] = df['company_name'].astype(str)
+    return df.set_index(['cvr', 'year']).sort_index()
+
+
+# Function to fetch financial data for any number of companies within a year range.
+# Returns one frame indexed by (cvr, year) with a company_name column and one column per metric.
+@instrumented
+def fetch_financial_data_for_companies(cvr_numbers, year_range, metrics=COMPARISON_METRICS):
+    # Drop duplicates but keep the order the companies were picked in
+    cvr_numbers = tuple(dict.fromkeys(int(cvr) for cvr in cvr_numbers))
+    if not cvr_numbers:
+        return pd.DataFrame(columns=['company_name', *metrics],
+                            index=pd.MultiIndex.from_arrays([[], []], names=['cvr', 'year']))
+    return _fetch_companies_frame(cvr_numbers, tuple(year_range), tuple(metrics))
+
+
+@instrumented
 def fetch_financial_data_for_two_companies(cvr_number1, cvr_number2, year_range):
-    # Establish a connection to the database
-    conn = get_db_connection()
-    # Create a cursor object to execute SQL queries
-    cursor = conn.cursor()
-    # SQL query to select financial data for two companies over the given year range
-    query = """
-    SELECT cvr, year, profit_loss, equity, return_on_assets
-    FROM financials
-    WHERE cvr IN (?, ?) AND year BETWEEN ? AND ?
-    ORDER BY year, cvr
-    """
-    # Combine the parameters into a single tuple
-    params = (cvr_number1, cvr_number2, year_range[0], year_range[1])
-    # Execute the query with the parameters
-    cursor.execute(query, params)
-    # Fetch all rows of the query result
-    return cursor.fetchall()
\ No newline at end of file
+    # Rows of (cvr, year, profit_loss, equity, return_on_assets) ordered by year, then CVR number
+    df = fetch_financial_data_for_companies([cvr_number1, cvr_number2], year_range).reset_index()
+    df = df.sort_values(['year', 'cvr'])[['cvr', 'year', *COMPARISON_METRICS]]
+    return list(df.astype(object).itertuples(index=False, name=None))
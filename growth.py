@@ -0,0 +1,39 @@
+import numpy as np
+
+# Year-over-year growth columns computed by add_growth_columns: source column -> growth column
+GROWTH_COLUMNS = {
+    'equity': 'equity_growth',
+    'assets': 'assets_growth',
+}
+
+# Add year-over-year growth columns for every source column in columns.
+# Rows are sorted once by (key, year) - skipped when they already are - and all growth
+# columns are computed in a single vectorized pass: each value is divided by the value
+# of the previous row, and rows that start a new company (group boundary) get NaN.
+# A previous value of 0 gives NaN too rather than +/-inf, matching the NULL that SQLite's
+# division by zero leaves in the stored growth columns (schema.GROWTH_UPDATE).
+# Companies are identified by CVR so two companies sharing a name are never mixed.
+def add_growth_columns(df, columns=GROWTH_COLUMNS, key='cvr', year='year'):
+    if not df.empty:
+        keys = df[key].to_numpy()
+        years = df[year].to_numpy()
+        already_sorted = bool(np.all((keys[1:] > keys[:-1]) | ((keys[1:] == keys[:-1]) & (years[1:] > years[:-1]))))
+        if not already_sorted:
+            df = df.sort_values([key, year], kind='stable', ignore_index=True)
+
+    keys = df[key].to_numpy()
+    # True where a row continues the company of the previous row
+    same_company = np.zeros(len(df), dtype=bool)
+    same_company[1:] = keys[1:] == keys[:-1]
+
+    sources = list(columns)
+    values = df[sources].to_numpy(dtype=np.float64)
+    growth = np.full_like(values, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth[1:] = values[1:] / values[:-1] - 1.0
+    growth[~same_company] = np.nan
+    growth[~np.isfinite(growth)] = np.nan
+
+    for position, source in enumerate(sources):
+        df[columns[source]] = growth[:, position]
+    return df
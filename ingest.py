@@ -0,0 +1,327 @@
+# Load company and financial records from CSV or JSONL files (optionally gzipped) into the database.
+# Records are streamed in fixed-size batches and upserted with executemany in large transactions:
+# companies by CVR number, financials by (cvr, year). Secondary indexes and the rollup triggers are
+# dropped for the load and rebuilt once at the end. The derived columns (operating margin, expense
+# ratio and year-over-year growth) are computed during the load, so the views can read them directly.
+# Two maintenance steps the application's startup migrations leave to this script:
+#   --dedupe   remove duplicated companies and company-years, which keep migrations 4 and 5 from
+#              creating their unique keys
+#   --backfill compute the derived columns of every financials row (also done by any load while
+#              the rows present at migration 4 are still waiting for it)
+#
+# Usage: python ingest.py [--db path/to/cvr_database.db] [--companies companies.csv]
+#                         [--financials financials.jsonl.gz] [--batch-size 50000] [--keep-indexes]
+#                         [--dedupe] [--backfill]
+import argparse
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from pool import DB_PATH
+from rollup import TRIGGERS, create_rollup_schema, refresh_sector_year_rollup
+from schema import GROWTH_UPDATE, backfill_derived_columns, derived_columns_pending, migrate
+from utils import sector_attributes, sector_codes
+
+logger = logging.getLogger(__name__)
+
+# Records per executemany batch; bounds the memory held by the load
+INGEST_BATCH_SIZE = 50_000
+# Rows written per transaction
+COMMIT_ROWS = 500_000
+# Page cache of the loading connection in KiB; the index builds at the end use it
+INGEST_CACHE_SIZE_KIB = 256 * 1024
+# Rejected records that are logged individually; the rest are only counted
+LOGGED_REJECTS = 10
+
+COMPANY_COLUMNS = ('cvr_number', 'name', 'industry_sector', 'email', 'phone_number', 'establishment_date', 'purpose')
+FINANCIAL_VALUE_COLUMNS = (
+    'profit_loss', 'equity', 'return_on_assets', 'solvency_ratio', 'gross_profit_loss', 'assets',
+    'return_on_investment', 'current_ratio', 'profit_margin', 'revenue', 'external_expenses', 'employee_expense',
+    'profit_loss_from_ordinary_operating_activities', 'cash_and_cash_equivalents',
+)
+# Written with every financials row; growth is filled in after the load, once every year is present
+FINANCIAL_COLUMNS = ('cvr', 'year', *FINANCIAL_VALUE_COLUMNS, 'operating_margin', 'expense_ratio')
+
+UPSERT_COMPANY = f"""
+    INSERT INTO company ({', '.join(COMPANY_COLUMNS)}) VALUES ({', '.join('?' * len(COMPANY_COLUMNS))})
+    ON CONFLICT (cvr_number) DO UPDATE SET
+    {', '.join(f'{column} = excluded.{column}' for column in COMPANY_COLUMNS[1:])}
+"""
+UPSERT_FINANCIALS = f"""
+    INSERT INTO financials ({', '.join(FINANCIAL_COLUMNS)}) VALUES ({', '.join('?' * len(FINANCIAL_COLUMNS))})
+    ON CONFLICT (cvr, year) DO UPDATE SET
+    {', '.join(f'{column} = excluded.{column}' for column in FINANCIAL_COLUMNS[2:])}
+"""
+
+# Remove duplicated keys so the unique indexes of the migrations can be created; the most recently
+# inserted row of each company and company-year is kept
+DEDUPE_STATEMENTS = [
+    "DELETE FROM company WHERE rowid NOT IN (SELECT MAX(rowid) FROM company GROUP BY cvr_number)",
+    "DELETE FROM financials WHERE rowid NOT IN (SELECT MAX(rowid) FROM financials GROUP BY cvr, year)",
+]
+
+# CVR numbers whose financials were written, for the growth pass after the load
+TOUCHED_TABLE = 'temp.ingest_cvrs'
+CREATE_TOUCHED_TABLE = f"CREATE TABLE IF NOT EXISTS {TOUCHED_TABLE} (cvr INTEGER PRIMARY KEY)"
+# Year-over-year growth of the companies written to by a load
+TOUCHED_GROWTH_UPDATE = GROWTH_UPDATE.format(where=f"WHERE cvr IN (SELECT cvr FROM {TOUCHED_TABLE})")
+# The unique keys the upserts depend on; never deferred
+KEPT_INDEXES = {'idx_company_cvr_number_key', 'idx_financials_cvr_year_key'}
+
+
+class RejectedRecord(ValueError):
+    # A record that cannot be loaded (missing key, unparseable number); it is skipped and counted
+    pass
+
+
+# Iterate the records of a .csv or .jsonl/.ndjson file (either optionally .gz) as dicts
+def read_records(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    raw = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    with io.TextIOWrapper(raw, encoding='utf-8', newline='') as f:
+        if name.endswith('.csv'):
+            yield from csv.DictReader(f)
+        elif name.endswith(('.jsonl', '.ndjson')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError(f"Cannot tell the format of {path}; expected .csv, .jsonl or .ndjson (optionally .gz)")
+
+
+def _text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _number(record, column):
+    value = record.get(column)
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise RejectedRecord(f"{column} is not a number: {value!r}")
+
+
+def _integer(record, *columns):
+    for column in columns:
+        value = record.get(column)
+        if value is not None and value != '':
+            try:
+                return int(float(value))
+            except (TypeError, ValueError):
+                raise RejectedRecord(f"{column} is not an integer: {value!r}")
+    raise RejectedRecord(f"{' or '.join(columns)} is missing")
+
+
+# Sector code for a code or a display name; unknown sectors are stored as NULL
+def _sector_code(value):
+    value = _text(value)
+    if value is None or value in sector_attributes:
+        return value
+    return sector_codes.get(value)
+
+
+def company_row(record):
+    return (
+        _integer(record, 'cvr_number', 'cvr'),
+        _text(record.get('name')),
+        _sector_code(record.get('industry_sector')),
+        *(_text(record.get(column)) for column in COMPANY_COLUMNS[3:]),
+    )
+
+
+# Value a / b, or None when either is missing or b is zero
+def _ratio(a, b):
+    if a is None or not b:
+        return None
+    return a / b
+
+
+def financial_row(record):
+    values = {column: _number(record, column) for column in FINANCIAL_VALUE_COLUMNS}
+    expenses = (None if values['external_expenses'] is None or values['employee_expense'] is None
+                else values['external_expenses'] + values['employee_expense'])
+    return (
+        _integer(record, 'cvr', 'cvr_number'),
+        _integer(record, 'year'),
+        *values.values(),
+        _ratio(values['profit_loss_from_ordinary_operating_activities'], values['revenue']),
+        _ratio(expenses, values['revenue']),
+    )
+
+
+# Convert records to rows and group them in lists of batch_size; rejected records are counted in stats
+def _batches(records, convert, batch_size, stats):
+    batch = []
+    for number, record in enumerate(records, start=1):
+        try:
+            batch.append(convert(record))
+        except RejectedRecord as error:
+            stats['rejected'] += 1
+            if stats['rejected'] <= LOGGED_REJECTS:
+                logger.warning("Skipping record %d: %s", number, error)
+            continue
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Upsert the rows of every batch, committing every COMMIT_ROWS rows. Returns the number of rows written.
+def _load(conn, batches, upsert, label, on_batch=None):
+    started = time.perf_counter()
+    written = uncommitted = 0
+    for batch in batches:
+        conn.executemany(upsert, batch)
+        if on_batch is not None:
+            on_batch(batch)
+        written += len(batch)
+        uncommitted += len(batch)
+        if uncommitted >= COMMIT_ROWS:
+            conn.commit()
+            uncommitted = 0
+            logger.info("%s: %d rows (%.0f rows/s)", label, written, written / (time.perf_counter() - started))
+    conn.commit()
+    return written
+
+
+# Drop the secondary indexes of company and financials; returns their CREATE statements
+def _defer_indexes(conn):
+    indexes = conn.execute("""
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND tbl_name IN ('company', 'financials') AND sql IS NOT NULL
+    """).fetchall()
+    statements = []
+    for name, sql in indexes:
+        if name not in KEPT_INDEXES:
+            conn.execute(f"DROP INDEX {name}")
+            statements.append(sql)
+    return statements
+
+
+# Delete the rows of DEDUPE_STATEMENTS; returns the number of rows deleted
+def remove_duplicates(conn):
+    removed = 0
+    for statement in DEDUPE_STATEMENTS:
+        removed += conn.execute(statement).rowcount
+    if removed:
+        logger.warning("Removed %d duplicated rows", removed)
+    return removed
+
+
+# Load the given files into the database at db_path and bring the derived columns, the indexes and the
+# sector/year rollup up to date. dedupe removes duplicated keys before the migrations run, backfill
+# recomputes the derived columns of every row. Returns a dict of counts and timings.
+def ingest(db_path, companies=None, financials=None, batch_size=INGEST_BATCH_SIZE, defer_indexes=True,
+           dedupe=False, backfill=False):
+    started = time.perf_counter()
+    stats = {'companies': 0, 'financials': 0, 'rejected': 0}
+    if not os.path.exists(db_path):
+        raise FileNotFoundError(f"Database file {db_path} does not exist")
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{INGEST_CACHE_SIZE_KIB}")
+        if dedupe:
+            stats['duplicates'] = remove_duplicates(conn)
+            conn.commit()
+        # The unique (cvr, year) key and the derived columns come with the migrations
+        migrate(conn)
+        conn.commit()
+
+        # Every inserted row would otherwise fire a rollup trigger; the rollup is rebuilt once at the end
+        for name in TRIGGERS:
+            conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        deferred = _defer_indexes(conn) if defer_indexes else []
+        if financials:
+            conn.execute(CREATE_TOUCHED_TABLE)
+        conn.commit()
+
+        try:
+            try:
+                if companies:
+                    stats['companies'] = _load(conn, _batches(read_records(companies), company_row, batch_size, stats),
+                                               UPSERT_COMPANY, 'companies')
+                if financials:
+                    def remember_cvrs(batch):
+                        conn.executemany(f"INSERT OR IGNORE INTO {TOUCHED_TABLE} (cvr) VALUES (?)",
+                                         ((cvr,) for cvr in {row[0] for row in batch}))
+
+                    stats['financials'] = _load(conn, _batches(read_records(financials), financial_row, batch_size,
+                                                                stats), UPSERT_FINANCIALS, 'financials', remember_cvrs)
+                    stats['load_seconds'] = time.perf_counter() - started
+            except BaseException:
+                # Discard the uncommitted rows of the failed batch; the batches committed before it stay
+                # loaded and still get their growth, indexes and rollup below
+                conn.rollback()
+                raise
+            finally:
+                step = time.perf_counter()
+                if backfill or derived_columns_pending(conn):
+                    # Rows from before migration 4 have no derived columns yet; fill in every row at once
+                    backfill_derived_columns(conn)
+                    conn.commit()
+                    stats['backfill_seconds'] = time.perf_counter() - step
+                elif financials:
+                    # Growth depends on the previous year, which may come from this load or from earlier data,
+                    # so it is recomputed over the full history of every company that was written to
+                    conn.execute(TOUCHED_GROWTH_UPDATE)
+                    conn.commit()
+                    stats['growth_seconds'] = time.perf_counter() - step
+                conn.execute(f"DROP TABLE IF EXISTS {TOUCHED_TABLE}")
+        finally:
+            # Rebuild what was dropped even when the load failed halfway, so the database stays usable
+            step = time.perf_counter()
+            for statement in deferred:
+                conn.execute(statement)
+            conn.execute("ANALYZE")
+            create_rollup_schema(conn)
+            # The full refresh also bumps the data version, so the application sees everything loaded
+            refresh_sector_year_rollup(conn, full=True)
+            conn.commit()
+            stats['index_seconds'] = time.perf_counter() - step
+    finally:
+        conn.close()
+    stats['seconds'] = time.perf_counter() - started
+    logger.info("Ingested %d companies and %d financials rows (%d rejected) in %.1f s",
+                stats['companies'], stats['financials'], stats['rejected'], stats['seconds'])
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load company and financial records from CSV/JSONL files.")
+    parser.add_argument('--db', default=DB_PATH, help="database file to load into (default: the application database)")
+    parser.add_argument('--companies', help="company records (.csv, .jsonl or .ndjson, optionally .gz)")
+    parser.add_argument('--financials', help="financial records, one per company and year (same formats)")
+    parser.add_argument('--batch-size', type=int, default=INGEST_BATCH_SIZE,
+                        help="records per executemany batch (default %(default)s)")
+    parser.add_argument('--keep-indexes', action='store_true',
+                        help="keep the secondary indexes during the load (faster for small updates)")
+    parser.add_argument('--dedupe', action='store_true',
+                        help="remove duplicated companies and company-years (keeping the last inserted) before migrating")
+    parser.add_argument('--backfill', action='store_true',
+                        help="recompute the derived columns of every financials row")
+    args = parser.parse_args(argv)
+    if not (args.companies or args.financials or args.dedupe or args.backfill):
+        parser.error("nothing to do; pass --companies, --financials, --dedupe and/or --backfill")
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    stats = ingest(args.db, args.companies, args.financials, args.batch_size, not args.keep_indexes,
+                   args.dedupe, args.backfill)
+    print(json.dumps(stats, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+import pandas as pd
+import streamlit as st
+from loader import frame_memory
+
+# Usernames allowed to see the timing panel, comma-separated in CVR_ADMIN_USERS
+ADMIN_USERS = {name.strip() for name in os.environ.get('CVR_ADMIN_USERS', '').split(',') if name.strip()}
+# JSONL file receiving one line per dashboard rerun; rotated at TIMING_LOG_MAX_BYTES
+TIMING_LOG_PATH = os.environ.get('CVR_TIMING_LOG', os.path.join(os.path.dirname(__file__), 'logs', 'timings.jsonl'))
+TIMING_LOG_MAX_BYTES = 5 * 1024 * 1024
+TIMING_LOG_BACKUPS = 5
+
+# The rerun being recorded on the current script thread, if any
+_current = threading.local()
+
+# Process-wide totals per instrumented stage: name -> [calls, total seconds, max seconds]
+_totals = {}
+_totals_lock = threading.Lock()
+
+_timing_log = None
+_timing_log_lock = threading.Lock()
+
+
+# Logger writing to the rotating JSONL file, created on first use
+def _get_timing_log():
+    global _timing_log
+    with _timing_log_lock:
+        if _timing_log is None:
+            os.makedirs(os.path.dirname(TIMING_LOG_PATH), exist_ok=True)
+            handler = RotatingFileHandler(TIMING_LOG_PATH, maxBytes=TIMING_LOG_MAX_BYTES,
+                                          backupCount=TIMING_LOG_BACKUPS, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            _timing_log = logging.getLogger('cvr.timings')
+            _timing_log.setLevel(logging.INFO)
+            _timing_log.propagate = False
+            _timing_log.addHandler(handler)
+    return _timing_log
+
+
+# Rows and memory of a stage's result: frames and row lists are measured, other results are not.
+# Runs on every call, cache hits included, so frames get the shallow count: walking the strings
+# of object columns would cost more than many of the stages being timed.
+def _measure(result):
+    if isinstance(result, pd.DataFrame):
+        return {'rows': len(result), 'bytes': frame_memory(result, deep=False)}
+    if isinstance(result, list):
+        return {'rows': len(result)}
+    return {}
+
+
+def _add_to_totals(name, seconds):
+    with _totals_lock:
+        totals = _totals.setdefault(name, [0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] = max(totals[2], seconds)
+
+
+# Time a block as one stage of the current rerun; yields the event so the block can add fields.
+# Stages started inside the block are recorded as its children.
+@contextmanager
+def stage(name):
+    rerun = getattr(_current, 'rerun', None)
+    event = {'name': name, 'depth': rerun['depth'] if rerun is not None else 0}
+    if rerun is not None:
+        # Appended up front so the events read in call order
+        rerun['events'].append(event)
+        rerun['depth'] += 1
+    started = time.perf_counter()
+    try:
+        yield event
+    finally:
+        seconds = time.perf_counter() - started
+        if rerun is not None:
+            rerun['depth'] -= 1
+        event['seconds'] = round(seconds, 6)
+        _add_to_totals(name, seconds)
+
+
+# Decorator recording the wall time, rows and shallow frame memory of every call
+def instrumented(func):
+    name = f"{func.__module__}.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(name) as event:
+            result = func(*args, **kwargs)
+            event.update(_measure(result))
+        return result
+    return wrapper
+
+
+# Record everything instrumented during one dashboard rerun and append it to the JSONL log
+@contextmanager
+def instrumented_rerun(username=None):
+    rerun = {'started_at': time.time(), 'user': username, 'view': None, 'depth': 0, 'events': []}
+    _current.rerun = rerun
+    started = time.perf_counter()
+    try:
+        yield rerun
+    finally:
+        _current.rerun = None
+        rerun['seconds'] = round(time.perf_counter() - started, 6)
+        del rerun['depth']
+        st.session_state['last_rerun_timings'] = rerun
+        try:
+            _get_timing_log().info(json.dumps(rerun, default=str))
+        except OSError:
+            # Timing must never break the dashboard, e.g. on a read-only file system
+            pass
+
+
+# Name the view being rendered by the current rerun
+def set_rerun_view(view):
+    rerun = getattr(_current, 'rerun', None)
+    if rerun is not None:
+        rerun['view'] = view
+
+
+def is_admin(username):
+    return username in ADMIN_USERS
+
+
+def timing_totals():
+    with _totals_lock:
+        return {name: {'calls': calls, 'seconds_total': total, 'seconds_max': worst,
+                       'seconds_avg': total / calls if calls else 0.0}
+                for name, (calls, total, worst) in _totals.items()}
+
+
+# Sidebar panel for admins: the stages of the last rerun and the process-wide totals
+def render_timing_panel(extra_stats=None):
+    rerun = st.session_state.get('last_rerun_timings')
+    with st.sidebar.expander("Timings (admin)"):
+        if rerun:
+            st.caption(f"Last rerun: {rerun['view']} in {rerun['seconds'] * 1000:.1f} ms")
+            events = pd.DataFrame(rerun['events'])
+            if not events.empty:
+                events['name'] = ['  ' * depth + name for depth, name in zip(events['depth'], events['name'])]
+                st.dataframe(events.drop(columns=['depth']), hide_index=True)
+        totals = pd.DataFrame.from_dict(timing_totals(), orient='index')
+        if not totals.empty:
+            st.caption("Since server start")
+            st.dataframe(totals.sort_values('seconds_total', ascending=False))
+        for title, stats in (extra_stats or {}).items():
+            st.caption(title)
+            st.json(stats, expanded=False)
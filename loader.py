@@ -0,0 +1,109 @@
+import logging
+import time
+from contextlib import nullcontext
+import numpy as np
+import pandas as pd
+from pool import read_connection
+from utils import sector_attributes
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per chunk when a query is read in chunks
+LOAD_CHUNKSIZE = 100_000
+
+# Categorical dtype for sector display names; the category order follows utils.sector_attributes
+SECTOR_DTYPE = pd.CategoricalDtype(list(sector_attributes.values()))
+
+# Sector codes as a categorical whose categories are renamed to display names in one step
+_SECTOR_CODE_DTYPE = pd.CategoricalDtype(list(sector_attributes.keys()))
+
+# Compact dtypes for the financials/company columns used by the views. Ratios fit comfortably in
+# float32; amounts in DKK stay float64 so large values keep their precision.
+COLUMN_DTYPES = {
+    'cvr': 'int32',
+    'cvr_number': 'int32',
+    'year': 'int16',
+    'company_name': 'category',
+    'name': 'category',
+    'industry_sector': SECTOR_DTYPE,
+    'solvency_ratio': 'float32',
+    'return_on_assets': 'float32',
+    'return_on_investment': 'float32',
+    'current_ratio': 'float32',
+    'profit_margin': 'float32',
+    'operating_margin': 'float32',
+    'expense_ratio': 'float32',
+    'equity_growth': 'float32',
+    'assets_growth': 'float32',
+    'avg_solvency_ratio': 'float32',
+    'avg_return_on_assets': 'float32',
+    'avg_return_on_investment': 'float32',
+    'avg_current_ratio': 'float32',
+}
+
+# Nullable counterparts used when an integer column contains NULLs
+_NULLABLE_INTEGERS = {'int16': 'Int16', 'int32': 'Int32', 'int64': 'Int64'}
+
+
+# Map sector codes to display names through a categorical: one hash lookup per distinct code
+# instead of a per-value dictionary replace. Codes outside utils.sector_attributes become NaN.
+def sector_names(codes):
+    categorical = codes.astype(_SECTOR_CODE_DTYPE)
+    return categorical.cat.rename_categories(list(sector_attributes.values()))
+
+
+# Convert the columns of df that appear in dtypes to their compact dtype, in place
+def apply_dtypes(df, dtypes=COLUMN_DTYPES):
+    for column, dtype in dtypes.items():
+        if column not in df or df[column].dtype == dtype:
+            continue
+        if dtype is SECTOR_DTYPE:
+            df[column] = sector_names(df[column])
+        elif dtype in _NULLABLE_INTEGERS and df[column].isna().any():
+            df[column] = df[column].astype(_NULLABLE_INTEGERS[dtype])
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+# Concatenate converted chunks (or partitions). Categoricals whose categories differ per chunk
+# (company names) are first given the union of all categories so the result stays categorical.
+def concat_frames(chunks):
+    if len(chunks) == 1:
+        return chunks[0]
+    for column in chunks[0].columns:
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype) and chunks[0][column].dtype != SECTOR_DTYPE:
+            categories = pd.Index(np.concatenate([chunk[column].cat.categories for chunk in chunks])).unique()
+            for chunk in chunks:
+                chunk[column] = chunk[column].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+# Bytes held by a frame, counting the contents of object columns unless deep is off.
+# The shallow count only sizes the column buffers and costs nothing even on large frames.
+def frame_memory(df, deep=True):
+    return int(df.memory_usage(deep=deep, index=True).sum())
+
+
+# Bytes per column, largest first
+def memory_report(df):
+    return df.memory_usage(deep=True, index=False).sort_values(ascending=False).to_dict()
+
+
+# Run a query on a pooled read-only connection and return a frame with compact dtypes.
+# With chunksize set, rows are fetched and converted chunk by chunk, so the wide object and
+# float64 columns of only one chunk are alive at a time. Processes without the pool (rebuild
+# workers) pass their own connection.
+def load_frame(query, params=(), dtypes=COLUMN_DTYPES, chunksize=None, conn=None):
+    started = time.perf_counter()
+    with read_connection() if conn is None else nullcontext(conn) as conn:
+        if chunksize:
+            chunks = [apply_dtypes(chunk, dtypes)
+                      for chunk in pd.read_sql_query(query, conn, params=params, chunksize=chunksize)]
+            df = concat_frames(chunks) if chunks else apply_dtypes(
+                pd.read_sql_query(query, conn, params=params), dtypes)
+        else:
+            df = apply_dtypes(pd.read_sql_query(query, conn, params=params), dtypes)
+    logger.debug("Loaded %d rows x %d columns (%.1f MiB) in %.3f s", len(df), len(df.columns),
+                 frame_memory(df) / 2**20, time.perf_counter() - started)
+    return df
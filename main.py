@@ -1,7 +1,10 @@
+import pandas as pd
 import streamlit as st  
 from auth import run_auth_page 
 from dashboard import run_dashboard 
 from styles import apply_custom_css
+from bootstrap import bootstrap
+from auth_service import session_user
 
 def show_landing_page():
     apply_custom_css()
@@ -45,7 +48,13 @@ def show_landing_page():
         if st.button("Begin Exploration"):
             st.session_state['page'] = 'auth'
 def main():
+    # The analytics store frames are shared by every session; with copy-on-write, a view modifying a
+    # selection of them copies it instead of writing through to the shared data (see store.py)
+    pd.set_option('mode.copy_on_write', True)
     apply_custom_css()
+    # Set up the schema, discover the metadata and start loading the shared analytics frames;
+    # only the first run of the process does the work, later reruns reuse the cached metadata
+    bootstrap()
     # Initialize session state variables if they are not already set
     if 'logged_in' not in st.session_state:
         st.session_state.logged_in = False 
@@ -53,6 +62,12 @@ def main():
         st.session_state.page = 'landing'
     if 'show_login' not in st.session_state:
         st.session_state.show_login = True  
+    # A logged-in session stays logged in while its verified-session token is valid, which each rerun
+    # extends; no password is re-checked
+    if st.session_state.logged_in and session_user(st.session_state.get('auth_token')) != st.session_state.get('username'):
+        st.session_state.logged_in = False
+        st.session_state.show_login = True
+        st.session_state.page = 'auth'
 
     # Determine which page to display based on the session state
     if st.session_state.page == 'landing':
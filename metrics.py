@@ -1,131 +1,356 @@
+import logging
+import os
 import pandas as pd
-import streamlit as st
 from utils import sector_attributes
-from db import get_db_connection
+from cache import cached_query
+from db import YEAR_RANGE_QUERY
+from rollup import ensure_sector_year_rollup
+from charts import company_trend_figure, drop_unused_categories, prepare_figure, show_figure
+from loader import LOAD_CHUNKSIZE, apply_dtypes, load_frame
+from pool import read_connection
+from instrumentation import instrumented
+from snapshot import read_snapshot, snapshot_is_fresh
+from store import store_frame
 import plotly.express as px
 
-# @st.cache_data(suppress_st_warning=True) 
-def sector_performance_overview():
-    # Establish a connection to the database
-    conn = get_db_connection()
-    # Create a cursor object to execute SQL queries
-    cursor = conn.cursor()
-    # SQL query to select data from the 'financials' table
-    query = """
-        SELECT c.industry_sector, f.year, AVG(f.gross_profit_loss) AS avg_gross_profit_loss, 
-               AVG(f.equity) AS avg_equity, AVG(f.assets) AS avg_assets
-        FROM financials f
-        JOIN company c ON f.cvr = c.cvr_number
-        GROUP BY c.industry_sector, f.year
-        ORDER BY c.industry_sector, f.year;
-        """
-
-    df_sector_performance = pd.read_sql_query(query, conn)
-
-    # Map sector codes to names
-    df_sector_performance['industry_sector'] = df_sector_performance['industry_sector'].replace(sector_attributes)
-
-    fig = px.line(df_sector_performance, x='year', y='avg_equity', color='industry_sector',
-              title='Average Equity by Sector Over Time')
-    
-    fig.update_layout(width=1200)
-    st.plotly_chart(fig)
-
-
-# @st.cache_data(suppress_st_warning=True) 
-def financial_health_dashboard(metric):
-    # Establish a connection to the database
-    conn = get_db_connection()
-    
-    # SQL query to fetch financial health indicators
-    query = """
-    SELECT c.industry_sector, f.year,
-           AVG(f.solvency_ratio) AS avg_solvency_ratio,
-           AVG(f.return_on_assets) AS avg_return_on_assets,
-           AVG(f.return_on_investment) AS avg_return_on_investment,
-           AVG(f.current_ratio) AS avg_current_ratio
+logger = logging.getLogger(__name__)
+
+# Where the data functions read from: 'store' (the process-wide frames shared by every session,
+# default), 'sqlite' (the database) or 'snapshot' (the memory-mapped Arrow dataset written by
+# snapshot.py). Set with the CVR_METRICS_BACKEND environment variable or per call; a missing or
+# stale snapshot falls back to sqlite.
+METRICS_BACKEND = os.environ.get('CVR_METRICS_BACKEND', 'store')
+BACKENDS = ('store', 'sqlite', 'snapshot')
+
+# Year window condition of the queries reading company-years from 'financials'. A window covering
+# every year in the database drops it (see windowed_query), so the whole table is read in the order
+# the query needs instead of through the year index with a row lookup per company-year.
+YEAR_CONDITION = "f.year BETWEEN ? AND ?"
+
+# SQL queries used by the data functions below; kept at module level so check_query_plans.py can inspect them
+# Average gross profit, equity and assets per sector and year, read from the sector/year rollup
+SECTOR_PERFORMANCE_QUERY = """
+    SELECT industry_sector, year, avg_gross_profit_loss, avg_equity, avg_assets
+    FROM sector_year_rollup
+    WHERE year BETWEEN ? AND ?
+    ORDER BY industry_sector, year;
+"""
+
+# Same averages aggregated directly from 'financials' when the rollup is unavailable
+SECTOR_PERFORMANCE_FALLBACK_QUERY = f"""
+    SELECT c.industry_sector, f.year, AVG(f.gross_profit_loss) AS avg_gross_profit_loss, 
+           AVG(f.equity) AS avg_equity, AVG(f.assets) AS avg_assets
+    FROM financials f
+    JOIN company c ON f.cvr = c.cvr_number
+    WHERE {YEAR_CONDITION}
+    GROUP BY c.industry_sector, f.year
+    ORDER BY c.industry_sector, f.year;
+"""
+
+# Financial health metrics, keyed by the rollup column holding the sector average.
+# Each metric declares the raw 'financials' column it averages, its sidebar label and its chart title,
+# so only the selected metric is queried, converted and drawn.
+FINANCIAL_HEALTH_METRICS = {
+    'avg_solvency_ratio': {
+        'column': 'solvency_ratio',
+        'label': 'Average Solvency Ratio by Sector Over Time',
+        'title': 'Average Solvency Ratio by Sector Over Time',
+    },
+    'avg_return_on_assets': {
+        'column': 'return_on_assets',
+        'label': 'Average ROA by Sector Over Time',
+        'title': 'Average Return on Assets by Sector Over Time',
+    },
+    'avg_return_on_investment': {
+        'column': 'return_on_investment',
+        'label': 'Average ROI by Sector Over Time',
+        'title': 'Average Return on Investment by Sector Over Time',
+    },
+    'avg_current_ratio': {
+        'column': 'current_ratio',
+        'label': 'Average Current Ratio by Sector Over Time',
+        'title': 'Average Current Ratio by Sector Over Time',
+    },
+}
+
+# Year window covering every year in the database
+ALL_YEARS = (0, 9999)
+
+
+# A query reading company-years of every year: the year window condition is always true
+def all_years_query(query):
+    return query.replace(YEAR_CONDITION, 'TRUE')
+
+
+# True when year_range includes every year with financials in the database
+def covers_all_years(year_range):
+    if tuple(year_range) == ALL_YEARS:
+        return True
+    # MIN and MAX are single lookups on idx_financials_year
+    with read_connection() as conn:
+        min_year, max_year = conn.execute(YEAR_RANGE_QUERY).fetchone()
+    return min_year is None or (year_range[0] <= min_year and max_year <= year_range[1])
+
+
+# The query and its year window parameters for year_range; without the window condition when the
+# window covers every year
+def windowed_query(query, year_range):
+    if YEAR_CONDITION in query and covers_all_years(year_range):
+        return all_years_query(query), ()
+    return query, tuple(year_range)
+
+
+# SQL query for one financial health metric; the metric name comes from the registry above,
+# never from user input. The fallback aggregates 'financials' directly when the rollup is unavailable.
+def financial_health_query(metric, fallback=False):
+    if fallback:
+        column = FINANCIAL_HEALTH_METRICS[metric]['column']
+        return f"""
+    SELECT c.industry_sector, f.year, AVG(f.{column}) AS {metric}
     FROM financials f
     JOIN company c ON f.cvr = c.cvr_number
+    WHERE {YEAR_CONDITION}
     GROUP BY c.industry_sector, f.year
     ORDER BY c.industry_sector, f.year;
-    """
+"""
+    return f"""
+    SELECT industry_sector, year, {metric}
+    FROM sector_year_rollup
+    WHERE year BETWEEN ? AND ?
+    ORDER BY industry_sector, year;
+"""
+
+# Profitability, returns, equity and assets with their stored year-over-year growth for each company
+# within a year window, in (cvr, year) order
+COMPANY_GROWTH_QUERY = f"""
+    SELECT f.cvr, c.name AS company_name, c.industry_sector, f.year,
+           f.profit_margin, f.return_on_investment, f.equity, f.assets, f.equity_growth, f.assets_growth
+    FROM financials f
+    JOIN company c ON f.cvr = c.cvr_number
+    WHERE {YEAR_CONDITION}
+    ORDER BY f.cvr, f.year;
+"""
+
+# Default thresholds for the investment screen; every one is a strict lower bound
+INVESTMENT_THRESHOLDS = {
+    'min_profit_margin': 0.0,
+    'min_return_on_investment': 0.0,
+    'min_equity_growth': 0.0,
+    'min_assets_growth': 0.0,
+}
+
+# Company-years within a year window passing the investment screen; used by the sqlite backend only,
+# the store and snapshot backends screen their own company-year frame. Growth is stored on every row
+# (see schema.GROWTH_UPDATE) and the thresholds are bound parameters, so only qualifying rows are returned.
+INVESTMENT_OPPORTUNITIES_QUERY = f"""
+    SELECT f.cvr, c.name AS company_name, c.industry_sector, f.year,
+           f.profit_margin, f.return_on_investment, f.equity, f.assets,
+           f.equity_growth, f.assets_growth
+    FROM financials f
+    JOIN company c ON f.cvr = c.cvr_number
+    WHERE {YEAR_CONDITION}
+      AND f.profit_margin > ?
+      AND f.return_on_investment > ?
+      AND f.equity_growth > ?
+      AND f.assets_growth > ?
+    ORDER BY f.cvr, f.year;
+"""
+
+# Revenue, expenses and operating profit with the stored efficiency ratios for each company within a year window
+OPERATIONAL_EFFICIENCY_QUERY = f"""
+    SELECT f.cvr, c.name AS company_name, c.industry_sector, f.year,
+           f.revenue, f.external_expenses, f.employee_expense, 
+           f.profit_loss_from_ordinary_operating_activities, f.operating_margin, f.expense_ratio
+    FROM financials f
+    JOIN company c ON f.cvr = c.cvr_number
+    WHERE {YEAR_CONDITION}
+    ORDER BY c.name, f.year;
+"""
 
-    # Execute the query and load the data into a DataFrame
-    df_financial_health = pd.read_sql_query(query, conn)
+# Liquidity and solvency data for each company within a year window
+LIQUIDITY_AND_SOLVENCY_QUERY = f"""
+    SELECT f.cvr, c.name AS company_name, c.industry_sector, f.year,
+           f.current_ratio, f.solvency_ratio, f.cash_and_cash_equivalents
+    FROM financials f
+    JOIN company c ON f.cvr = c.cvr_number
+    WHERE {YEAR_CONDITION}
+    ORDER BY c.name, f.year;
+"""
 
-    # Map sector codes to names using the previously defined `sector_attributes`
-    df_financial_health['industry_sector'] = df_financial_health['industry_sector'].replace(sector_attributes)
 
-    # Ensure correct data types
-    df_financial_health['year'] = pd.to_datetime(df_financial_health['year'], format='%Y')
+# Backend a data function reads from for the requested backend (None for the default)
+def resolve_backend(backend=None):
+    backend = backend or METRICS_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown metrics backend {backend!r}; expected one of {BACKENDS}")
+    if backend == 'snapshot' and not snapshot_is_fresh():
+        logger.warning("Snapshot is missing or older than the database; reading from sqlite instead")
+        return 'sqlite'
+    return backend
+
+
+# Rows of df inside the year window; a plain selection when every row is inside
+def _in_window(df, year_range):
+    in_window = df['year'].between(*year_range)
+    if in_window.all():
+        return df
+    return df[in_window].reset_index(drop=True)
+
 
-    # Create the dashboard visualizations
-    create_financial_health_charts(df_financial_health, metric)
+# Columns of the shared company-year frame within a year window. The full window selects
+# columns only, which shares memory with the store; narrower windows copy just their rows.
+def _store_company_years(columns, year_range=ALL_YEARS):
+    return _in_window(store_frame('company_years')[columns], year_range)
 
 
+# Average of the given columns per sector and year, computed from the snapshot.
+# Rows without a sector are left out, as in the rollup.
+def _snapshot_sector_averages(columns, year_range=None):
+    df = read_snapshot(['industry_sector', 'year', *columns], year_range=year_range)
+    averages = df.groupby(['industry_sector', 'year'], observed=True, sort=True)[list(columns)].mean()
+    return apply_dtypes(averages.add_prefix('avg_').reset_index())
 
-def create_financial_health_charts(df, metric):
-    # Solvency Ratio
-    fig_solvency = px.line(df, x='year', y='avg_solvency_ratio', color='industry_sector',
-                           title='Average Solvency Ratio by Sector Over Time')
-    fig_solvency.update_layout(width=1200, height=600)
 
-    # Return on Assets
-    fig_roa = px.line(df, x='year', y='avg_return_on_assets', color='industry_sector',
-                      title='Average Return on Assets by Sector Over Time')
-    fig_roa.update_layout(width=1200, height=600)
+# Load the average gross profit, equity and assets per sector and year within a year window
+@instrumented
+@cached_query
+def fetch_sector_performance_data(year_range=ALL_YEARS, backend=None):
+    source = resolve_backend(backend)
+    if source == 'store':
+        return _in_window(store_frame('sector_years')[['industry_sector', 'year', 'avg_gross_profit_loss',
+                                                       'avg_equity', 'avg_assets']], year_range)
+    if source == 'snapshot':
+        return _snapshot_sector_averages(['gross_profit_loss', 'equity', 'assets'], year_range)
 
-    # Return on Investment
-    fig_roi = px.line(df, x='year', y='avg_return_on_investment', color='industry_sector',
-                      title='Average Return on Investment by Sector Over Time')
-    fig_roi.update_layout(width=1200, height=600)
+    # Read the precomputed averages from the sector/year rollup when it is available
+    query = SECTOR_PERFORMANCE_QUERY
+    if not ensure_sector_year_rollup():
+        # Fall back to aggregating the 'financials' table directly
+        query = SECTOR_PERFORMANCE_FALLBACK_QUERY
 
-    # Current Ratio
-    fig_current_ratio = px.line(df, x='year', y='avg_current_ratio', color='industry_sector',
-                                title='Average Current Ratio by Sector Over Time')
-    fig_current_ratio.update_layout(width=1200, height=600)
+    # Run the query on a pooled read-only connection; the loader maps sector codes to names
+    query, params = windowed_query(query, year_range)
+    df_sector_performance = load_frame(query, params=params)
 
-    # Use Streamlit to layout the charts on the page
-    if metric == 'avg_solvency_ratio':
-        st.plotly_chart(fig_solvency)
-    elif metric == 'avg_return_on_assets':
-        st.plotly_chart(fig_roa)
-    elif metric == 'avg_return_on_investment':
-        st.plotly_chart(fig_roi)
-    elif metric == 'avg_current_ratio':
-        st.plotly_chart(fig_current_ratio)
+    return df_sector_performance
 
 
-def investment_opportunity_identification():
-    # Establish a connection to the database
-    conn = get_db_connection()
+# Build the average equity by sector chart
+def create_sector_performance_chart(df):
+    fig = px.line(df, x='year', y='avg_equity', color='industry_sector',
+              title='Average Equity by Sector Over Time')
     
-    # SQL query to fetch necessary financial data for each company over the years
-    query = """
-    SELECT c.name AS company_name, c.industry_sector, f.year,
-           f.profit_margin, f.return_on_investment, f.equity, f.assets
-    FROM financials f
-    JOIN company c ON f.cvr = c.cvr_number
-    ORDER BY c.name, f.year;
-    """
+    fig.update_layout(width=1200)
+    return fig
 
-    # Execute the query and load the data into a DataFrame
-    df_investment_opportunities = pd.read_sql_query(query, conn)
 
-    # Map sector codes to names using the `sector_attributes` defined earlier
-    df_investment_opportunities['industry_sector'] = df_investment_opportunities['industry_sector'].replace(sector_attributes)
+@instrumented
+def sector_performance_overview(year_range=ALL_YEARS):
+    # Load the (cached) sector averages for the selected years
+    df_sector_performance = fetch_sector_performance_data(tuple(year_range))
 
-    # Calculate year-over-year growth for equity and assets
-    df_investment_opportunities['equity_growth'] = df_investment_opportunities.groupby('company_name')['equity'].pct_change()
-    df_investment_opportunities['assets_growth'] = df_investment_opportunities.groupby('company_name')['assets'].pct_change()
+    show_figure(create_sector_performance_chart(df_sector_performance))
 
-    # Filter companies showing consistent increase in metrics (customize the threshold as needed)
-    df_filtered = df_investment_opportunities[
-        (df_investment_opportunities['profit_margin'] > 0) &
-        (df_investment_opportunities['return_on_investment'] > 0) &
-        (df_investment_opportunities['equity_growth'] > 0) &
-        (df_investment_opportunities['assets_growth'] > 0)
-    ]
+
+# Load the sector averages of a single financial health metric within a year window
+@instrumented
+@cached_query
+def fetch_financial_health_data(metric, year_range=ALL_YEARS, backend=None):
+    source = resolve_backend(backend)
+    if source == 'store':
+        # Copied because the year column is converted below
+        df_financial_health = _in_window(store_frame('sector_years')[['industry_sector', 'year', metric]],
+                                         year_range).copy()
+    elif source == 'snapshot':
+        # Average the metric's raw column over the partitions inside the year window
+        df_financial_health = _snapshot_sector_averages([FINANCIAL_HEALTH_METRICS[metric]['column']], year_range)
+    else:
+        # Read the precomputed average from the sector/year rollup when it is available
+        query, params = windowed_query(financial_health_query(metric, fallback=not ensure_sector_year_rollup()),
+                                       year_range)
+
+        # Execute the query on a pooled read-only connection and load the data into a compact DataFrame
+        df_financial_health = load_frame(query, params=params)
+
+    # Ensure correct data types
+    df_financial_health['year'] = pd.to_datetime(df_financial_health['year'], format='%Y')
+
+    return df_financial_health
+
+
+# Build the chart for a single financial health metric
+def create_financial_health_chart(df, metric):
+    fig = px.line(df, x='year', y=metric, color='industry_sector',
+                  title=FINANCIAL_HEALTH_METRICS[metric]['title'])
+    fig.update_layout(width=1200, height=600)
+    return fig
+
+
+# Build (and prepare for display) the chart for one metric and year window; cached per metric and window
+@instrumented
+@cached_query
+def build_financial_health_figure(metric, year_range=ALL_YEARS):
+    return prepare_figure(create_financial_health_chart(fetch_financial_health_data(metric, year_range), metric))
+
+
+@instrumented
+def financial_health_dashboard(metric, year_range=ALL_YEARS):
+    # Only the selected metric is queried and drawn; the prepared figure comes from the cache when possible
+    fig, info = build_financial_health_figure(metric, tuple(year_range))
+    show_figure(fig, info=info)
+
+
+# Load every company-year within a year window with year-over-year equity and assets growth for the
+# company comparison view. Cached, so growth is computed once per window and database version.
+@instrumented
+@cached_query
+def fetch_company_growth_data(year_range=ALL_YEARS, backend=None):
+    source = resolve_backend(backend)
+    if source == 'store':
+        # Growth is already part of the shared frame
+        return _store_company_years(['cvr', 'company_name', 'industry_sector', 'year', 'profit_margin',
+                                     'return_on_investment', 'equity', 'assets', 'equity_growth', 'assets_growth'],
+                                    year_range)
+    if source == 'sqlite':
+        # Growth is stored on the rows; load the window in chunks with compact dtypes (categorical sector and company names)
+        query, params = windowed_query(COMPANY_GROWTH_QUERY, year_range)
+        return load_frame(query, params=params, chunksize=LOAD_CHUNKSIZE)
+
+    # Read only the needed columns and year partitions from the memory-mapped snapshot, in (cvr, year) order.
+    # Growth is the stored growth exported with the rows, so it matches the sqlite backend even across
+    # gaps in a company's years and at the start of the window.
+    df_company_growth = read_snapshot(['cvr', 'company_name', 'industry_sector', 'year', 'profit_margin',
+                                       'return_on_investment', 'equity', 'assets', 'equity_growth', 'assets_growth'],
+                                      year_range=year_range)
+    return df_company_growth.sort_values(['cvr', 'year'], ignore_index=True)
+
+
+# Load the companies showing growth together with margins and returns above the given thresholds
+@instrumented
+@cached_query
+def fetch_investment_opportunities_data(min_profit_margin=0.0, min_return_on_investment=0.0,
+                                        min_equity_growth=0.0, min_assets_growth=0.0, year_range=ALL_YEARS,
+                                        backend=None):
+    source = resolve_backend(backend)
+    if source in ('store', 'snapshot'):
+        # Same screen as INVESTMENT_OPPORTUNITIES_QUERY, applied in pandas to the growth frame of the
+        # store or the snapshot; the whole window is loaded before it is filtered
+        df = fetch_company_growth_data(tuple(year_range), backend)
+        passes = ((df['profit_margin'] > min_profit_margin) & (df['return_on_investment'] > min_return_on_investment)
+                  & (df['equity_growth'] > min_equity_growth) & (df['assets_growth'] > min_assets_growth))
+        return df[passes].reset_index(drop=True)
+
+    # The screen runs in SQL on the stored growth, so only qualifying rows are loaded into a DataFrame
+    query, params = windowed_query(INVESTMENT_OPPORTUNITIES_QUERY, year_range)
+    params = (*params, min_profit_margin, min_return_on_investment, min_equity_growth, min_assets_growth)
+    return load_frame(query, params=params)
+
+
+@instrumented
+def investment_opportunity_identification(thresholds=None, year_range=ALL_YEARS):
+    # Load the (cached) investment candidates for the chosen thresholds and years
+    df_filtered = fetch_investment_opportunities_data(**(thresholds or INVESTMENT_THRESHOLDS),
+                                                      year_range=tuple(year_range))
 
     # Visualize the filtered data
     visualize_investment_opportunities(df_filtered)
@@ -136,40 +361,22 @@ def visualize_investment_opportunities(df):
     # Example: Scatter plot comparing Return on Investment and Profit Margin for the latest year available
     
     # Assuming 'df' is filtered to include only the latest year for each company
-    fig = px.scatter(df, x='return_on_investment', y='profit_margin', color='industry_sector',
+    fig = px.scatter(drop_unused_categories(df), x='return_on_investment', y='profit_margin', color='industry_sector',
                      hover_data=['company_name', 'equity_growth', 'assets_growth'],
                      title='Investment Opportunities: ROI vs. Profit Margin')
     fig.update_layout(width=800, height=600)
-    st.plotly_chart(fig)
-
-@st.cache_resource
-def company_level_comparison():
-    # Establish a connection to the database
-    conn = get_db_connection()
-    
-    # SQL query to fetch necessary financial data for each company over the years
-    query = """
-    SELECT c.name AS company_name, c.industry_sector, f.year,
-           f.profit_margin, f.return_on_investment, f.equity, f.assets
-    FROM financials f
-    JOIN company c ON f.cvr = c.cvr_number
-    ORDER BY c.name, f.year;
-    """
-
-    # Execute the query and load the data into a DataFrame
-    df_company_comparison = pd.read_sql_query(query, conn)
+    show_figure(fig)
 
-    # Map sector codes to names
-    df_company_comparison['industry_sector'] = df_company_comparison['industry_sector'].replace(sector_attributes)
-
-    # Calculate year-over-year growth for equity and assets
-    df_company_comparison['equity_growth'] = df_company_comparison.groupby('company_name')['equity'].pct_change()
-    df_company_comparison['assets_growth'] = df_company_comparison.groupby('company_name')['assets'].pct_change()
-
-    return df_company_comparison
+@instrumented
+def company_level_comparison(year_range=ALL_YEARS):
+    # Company-year rows with equity and assets growth within the selected years (cached)
+    return fetch_company_growth_data(tuple(year_range))
 
 
 def visualize_company_comparison(df):
+    # Work on a copy; the frame passed in may be shared through the query cache
+    df = df.copy()
+
     # Handle NaN values by filling with 0 or a small positive value
     df['equity_growth'] = df['equity_growth'].fillna(0)
     
@@ -191,89 +398,122 @@ def visualize_company_comparison(df):
     max_size = 100
     df['equity_growth_scaled'] = df['equity_growth_normalized'] * (max_size - min_size) + min_size
         
-    fig = px.scatter(df, x='return_on_investment', y='profit_margin', 
+    fig = px.scatter(drop_unused_categories(df), x='return_on_investment', y='profit_margin', 
                      size='equity_growth_scaled', color='company_name', 
                      hover_data=['company_name', 'equity_growth', 'assets_growth'],
                      title='Company-Level Comparison: ROI vs. Profit Margin with Equity Growth')
     fig.update_layout(width=1000, height=600)
-    st.plotly_chart(fig)
-
-
-def operational_efficiency_analysis():
-    # Establish a connection to the database
-    conn = get_db_connection()
-    
-    # SQL query to fetch necessary financial data
-    query = """
-    SELECT c.name AS company_name, f.year,
-           f.revenue, f.external_expenses, f.employee_expense, 
-           f.profit_loss_from_ordinary_operating_activities
-    FROM financials f
-    JOIN company c ON f.cvr = c.cvr_number
-    ORDER BY c.name, f.year;
-    """
-
-    # Execute the query and load the data into a DataFrame
-    df_efficiency = pd.read_sql_query(query, conn)
+    show_figure(fig)
+
+
+# Load revenue, expenses and operating profit per company and year within a year window with the
+# derived efficiency ratios
+@instrumented
+@cached_query
+def fetch_operational_efficiency_data(year_range=ALL_YEARS, backend=None):
+    source = resolve_backend(backend)
+    if source == 'store':
+        # The efficiency ratios are already part of the shared frame
+        return _store_company_years(['cvr', 'company_name', 'industry_sector', 'year', 'revenue',
+                                     'external_expenses', 'employee_expense',
+                                     'profit_loss_from_ordinary_operating_activities',
+                                     'operating_margin', 'expense_ratio'], year_range)
+    if source == 'snapshot':
+        # Read only the needed columns and year partitions from the memory-mapped snapshot, in (cvr, year) order
+        df_efficiency = read_snapshot(['cvr', 'company_name', 'industry_sector', 'year', 'revenue',
+                                       'external_expenses', 'employee_expense',
+                                       'profit_loss_from_ordinary_operating_activities'], year_range=year_range)
+        df_efficiency = df_efficiency.sort_values(['cvr', 'year'], ignore_index=True)
+    else:
+        # Load the company-years of the window with their stored ratios in chunks with compact dtypes
+        query, params = windowed_query(OPERATIONAL_EFFICIENCY_QUERY, year_range)
+        return load_frame(query, params=params, chunksize=LOAD_CHUNKSIZE)
 
     # Calculate operational efficiency metrics
     df_efficiency['operating_margin'] = df_efficiency['profit_loss_from_ordinary_operating_activities'] / df_efficiency['revenue']
     df_efficiency['expense_ratio'] = (df_efficiency['external_expenses'] + df_efficiency['employee_expense']) / df_efficiency['revenue']
 
+    # Store the derived ratios as float32 like the other ratio columns
+    return apply_dtypes(df_efficiency)
+
+
+# Rows of a company-level frame belonging to one sector (all rows when sector_code is None)
+def select_sector(df, sector_code):
+    if sector_code is None:
+        return df
+    return df[df['industry_sector'] == sector_attributes.get(sector_code)]
+
+
+@instrumented
+def operational_efficiency_analysis(sector_code=None, year_range=ALL_YEARS):
+    # Load the (cached) efficiency data for the selected years
+    df_efficiency = fetch_operational_efficiency_data(tuple(year_range))
+    # Restrict to the selected sector so the percentile bands describe that sector
+    df_efficiency = select_sector(df_efficiency, sector_code)
+
     # Visualization
     visualize_operational_efficiency(df_efficiency)
 
 
-def visualize_operational_efficiency(df):
-    # Operating Margin Over Time for Each Company
-    fig_margin = px.line(df, x='year', y='operating_margin', color='company_name', 
-                         title='Operating Margin Over Time by Company')
-    fig_margin.update_layout(width=1000, height=600)
-    st.plotly_chart(fig_margin)
-
-    # Expense Ratio Over Time for Each Company
-    fig_expense_ratio = px.line(df, x='year', y='expense_ratio', color='company_name', 
-                                title='Expense Ratio Over Time by Company')
-    fig_expense_ratio.update_layout(width=1000, height=600)
-    st.plotly_chart(fig_expense_ratio)
-
-
-def liquidity_and_solvency_trend_analysis():
-    # Establish a connection to the database
-    conn = get_db_connection()
-    
-    # SQL query to fetch liquidity and solvency data
-    query = """
-    SELECT c.name AS company_name, f.year,
-           f.current_ratio, f.solvency_ratio, f.cash_and_cash_equivalents
-    FROM financials f
-    JOIN company c ON f.cvr = c.cvr_number
-    ORDER BY c.name, f.year;
-    """
+# Build the operational efficiency charts. They switch to percentile bands plus the top companies
+# once there are too many companies to draw one line each.
+def create_operational_efficiency_charts(df):
+    return [
+        # Operating Margin Over Time for Each Company
+        company_trend_figure(df, 'operating_margin', 'Operating Margin Over Time by Company'),
+        # Expense Ratio Over Time for Each Company
+        company_trend_figure(df, 'expense_ratio', 'Expense Ratio Over Time by Company'),
+    ]
+
 
-    # Execute the query and load the data into a DataFrame
-    df_liquidity_solvency = pd.read_sql_query(query, conn)
+def visualize_operational_efficiency(df):
+    for fig in create_operational_efficiency_charts(df):
+        show_figure(fig)
+
+
+# Load current ratio, solvency ratio and cash per company and year within a year window
+@instrumented
+@cached_query
+def fetch_liquidity_and_solvency_data(year_range=ALL_YEARS, backend=None):
+    source = resolve_backend(backend)
+    if source == 'store':
+        return _store_company_years(['cvr', 'company_name', 'industry_sector', 'year', 'current_ratio',
+                                     'solvency_ratio', 'cash_and_cash_equivalents'], year_range)
+    if source == 'snapshot':
+        # Read only the needed columns and year partitions from the memory-mapped snapshot, in (cvr, year) order
+        df_liquidity_solvency = read_snapshot(['cvr', 'company_name', 'industry_sector', 'year', 'current_ratio',
+                                               'solvency_ratio', 'cash_and_cash_equivalents'], year_range=year_range)
+        return df_liquidity_solvency.sort_values(['cvr', 'year'], ignore_index=True)
+
+    # Load the company-years of the window in chunks with compact dtypes
+    query, params = windowed_query(LIQUIDITY_AND_SOLVENCY_QUERY, year_range)
+    df_liquidity_solvency = load_frame(query, params=params, chunksize=LOAD_CHUNKSIZE)
+
+    return df_liquidity_solvency
+
+
+@instrumented
+def liquidity_and_solvency_trend_analysis(sector_code=None, year_range=ALL_YEARS):
+    # Load the (cached) liquidity and solvency data for the selected years
+    df_liquidity_solvency = fetch_liquidity_and_solvency_data(tuple(year_range))
+    # Restrict to the selected sector so the percentile bands describe that sector
+    df_liquidity_solvency = select_sector(df_liquidity_solvency, sector_code)
 
     # Visualization
     visualize_liquidity_and_solvency(df_liquidity_solvency)
 
-    conn.close()
+# Build the liquidity and solvency charts. They switch to percentile bands plus the top companies
+# once there are too many companies to draw one line each.
+def create_liquidity_and_solvency_charts(df):
+    return [
+        # Current Ratio Over Time for Each Company
+        company_trend_figure(df, 'current_ratio', 'Current Ratio Over Time by Company'),
+        # Solvency Ratio Over Time for Each Company
+        company_trend_figure(df, 'solvency_ratio', 'Solvency Ratio Over Time by Company'),
+        # Cash and Cash Equivalents Over Time for Each Company
+        company_trend_figure(df, 'cash_and_cash_equivalents', 'Cash and Cash Equivalents Over Time by Company'),
+    ]
 
 def visualize_liquidity_and_solvency(df):
-    # Current Ratio Over Time for Each Company
-    fig_current_ratio = px.line(df, x='year', y='current_ratio', color='company_name', 
-                                title='Current Ratio Over Time by Company')
-    fig_current_ratio.update_layout(width=1000, height=600)
-    st.plotly_chart(fig_current_ratio)
-
-    # Solvency Ratio Over Time for Each Company
-    fig_solvency_ratio = px.line(df, x='year', y='solvency_ratio', color='company_name', 
-                                 title='Solvency Ratio Over Time by Company')
-    fig_solvency_ratio.update_layout(width=1000, height=600)
-    st.plotly_chart(fig_solvency_ratio)
-
-    # Cash and Cash Equivalents Over Time for Each Company
-    fig_cash = px.line(df, x='year', y='cash_and_cash_equivalents', color='company_name', 
-                       title='Cash and Cash Equivalents Over Time by Company')
-    fig_cash.update_layout(width=1000, height=600)
-    st.plotly_chart(fig_cash)
+    for fig in create_liquidity_and_solvency_charts(df):
+        show_figure(fig)
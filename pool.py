@@ -0,0 +1,221 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Path of the SQLite database file; can be pointed elsewhere with the CVR_DB_PATH environment variable
+DB_PATH = os.environ.get('CVR_DB_PATH', os.path.join(os.path.dirname(__file__), 'cvr_database.db'))
+# Maximum number of read-only connections that may be open at the same time
+POOL_SIZE = int(os.environ.get('CVR_DB_POOL_SIZE', '4'))
+# Seconds a thread waits for a free read-only connection before giving up
+CHECKOUT_TIMEOUT = 30.0
+# Bytes of the database file SQLite may memory-map per connection
+MMAP_SIZE = 256 * 1024 * 1024
+# Page cache size per connection in KiB (passed to SQLite as a negative number)
+CACHE_SIZE_KIB = 64 * 1024
+
+
+# Open a read-only connection with the pool's pragmas. Used by the pool and by worker processes
+# (see sector_rebuild.py), which cannot share the pool's connections.
+def connect_read_only(db_path, **kwargs):
+    # mode=ro fails instead of silently creating an empty database when the file is missing
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, **kwargs)
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    return conn
+
+
+class ConnectionPool:
+    # A bounded pool of read-only SQLite connections plus a single shared writer connection.
+    # Streamlit runs every script rerun on its own thread, so connections are handed out per
+    # checkout rather than pinned to a thread for its whole lifetime; a thread that already
+    # holds a connection gets the same one back if it nests checkouts.
+
+    def __init__(self, db_path, size=POOL_SIZE, timeout=CHECKOUT_TIMEOUT):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        # Idle read-only connections, most recently used first so hot page caches get reused
+        self._idle = queue.LifoQueue()
+        # One slot per connection that may exist; this is what keeps the handle count fixed
+        self._slots = threading.BoundedSemaphore(size)
+        # Per-thread record of the connection currently checked out and the nesting depth
+        self._local = threading.local()
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._stats_lock = threading.Lock()
+        self._closed = False
+        # Pool metrics
+        self._checkouts = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._live_handles = 0
+        self._in_use = 0
+
+    # Open a new connection and apply the per-connection pragmas. The database file must exist:
+    # sqlite3.connect would silently create an empty one for the writer.
+    def _open(self, read_only):
+        if not os.path.exists(self.db_path):
+            raise FileNotFoundError(f"Database file {self.db_path} does not exist; point CVR_DB_PATH at the CVR database")
+        if read_only:
+            conn = connect_read_only(self.db_path, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            # Switch the database to WAL mode so readers are not blocked by this connection's writes;
+            # the setting is stored in the file, so the read-only connections pick it up too
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.OperationalError:
+                # A read-only file system keeps whatever journal mode the file already has
+                pass
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+            conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+        with self._stats_lock:
+            self._live_handles += 1
+        return conn
+
+    def _discard(self, conn):
+        conn.close()
+        with self._stats_lock:
+            self._live_handles -= 1
+
+    # Check out a read-only connection for the duration of a with-block
+    @contextmanager
+    def connection(self):
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            # Nested checkout on the same thread: reuse the connection already held
+            self._local.depth += 1
+            try:
+                yield held
+            finally:
+                self._local.depth -= 1
+            return
+
+        if self._closed:
+            raise RuntimeError("Connection pool has been closed")
+
+        # Wait for a free slot and record how long that took
+        started = time.perf_counter()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        waited = time.perf_counter() - started
+        with self._stats_lock:
+            self._wait_time += waited
+            self._max_wait = max(self._max_wait, waited)
+            if acquired:
+                self._checkouts += 1
+            else:
+                self._timeouts += 1
+        if not acquired:
+            raise TimeoutError(f"No database connection available after {self.timeout} seconds")
+
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._open(read_only=True)
+        except Exception:
+            self._slots.release()
+            raise
+
+        self._local.conn = conn
+        self._local.depth = 1
+        with self._stats_lock:
+            self._in_use += 1
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._local.depth = 0
+            with self._stats_lock:
+                self._in_use -= 1
+            if self._closed:
+                self._discard(conn)
+            else:
+                self._idle.put(conn)
+            self._slots.release()
+
+    # Use the shared writer connection; commits on success and rolls back on error
+    @contextmanager
+    def write_connection(self):
+        with self._writer_lock:
+            if self._closed:
+                raise RuntimeError("Connection pool has been closed")
+            if self._writer is None:
+                self._writer = self._open(read_only=False)
+            try:
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+
+    # Snapshot of the pool metrics
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'checkouts': self._checkouts,
+                'wait_time_total': self._wait_time,
+                'wait_time_max': self._max_wait,
+                'wait_time_avg': self._wait_time / self._checkouts if self._checkouts else 0.0,
+                'timeouts': self._timeouts,
+                'live_handles': self._live_handles,
+                'idle_handles': self._idle.qsize(),
+                'in_use': self._in_use,
+                'size': self.size,
+            }
+
+    # Close every idle connection and the writer; checked-out connections close when returned
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        with self._writer_lock:
+            if self._writer is not None:
+                self._discard(self._writer)
+                self._writer = None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# Return the process-wide pool, creating it on first use
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_PATH)
+    return _pool
+
+
+# Point the process-wide pool at a different database file (used by scripts and tooling)
+def configure_pool(db_path, size=POOL_SIZE):
+    global _pool, DB_PATH
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        DB_PATH = db_path
+        _pool = ConnectionPool(db_path, size=size)
+    return _pool
+
+
+def read_connection():
+    return get_pool().connection()
+
+
+def write_connection():
+    return get_pool().write_connection()
+
+
+def pool_stats():
+    return get_pool().stats()
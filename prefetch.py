@@ -0,0 +1,169 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from cache import query_cache
+from instrumentation import stage
+from loader import frame_memory
+from metrics import (FINANCIAL_HEALTH_METRICS, INVESTMENT_THRESHOLDS, build_financial_health_figure,
+                     fetch_investment_opportunities_data, fetch_liquidity_and_solvency_data,
+                     fetch_operational_efficiency_data, fetch_sector_performance_data)
+from pool import pool_stats
+from search import get_search_index
+
+logger = logging.getLogger(__name__)
+
+# Threads warming caches in the background; kept below the connection pool size so the
+# script threads of active sessions always find a connection
+PREFETCH_WORKERS = int(os.environ.get('CVR_PREFETCH_WORKERS', '1'))
+# Most prefetch tasks waiting or running at once across all sessions; further tasks are dropped
+PREFETCH_QUEUE_LIMIT = 16
+# Prefetching stops while the frames in the query cache take more than this many bytes.
+# Frames selected from the analytics store share memory with it, so this overestimates.
+PREFETCH_MEMORY_BUDGET = int(os.environ.get('CVR_PREFETCH_MEMORY_MB', '512')) * 1024 * 1024
+# Read connections left for the active sessions; a task is skipped when fewer are free
+RESERVED_CONNECTIONS = 1
+
+
+# The cache warming done for each dashboard view, as (name, function, args, kwargs) tasks.
+# Each task calls a cached data function with the same arguments the view passes, so the view finds it cached.
+def view_tasks(view, sector_code, year_range):
+    year_range = tuple(year_range)
+    if view == "Sector Performance Overview":
+        return [('sector_performance', fetch_sector_performance_data, (year_range,), {})]
+    if view == "Financial Health Dashboard":
+        # Every metric of the metric selectbox, so switching metrics is served from the cache too
+        return [(f'financial_health:{metric}', build_financial_health_figure, (metric, year_range), {})
+                for metric in FINANCIAL_HEALTH_METRICS]
+    if view == "Investment Opportunity Identification":
+        return [('investment_opportunities', fetch_investment_opportunities_data, (),
+                 dict(INVESTMENT_THRESHOLDS, year_range=year_range))]
+    if view == "Operational Efficiency Analysis":
+        return [('operational_efficiency', fetch_operational_efficiency_data, (year_range,), {})]
+    if view == "Liquidity and Solvency Trend Analysis":
+        return [('liquidity_and_solvency', fetch_liquidity_and_solvency_data, (year_range,), {})]
+    if view in ("Company Analysis", "Company to Company Comparison", "Company Information"):
+        # The company picker of these views searches the sector's companies
+        return [(f'search_index:{sector_code}', get_search_index, (sector_code,), {})]
+    return []
+
+
+# Bytes of the frames held by the query cache
+def cached_frame_bytes():
+    total = 0
+    for value in query_cache.values():
+        for part in (value if isinstance(value, tuple) else (value,)):
+            if isinstance(part, pd.DataFrame):
+                total += frame_memory(part)
+    return total
+
+
+class Prefetcher:
+    # Small thread pool warming caches ahead of the user. Tasks are scheduled per owner (a session);
+    # scheduling again or calling cancel drops the owner's tasks that have not started yet.
+
+    def __init__(self, workers=PREFETCH_WORKERS, queue_limit=PREFETCH_QUEUE_LIMIT,
+                 memory_budget=PREFETCH_MEMORY_BUDGET):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self._lock = threading.Lock()
+        # owner -> futures of its latest schedule
+        self._owners = {}
+        # Task key -> future, for tasks waiting or running; the same task is never queued twice
+        self._pending = {}
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.memory_budget = memory_budget
+        self.counts = {'scheduled': 0, 'completed': 0, 'cancelled': 0, 'failed': 0, 'dropped': 0,
+                       'skipped_busy': 0, 'skipped_memory': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    # Run one task unless the active sessions need the resources
+    def _run(self, name, func, args, kwargs):
+        stats = pool_stats()
+        if stats['size'] - stats['in_use'] <= RESERVED_CONNECTIONS:
+            self._count('skipped_busy')
+            return
+        if self.memory_budget and cached_frame_bytes() >= self.memory_budget:
+            self._count('skipped_memory')
+            return
+        try:
+            with stage(f'prefetch.{name}'):
+                func(*args, **kwargs)
+        except Exception:
+            self._count('failed')
+            logger.warning("Prefetch of %s failed", name, exc_info=True)
+        else:
+            self._count('completed')
+
+    def _finished(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    # Replace the owner's queued tasks with tasks; tasks already queued by anyone are not queued again
+    def schedule(self, owner, tasks):
+        self.cancel(owner)
+        futures = []
+        with self._lock:
+            for name, func, args, kwargs in tasks:
+                key = (func.__module__, func.__qualname__, args, tuple(sorted(kwargs.items())))
+                if key in self._pending:
+                    continue
+                if len(self._pending) >= self.queue_limit:
+                    self.counts['dropped'] += 1
+                    continue
+                future = self._executor.submit(self._run, name, func, args, kwargs)
+                self._pending[key] = future
+                future.add_done_callback(lambda done, key=key: self._finished(key, done))
+                futures.append(future)
+                self.counts['scheduled'] += 1
+            self._owners[owner] = futures
+        return len(futures)
+
+    # Drop the owner's tasks that have not started; running tasks finish (a query cannot be interrupted)
+    def cancel(self, owner):
+        with self._lock:
+            futures = self._owners.pop(owner, [])
+        cancelled = sum(future.cancel() for future in futures)
+        if cancelled:
+            with self._lock:
+                self.counts['cancelled'] += cancelled
+        return cancelled
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, workers=self.workers, queued=len(self._pending),
+                        queue_limit=self.queue_limit, memory_budget=self.memory_budget)
+
+
+# Process-wide prefetcher shared by every Streamlit session
+prefetcher = Prefetcher()
+
+
+# After a view has rendered, warm the nearest view on either side of it in the view list (skipping
+# views with nothing to warm) for the same sector and year window. The owner's earlier prefetches
+# are cancelled first. Returns the number of tasks queued.
+def prefetch_adjacent_views(owner, views, current_view, sector_code, year_range):
+    position = views.index(current_view)
+    tasks = []
+    for step in (1, -1):
+        neighbour = position + step
+        while 0 <= neighbour < len(views):
+            neighbour_tasks = view_tasks(views[neighbour], sector_code, year_range)
+            if neighbour_tasks:
+                tasks += neighbour_tasks
+                break
+            neighbour += step
+    return prefetcher.schedule(owner, tasks)
+
+
+def cancel_prefetch(owner):
+    return prefetcher.cancel(owner)
+
+
+def prefetch_stats():
+    return prefetcher.stats()
@@ -0,0 +1,211 @@
+# Pre-render the most visited dashboard views for the database's full year range, so the dashboard
+# can serve them without querying the data or building the figures:
+#   sector_performance                   - the sector overview
+#   financial_health-<metric>            - one per metric of metrics.FINANCIAL_HEALTH_METRICS
+#   operational_efficiency-<sector code> - one per sector with companies
+#   liquidity_and_solvency-<sector code> - one per sector with companies
+# The data is loaded once through the metrics data functions; the figures are built, prepared for
+# display and written as Plotly JSON (and optionally standalone HTML) in worker processes. The
+# manifest records the database version, and the dashboard only serves reports of the current one.
+#
+# Usage: python reports.py [--db path/to/cvr_database.db] [--out reports_dir] [--format json|html|both]
+#                          [--workers 8] [--backend store|sqlite|snapshot]
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import plotly.graph_objects as go
+from bootstrap import bootstrap
+from cache import cached_query, db_version
+from charts import prepare_figure, show_figure
+from instrumentation import instrumented
+from metrics import (FINANCIAL_HEALTH_METRICS, create_financial_health_chart, create_liquidity_and_solvency_charts,
+                     create_operational_efficiency_charts, create_sector_performance_chart,
+                     fetch_financial_health_data, fetch_liquidity_and_solvency_data,
+                     fetch_operational_efficiency_data, fetch_sector_performance_data, select_sector)
+from pool import configure_pool
+
+logger = logging.getLogger(__name__)
+
+# Where the reports live; can be pointed elsewhere with the CVR_REPORTS_DIR environment variable
+REPORTS_DIR = os.environ.get('CVR_REPORTS_DIR', os.path.join(os.path.dirname(__file__), 'reports'))
+# File describing the reports: database version, year window and what each report holds
+MANIFEST_NAME = '_manifest.json'
+# Worker processes rendering reports; set with the CVR_REPORT_WORKERS environment variable
+REPORT_WORKERS = int(os.environ.get('CVR_REPORT_WORKERS', str(os.cpu_count() or 1)))
+FORMATS = ('json', 'html')
+
+# Page wrapping the figures of one report in the HTML format
+HTML_PAGE = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>{title}</title></head>
+<body>
+{figures}
+</body>
+</html>
+"""
+
+
+# File name (without extension) of the report of a view for a sector and/or metric
+def report_name(view, sector_code=None, metric=None):
+    return '-'.join(part for part in (view, sector_code, metric) if part is not None)
+
+
+# The reports to render as (name, chart builder, builder args); the data of every report is
+# loaded here, once per view, so the workers only build and serialize figures
+def report_tasks(sector_codes, year_range, backend=None):
+    tasks = [(report_name('sector_performance'), create_sector_performance_chart,
+              (fetch_sector_performance_data(year_range, backend),))]
+    for metric in FINANCIAL_HEALTH_METRICS:
+        tasks.append((report_name('financial_health', metric=metric), create_financial_health_chart,
+                      (fetch_financial_health_data(metric, year_range, backend), metric)))
+    for view, fetch, builder in (
+            ('operational_efficiency', fetch_operational_efficiency_data, create_operational_efficiency_charts),
+            ('liquidity_and_solvency', fetch_liquidity_and_solvency_data, create_liquidity_and_solvency_charts)):
+        df = fetch(year_range, backend)
+        for code in sector_codes:
+            tasks.append((report_name(view, code), builder, (select_sector(df, code),)))
+    return tasks
+
+
+# Build, prepare and write the figures of one report to out_dir. Runs in a worker process.
+def render_report(name, builder, args, out_dir, formats):
+    started = time.perf_counter()
+    figures = builder(*args)
+    prepared = [prepare_figure(fig) for fig in (figures if isinstance(figures, list) else [figures])]
+    if 'json' in formats:
+        with open(os.path.join(out_dir, f"{name}.json"), 'w', encoding='utf-8') as f:
+            json.dump({'figures': [{'figure': json.loads(fig.to_json()), 'info': info} for fig, info in prepared]}, f)
+    if 'html' in formats:
+        # plotly.js is embedded once, with the first figure, so the page works offline
+        html = '\n'.join(fig.to_html(full_html=False, include_plotlyjs=position == 0)
+                         for position, (fig, _) in enumerate(prepared))
+        with open(os.path.join(out_dir, f"{name}.html"), 'w', encoding='utf-8') as f:
+            f.write(HTML_PAGE.format(title=name, figures=html))
+    return {
+        'name': name,
+        'figures': len(prepared),
+        'bytes': sum(info['bytes'] for _, info in prepared),
+        'seconds': time.perf_counter() - started,
+    }
+
+
+# Render every report to path for the database's full year range. The reports are written next to
+# the target and swapped in at the end, so the dashboard never reads a half-written set.
+# Returns the manifest.
+def generate_reports(path=REPORTS_DIR, formats=('json',), workers=REPORT_WORKERS, backend=None):
+    started = time.perf_counter()
+    metadata = bootstrap()
+    # Stamped after the bootstrap's own writes; a change while rendering leaves the reports stale
+    version = db_version()
+    year_range = tuple(metadata['year_range'])
+    tasks = report_tasks(metadata['sector_codes'], year_range, backend)
+    load_seconds = time.perf_counter() - started
+
+    staging = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    reports = {}
+    # Spawned rather than forked, like sector_rebuild.py; the workers only need the chart code
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(tasks))), mp_context=context) as executor:
+        futures = [executor.submit(render_report, name, builder, args, staging, formats)
+                   for name, builder, args in tasks]
+        for future in as_completed(futures):
+            result = future.result()
+            logger.debug("Rendered %-40s %d figure(s), %9d bytes in %.2f s", result['name'], result['figures'],
+                         result['bytes'], result['seconds'])
+            reports[result.pop('name')] = result
+
+    manifest = {
+        'db_version': version,
+        'year_range': list(year_range),
+        'formats': list(formats),
+        'created_at': time.time(),
+        'load_seconds': load_seconds,
+        'seconds': time.perf_counter() - started,
+        'reports': dict(sorted(reports.items())),
+    }
+    with open(os.path.join(staging, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    # Swap the new reports in
+    retired = f"{path}.old-{os.getpid()}"
+    if os.path.exists(path):
+        os.rename(path, retired)
+    os.rename(staging, path)
+    shutil.rmtree(retired, ignore_errors=True)
+
+    logger.info("Rendered %d reports to %s in %.1f s (data loaded in %.1f s)",
+                len(reports), path, manifest['seconds'], load_seconds)
+    return manifest
+
+
+# Manifest of the reports at path, or None when there are none
+def read_report_manifest(path=REPORTS_DIR):
+    try:
+        with open(os.path.join(path, MANIFEST_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# True when the manifest's reports were rendered from the current database contents for year_range
+def reports_are_fresh(manifest, year_range):
+    if manifest is None or 'json' not in manifest['formats'] or tuple(manifest['year_range']) != tuple(year_range):
+        return False
+    return manifest['db_version'] == db_version()
+
+
+# The prepared figures of a report as (figure, info) pairs; cached per generation of the reports
+@cached_query
+def load_report_figures(path, name, created_at):
+    with open(os.path.join(path, f"{name}.json"), encoding='utf-8') as f:
+        report = json.load(f)
+    return [(go.Figure(entry['figure']), entry['info']) for entry in report['figures']]
+
+
+# Show the pre-rendered report of a view when one is current for the database and year window.
+# Returns False (showing nothing) otherwise, so the caller renders the view live.
+@instrumented
+def show_report(view, year_range, sector_code=None, metric=None, path=REPORTS_DIR):
+    manifest = read_report_manifest(path)
+    name = report_name(view, sector_code, metric)
+    if not reports_are_fresh(manifest, year_range) or name not in manifest['reports']:
+        return False
+    for fig, info in load_report_figures(path, name, manifest['created_at']):
+        show_figure(fig, info=info)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-render the dashboard's sector and metric views.")
+    parser.add_argument('--db', help="database file to render (defaults to the application database)")
+    parser.add_argument('--out', default=REPORTS_DIR, help="reports directory")
+    parser.add_argument('--format', choices=['json', 'html', 'both'], default='json',
+                        help="Plotly JSON served by the dashboard (default), standalone HTML pages, or both")
+    parser.add_argument('--workers', type=int, default=REPORT_WORKERS,
+                        help="worker processes (default: %(default)s, the number of CPUs)")
+    parser.add_argument('--backend', help="metrics backend the data is loaded from (default: CVR_METRICS_BACKEND)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # Copy-on-write over the shared store frames, as in the dashboard (see main.py)
+    pd.set_option('mode.copy_on_write', True)
+    if args.db:
+        configure_pool(args.db)
+    formats = FORMATS if args.format == 'both' else (args.format,)
+    manifest = generate_reports(args.out, formats, args.workers, args.backend)
+    print(json.dumps({name: manifest[name] for name in ('year_range', 'formats', 'load_seconds', 'seconds')}
+                     | {'reports': len(manifest['reports'])}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+import sqlite3
+from pool import read_connection, write_connection
+from schema import DATA_VERSION_BUMP, bump_data_version
+
+# Financial columns averaged per sector and year by the sector views
+ROLLUP_COLUMNS = [
+    'gross_profit_loss',
+    'equity',
+    'assets',
+    'solvency_ratio',
+    'return_on_assets',
+    'return_on_investment',
+    'current_ratio',
+]
+
+ROLLUP_TABLE = 'sector_year_rollup'
+# (sector, year) pairs whose underlying rows changed since the last refresh
+DIRTY_TABLE = 'sector_year_rollup_dirty'
+
+
+# Build the CREATE TABLE statement: a sum, a non-null count and an average for every column
+def _rollup_table_sql():
+    column_defs = []
+    for column in ROLLUP_COLUMNS:
+        column_defs.append(f"sum_{column} REAL")
+        column_defs.append(f"count_{column} INTEGER NOT NULL")
+        column_defs.append(f"avg_{column} REAL")
+    return f"""
+        CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+            industry_sector TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            {', '.join(column_defs)},
+            PRIMARY KEY (industry_sector, year)
+        ) WITHOUT ROWID
+    """
+
+
+# Triggers recording which (sector, year) pairs are touched by writes to financials or company,
+# followed by the ones bumping the data version on any write to them
+TRIGGERS = {
+    'financials_rollup_insert': f"""
+        CREATE TRIGGER IF NOT EXISTS financials_rollup_insert AFTER INSERT ON financials
+        BEGIN
+            INSERT OR IGNORE INTO {DIRTY_TABLE} (industry_sector, year)
+            SELECT industry_sector, NEW.year FROM company
+            WHERE cvr_number = NEW.cvr AND industry_sector IS NOT NULL;
+        END
+    """,
+    # Only updates of the key or of a rolled-up column matter; derived columns are rewritten in bulk
+    'financials_rollup_update': f"""
+        CREATE TRIGGER IF NOT EXISTS financials_rollup_update
+        AFTER UPDATE OF cvr, year, {', '.join(ROLLUP_COLUMNS)} ON financials
+        BEGIN
+            INSERT OR IGNORE INTO {DIRTY_TABLE} (industry_sector, year)
+            SELECT industry_sector, OLD.year FROM company
+            WHERE cvr_number = OLD.cvr AND industry_sector IS NOT NULL;
+            INSERT OR IGNORE INTO {DIRTY_TABLE} (industry_sector, year)
+            SELECT industry_sector, NEW.year FROM company
+            WHERE cvr_number = NEW.cvr AND industry_sector IS NOT NULL;
+        END
+    """,
+    'financials_rollup_delete': f"""
+        CREATE TRIGGER IF NOT EXISTS financials_rollup_delete AFTER DELETE ON financials
+        BEGIN
+            INSERT OR IGNORE INTO {DIRTY_TABLE} (industry_sector, year)
+            SELECT industry_sector, OLD.year FROM company
+            WHERE cvr_number = OLD.cvr AND industry_sector IS NOT NULL;
+        END
+    """,
+    'company_rollup_insert': f"""
+        CREATE TRIGGER IF NOT EXISTS company_rollup_insert AFTER INSERT ON company
+        WHEN NEW.industry_sector IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO {DIRTY_TABLE} (industry_sector, year)
+            SELECT NEW.industry_sector, year FROM financials WHERE cvr = NEW.cvr_number;
+        END
+    """,
+    'company_rollup_update': f"""
+        CREATE TRIGGER IF NOT EXISTS company_rollup_update AFTER UPDATE OF industry_sector, cvr_number ON company
+        BEGIN
+            INSERT OR IGNORE INTO {DIRTY_TABLE} (industry_sector, year)
+            SELECT OLD.industry_sector, year FROM financials
+            WHERE cvr = OLD.cvr_number AND OLD.industry_sector IS NOT NULL;
+            INSERT OR IGNORE INTO {DIRTY_TABLE} (industry_sector, year)
+            SELECT NEW.industry_sector, year FROM financials
+            WHERE cvr = NEW.cvr_number AND NEW.industry_sector IS NOT NULL;
+        END
+    """,
+    'company_rollup_delete': f"""
+        CREATE TRIGGER IF NOT EXISTS company_rollup_delete AFTER DELETE ON company
+        WHEN OLD.industry_sector IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO {DIRTY_TABLE} (industry_sector, year)
+            SELECT OLD.industry_sector, year FROM financials WHERE cvr = OLD.cvr_number;
+        END
+    """,
+}
+
+# Writes made outside the application (a manual UPDATE, another tool) change the data version as
+# they happen, so the caches and the analytics store reload without waiting for a rollup refresh.
+# ingest.py drops these with the others for a bulk load and bumps the version once at the end.
+TRIGGERS.update({
+    f"{table}_version_{event.lower()}": f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table}
+        BEGIN
+            {DATA_VERSION_BUMP};
+        END
+    """
+    for table in ('company', 'financials') for event in ('INSERT', 'UPDATE', 'DELETE')
+})
+
+
+# Aggregate SELECT feeding the rollup; extra_join narrows it down to the dirty pairs and
+# where (an extra condition on c) to one partition of the companies
+def _aggregate_sql(extra_join='', where=''):
+    aggregates = []
+    for column in ROLLUP_COLUMNS:
+        aggregates.append(f"SUM(f.{column})")
+        aggregates.append(f"COUNT(f.{column})")
+        aggregates.append(f"AVG(f.{column})")
+    return f"""
+        SELECT c.industry_sector, f.year, COUNT(*), {', '.join(aggregates)}
+        FROM financials f
+        JOIN company c ON f.cvr = c.cvr_number
+        {extra_join}
+        WHERE c.industry_sector IS NOT NULL {'AND ' + where if where else ''}
+        GROUP BY c.industry_sector, f.year
+    """
+
+
+# Columns of the rollup table in the order the aggregate SELECT produces them
+def _rollup_columns():
+    columns = ['industry_sector', 'year', 'row_count']
+    for column in ROLLUP_COLUMNS:
+        columns += [f"sum_{column}", f"count_{column}", f"avg_{column}"]
+    return columns
+
+
+def _insert_sql(extra_join=''):
+    return f"INSERT INTO {ROLLUP_TABLE} ({', '.join(_rollup_columns())}) {_aggregate_sql(extra_join)}"
+
+
+# Statements of the refresh below; kept at module level so check_query_plans.py can inspect them
+FULL_REFRESH_SQL = _insert_sql()
+# Drop the stale rows of the dirty pairs first; pairs that lost all their rows simply stay deleted
+DIRTY_DELETE_SQL = f"""
+    DELETE FROM {ROLLUP_TABLE}
+    WHERE (industry_sector, year) IN (SELECT industry_sector, year FROM {DIRTY_TABLE})
+"""
+DIRTY_REFRESH_SQL = _insert_sql(
+    f"JOIN {DIRTY_TABLE} d ON d.industry_sector = c.industry_sector AND d.year = f.year"
+)
+
+
+# Create the rollup table, the dirty-pair table and the triggers that maintain it.
+# Returns True when the rollup table had to be created (and therefore needs a full build).
+def create_rollup_schema(conn):
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (ROLLUP_TABLE,)
+    ).fetchone() is None
+    conn.execute(_rollup_table_sql())
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DIRTY_TABLE} (
+            industry_sector TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            PRIMARY KEY (industry_sector, year)
+        ) WITHOUT ROWID
+    """)
+    for trigger_sql in TRIGGERS.values():
+        conn.execute(trigger_sql)
+    return created
+
+
+# Recompute the rollup rows. A full refresh rebuilds everything; otherwise only the
+# (sector, year) pairs recorded in the dirty table are recomputed. Either way the data version
+# is bumped when anything was refreshed, which also covers the writes that marked the pairs.
+# Returns the number of (sector, year) pairs that were refreshed.
+def refresh_sector_year_rollup(conn, full=False):
+    if full:
+        conn.execute(f"DELETE FROM {ROLLUP_TABLE}")
+        conn.execute(FULL_REFRESH_SQL)
+        conn.execute(f"DELETE FROM {DIRTY_TABLE}")
+        bump_data_version(conn)
+        return conn.execute(f"SELECT COUNT(*) FROM {ROLLUP_TABLE}").fetchone()[0]
+
+    dirty_count = conn.execute(f"SELECT COUNT(*) FROM {DIRTY_TABLE}").fetchone()[0]
+    if not dirty_count:
+        return 0
+    conn.execute(DIRTY_DELETE_SQL)
+    conn.execute(DIRTY_REFRESH_SQL)
+    conn.execute(f"DELETE FROM {DIRTY_TABLE}")
+    bump_data_version(conn)
+    return dirty_count
+
+
+# Query for the rollup rows of the companies matching where, a condition on company c
+def rollup_rows_query(where=''):
+    return _aggregate_sql(where=where)
+
+
+# Rollup rows of the companies matching where (with params), computed on any connection;
+# sector_rebuild.py runs this per sector in worker processes
+def compute_rollup_rows(conn, where='', params=()):
+    return conn.execute(rollup_rows_query(where), params).fetchall()
+
+
+# Replace the whole rollup with rows computed by compute_rollup_rows. Pairs dirtied while the rows
+# were being computed are recomputed afterwards, so writes racing the rebuild are not lost.
+# Returns the number of rows written.
+def replace_sector_year_rollup(conn, rows):
+    columns = _rollup_columns()
+    conn.execute(f"DELETE FROM {ROLLUP_TABLE}")
+    conn.executemany(f"INSERT INTO {ROLLUP_TABLE} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                     rows)
+    refresh_sector_year_rollup(conn)
+    bump_data_version(conn)
+    return len(rows)
+
+
+# Make sure the rollup exists and is up to date. Returns False when it cannot be used,
+# e.g. because the database is read-only and the rollup was never built.
+def ensure_sector_year_rollup():
+    exists = False
+    try:
+        with read_connection() as conn:
+            exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (ROLLUP_TABLE,)
+            ).fetchone() is not None
+            dirty = exists and conn.execute(f"SELECT 1 FROM {DIRTY_TABLE} LIMIT 1").fetchone() is not None
+            # A migration or a bulk load may have dropped triggers; they are recreated below
+            triggers = conn.execute(
+                f"SELECT COUNT(*) FROM sqlite_master WHERE type='trigger' AND name IN ({', '.join('?' * len(TRIGGERS))})",
+                tuple(TRIGGERS),
+            ).fetchone()[0]
+        if exists and not dirty and triggers == len(TRIGGERS):
+            return True
+        with write_connection() as conn:
+            created = create_rollup_schema(conn)
+            refresh_sector_year_rollup(conn, full=created)
+        return True
+    except sqlite3.OperationalError:
+        return exists
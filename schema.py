@@ -0,0 +1,231 @@
+import sqlite3
+from utils import sector_attributes
+
+# Sector code/display name pairs as a SQL VALUES list, for migrations that translate names to codes
+_SECTOR_VALUES = ', '.join(f"('{code}', '{name.replace(chr(39), chr(39) * 2)}')" for code, name in sector_attributes.items())
+
+# The company and financials tables as read by the application. They come with the CVR database
+# and are not created by the migrations; synthetic_data.py uses these to build synthetic databases.
+BASE_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS company (
+        cvr_number INTEGER PRIMARY KEY,
+        name TEXT,
+        industry_sector TEXT,
+        email TEXT,
+        phone_number TEXT,
+        establishment_date TEXT,
+        purpose TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS financials (
+        cvr INTEGER NOT NULL,
+        year INTEGER NOT NULL,
+        profit_loss REAL,
+        equity REAL,
+        return_on_assets REAL,
+        solvency_ratio REAL,
+        gross_profit_loss REAL,
+        assets REAL,
+        return_on_investment REAL,
+        current_ratio REAL,
+        profit_margin REAL,
+        revenue REAL,
+        external_expenses REAL,
+        employee_expense REAL,
+        profit_loss_from_ordinary_operating_activities REAL,
+        cash_and_cash_equivalents REAL
+    )
+    """,
+]
+
+# Columns computed from the reported values and stored on every financials row, so the views read
+# them instead of deriving them per query. ingest.py maintains them for the rows it loads; the rows
+# already in the database when migration 4 adds the columns are filled by 'python ingest.py --backfill'.
+DERIVED_COLUMNS = ('operating_margin', 'expense_ratio', 'equity_growth', 'assets_growth')
+
+# Operating margin and expense ratio of every row; a zero or missing revenue gives NULL
+DERIVED_RATIOS_UPDATE = """
+    UPDATE financials
+    SET operating_margin = profit_loss_from_ordinary_operating_activities * 1.0 / NULLIF(revenue, 0),
+        expense_ratio = (external_expenses + employee_expense) * 1.0 / NULLIF(revenue, 0)
+"""
+
+# Year-over-year equity and assets growth of every row against the company's previous reported year,
+# for the rows selected by {where}; a company's first year (or a zero previous value) gives NULL
+GROWTH_UPDATE = """
+    UPDATE financials
+    SET equity_growth = g.equity_growth, assets_growth = g.assets_growth
+    FROM (
+        SELECT rowid AS row_id,
+               equity * 1.0 / LAG(equity) OVER company_years - 1 AS equity_growth,
+               assets * 1.0 / LAG(assets) OVER company_years - 1 AS assets_growth
+        FROM financials
+        {where}
+        WINDOW company_years AS (PARTITION BY cvr ORDER BY year)
+    ) AS g
+    WHERE financials.rowid = g.row_id
+"""
+
+# Small key/value table of database-wide state kept by the application
+STATE_TABLE = 'analytics_state'
+# State row set while the derived columns of existing financials rows still have to be backfilled
+DERIVED_PENDING = 'derived_columns_pending'
+# State row counting the changes to the analytics data (see cache.db_version)
+DATA_VERSION = 'data_version'
+
+DATA_VERSION_QUERY = f"SELECT value FROM {STATE_TABLE} WHERE name = '{DATA_VERSION}'"
+DATA_VERSION_BUMP = f"UPDATE {STATE_TABLE} SET value = value + 1 WHERE name = '{DATA_VERSION}'"
+
+
+class MigrationError(RuntimeError):
+    # A migration that cannot be applied to the data as it is; the message says how to fix the data
+    pass
+
+
+# Migration step creating a unique index. Rows sharing a key make it fail: they are reported rather
+# than removed, and cleaning them up is left to an explicit 'python ingest.py --dedupe'.
+def create_unique_index(name, table, columns):
+    def step(conn):
+        try:
+            conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+        except sqlite3.IntegrityError:
+            duplicates = conn.execute(
+                f"SELECT COUNT(*) FROM (SELECT 1 FROM {table} GROUP BY {columns} HAVING COUNT(*) > 1)"
+            ).fetchone()[0]
+            raise MigrationError(f"{duplicates} ({columns}) keys occur more than once in {table}; "
+                                 f"remove the duplicates with 'python ingest.py --dedupe' and start again") from None
+    return step
+
+
+# Schema migrations, applied in order and tracked through SQLite's user_version pragma.
+# Each entry is (version, description, list of SQL statements or functions taking the connection);
+# never edit a released migration, append a new one instead. Migrations run at application startup,
+# so they only change the schema: data clean-ups and full-table backfills are explicit ingest.py steps.
+MIGRATIONS = [
+    (1, "users table", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            sectors TEXT
+        )
+        """,
+    ]),
+    (2, "indexes for the financials/company access paths", [
+        # Per-company history lookups: cvr = ? AND year BETWEEN ? AND ?, latest year per company,
+        # and the financials side of the financials.cvr = company.cvr_number join
+        "CREATE INDEX IF NOT EXISTS idx_financials_cvr_year ON financials (cvr, year)",
+        # MIN/MAX(year) and year-window filters over all companies
+        "CREATE INDEX IF NOT EXISTS idx_financials_year ON financials (year)",
+        # Company side of the join
+        "CREATE INDEX IF NOT EXISTS idx_company_cvr_number ON company (cvr_number)",
+        # Companies in a sector ordered by name; cvr_number makes the index covering
+        "CREATE INDEX IF NOT EXISTS idx_company_sector_name ON company (industry_sector, name, cvr_number)",
+        # Fresh statistics so the planner actually picks the new indexes
+        "ANALYZE",
+    ]),
+    (3, "user_sectors table with the sector preferences of each user", [
+        """
+        CREATE TABLE IF NOT EXISTS user_sectors (
+            username TEXT NOT NULL REFERENCES users (username) ON DELETE CASCADE,
+            sector_code TEXT NOT NULL,
+            PRIMARY KEY (username, sector_code)
+        ) WITHOUT ROWID
+        """,
+        # Backfill from the ';'-joined display names in users.sectors. Names are matched whole between
+        # separators rather than split, because one sector name itself contains a ';'.
+        f"""
+        WITH sector_names (code, name) AS (VALUES {_SECTOR_VALUES})
+        INSERT OR IGNORE INTO user_sectors (username, sector_code)
+        SELECT u.username, s.code
+        FROM users u
+        JOIN sector_names s
+          ON instr(';' || u.sectors || ';', ';' || s.name || ';') > 0
+        WHERE u.sectors IS NOT NULL AND u.sectors != ''
+        """,
+    ]),
+    (4, "unique (cvr, year) key and stored derived columns on financials", [
+        # Upserts by (cvr, year) need a unique index; it replaces the plain one from migration 2
+        create_unique_index('idx_financials_cvr_year_key', 'financials', 'cvr, year'),
+        "DROP INDEX IF EXISTS idx_financials_cvr_year",
+        # The old rollup trigger fires on any updated column and would mark the backfill row by row;
+        # rollup.py recreates it limited to the columns the rollup reads
+        "DROP TRIGGER IF EXISTS financials_rollup_update",
+        *(f"ALTER TABLE financials ADD COLUMN {column} REAL" for column in DERIVED_COLUMNS),
+        f"""
+        CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """,
+        # The new columns are empty; filling them reads every row, so it is left to backfill_derived_columns
+        f"INSERT OR REPLACE INTO {STATE_TABLE} (name, value) SELECT '{DERIVED_PENDING}', EXISTS (SELECT 1 FROM financials)",
+    ]),
+    (5, "unique CVR number on company", [
+        # The company upsert of ingest.py needs a unique key; the primary key of BASE_TABLES only exists on
+        # databases created from it, not on the CVR database. It replaces the plain index from migration 2.
+        create_unique_index('idx_company_cvr_number_key', 'company', 'cvr_number'),
+        "DROP INDEX IF EXISTS idx_company_cvr_number",
+    ]),
+    (6, "data version counter", [
+        # Starts at the current time in milliseconds rather than 0, so a rebuilt database does not
+        # repeat the versions of the one it replaces and make an old snapshot or report look current
+        f"""
+        INSERT OR IGNORE INTO {STATE_TABLE} (name, value)
+        VALUES ('{DATA_VERSION}', CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER))
+        """,
+    ]),
+]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+# Apply every migration newer than the database's user_version inside one transaction, which the
+# caller commits; a migration that fails leaves no half-applied schema behind once it is rolled back.
+# Returns the list of versions that were applied.
+def migrate(conn):
+    current = get_schema_version(conn)
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        # sqlite3 only opens a transaction by itself before INSERT/UPDATE/DELETE; the DDL needs one too
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        for statement in statements:
+            if callable(statement):
+                statement(conn)
+            else:
+                conn.execute(statement)
+        # PRAGMA does not accept bound parameters; version is an int from the list above
+        conn.execute(f"PRAGMA user_version = {int(version)}")
+        applied.append(version)
+    return applied
+
+
+# True while the derived columns of the rows present at migration 4 have not been backfilled
+def derived_columns_pending(conn):
+    row = conn.execute(f"SELECT value FROM {STATE_TABLE} WHERE name = ?", (DERIVED_PENDING,)).fetchone()
+    return bool(row and row[0])
+
+
+# Compute the derived columns of every financials row and clear the pending mark. Reads and rewrites
+# the whole table, so it runs from 'python ingest.py --backfill' (and synthetic_data.py), never at
+# application startup.
+def backfill_derived_columns(conn):
+    conn.execute(DERIVED_RATIOS_UPDATE)
+    conn.execute(GROWTH_UPDATE.format(where=''))
+    conn.execute(f"UPDATE {STATE_TABLE} SET value = 0 WHERE name = ?", (DERIVED_PENDING,))
+    bump_data_version(conn)
+
+
+# Record a change of the analytics data in the same transaction as the change itself. Called by the
+# writers of analytics data: ingest.py, the derived column backfill and the rollup refresh and
+# rebuild; the rollup triggers bump it for every other write to company or financials. Other writes,
+# such as users registering, leave the version alone.
+def bump_data_version(conn):
+    conn.execute(DATA_VERSION_BUMP)
@@ -0,0 +1,169 @@
+import bisect
+import threading
+import numpy as np
+import streamlit as st
+from cache import db_version
+from pool import read_connection
+
+# Companies to build a search index from, read once per database version: every company, or the
+# companies of one sector through the covering idx_company_sector_name index
+COMPANY_SEARCH_QUERY = "SELECT cvr_number, name FROM company"
+SECTOR_COMPANY_SEARCH_QUERY = "SELECT cvr_number, name FROM company WHERE industry_sector = ?"
+
+# Matches shown per page of the type-ahead picker
+PAGE_SIZE = 20
+# Queries shorter than this only match name and CVR prefixes; longer ones also match anywhere in the name
+TRIGRAM = 3
+
+
+# Lower-cased, whitespace-normalized form of a name used for matching
+def fold(text):
+    return ' '.join(str(text or '').casefold().split())
+
+
+# Distinct three-character substrings of a folded name
+def trigrams(text):
+    return {text[i:i + TRIGRAM] for i in range(len(text) - TRIGRAM + 1)}
+
+
+class CompanySearchIndex:
+    # In-memory search over company names and CVR numbers.
+    # Companies are kept in name order; a name prefix is a contiguous range of that order found by
+    # binary search, and so is a CVR prefix in the (separately sorted) CVR order. Substring matches
+    # come from a trigram index: the sorted row lists of every trigram in the query are intersected
+    # and the few remaining candidates checked. Matches are returned page by page, prefix matches first.
+
+    def __init__(self, rows):
+        rows = sorted(((fold(name), name or '', int(cvr)) for cvr, name in rows))
+        self.folded = [row[0] for row in rows]
+        self.names = [row[1] for row in rows]
+        self.cvrs = np.array([row[2] for row in rows], dtype=np.int64)
+
+        # CVR numbers as strings in string order, with the name-order row of each
+        cvr_order = sorted(range(len(rows)), key=lambda row: str(self.cvrs[row]))
+        self.cvr_strings = [str(self.cvrs[row]) for row in cvr_order]
+        self.cvr_rows = np.array(cvr_order, dtype=np.int64)
+
+        # Trigram -> rows whose name contains it, in name order
+        postings = {}
+        for row, folded in enumerate(self.folded):
+            for gram in trigrams(folded):
+                postings.setdefault(gram, []).append(row)
+        self.postings = {gram: np.array(rows, dtype=np.int64) for gram, rows in postings.items()}
+
+    def __len__(self):
+        return len(self.names)
+
+    # Range [start, end) of the entries of a sorted list that start with prefix
+    @staticmethod
+    def _prefix_range(values, prefix):
+        start = bisect.bisect_left(values, prefix)
+        end = bisect.bisect_left(values, prefix + '\uffff', lo=start)
+        return start, end
+
+    # Rows matching query, best first, lazily
+    def _matches(self, query):
+        seen = set()
+        if query.isdigit():
+            start, end = self._prefix_range(self.cvr_strings, query)
+            for row in self.cvr_rows[start:end]:
+                seen.add(int(row))
+                yield int(row)
+
+        start, end = self._prefix_range(self.folded, query)
+        for row in range(start, end):
+            if row not in seen:
+                seen.add(row)
+                yield row
+
+        if len(query) < TRIGRAM:
+            return
+        # Intersect the posting lists, smallest first; a missing trigram means no substring match
+        lists = sorted((self.postings.get(gram) for gram in trigrams(query)),
+                       key=lambda rows: -1 if rows is None else len(rows))
+        if lists[0] is None:
+            return
+        candidates = lists[0]
+        for rows in lists[1:]:
+            candidates = np.intersect1d(candidates, rows, assume_unique=True)
+            if not len(candidates):
+                return
+        for row in candidates:
+            row = int(row)
+            if row not in seen and query in self.folded[row]:
+                yield row
+
+    # One page of matches as a list of (cvr_number, name) and whether more pages follow.
+    # An empty query pages through every company in name order.
+    def search(self, query, page=0, page_size=PAGE_SIZE):
+        query = fold(query)
+        skip = page * page_size
+        if not query:
+            rows = range(skip, min(skip + page_size + 1, len(self)))
+        else:
+            rows = []
+            for position, row in enumerate(self._matches(query)):
+                if position >= skip:
+                    rows.append(row)
+                if position >= skip + page_size:
+                    break
+        results = [(int(self.cvrs[row]), self.names[row]) for row in rows]
+        return results[:page_size], len(results) > page_size
+
+
+# Indexes per sector code (None for all companies), rebuilt when the database changes
+_indexes = {}
+_indexes_version = None
+_indexes_lock = threading.Lock()
+
+
+# Search index over the companies of a sector (or all companies), built on first use
+def get_search_index(sector_code=None):
+    global _indexes_version
+    version = db_version()
+    with _indexes_lock:
+        if version != _indexes_version:
+            _indexes.clear()
+            _indexes_version = version
+        index = _indexes.get(sector_code)
+        if index is None:
+            with read_connection() as conn:
+                if sector_code is None:
+                    rows = conn.execute(COMPANY_SEARCH_QUERY).fetchall()
+                else:
+                    rows = conn.execute(SECTOR_COMPANY_SEARCH_QUERY, (sector_code,)).fetchall()
+            index = CompanySearchIndex(rows)
+            _indexes[sector_code] = index
+        return index
+
+
+def search_companies(query, sector_code=None, page=0, page_size=PAGE_SIZE):
+    return get_search_index(sector_code).search(query, page, page_size)
+
+
+# Sidebar type-ahead company picker: a search box, one page of matches and previous/next buttons.
+# Returns the selected (cvr_number, name), or None when nothing matches.
+def company_picker(label, sector_code, key):
+    query = st.sidebar.text_input(label, key=f"{key}_query", placeholder="Company name or CVR number")
+
+    # Start from the first page whenever the query or sector changes
+    page_key = f"{key}_page"
+    if st.session_state.get(f"{key}_last") != (query, sector_code):
+        st.session_state[f"{key}_last"] = (query, sector_code)
+        st.session_state[page_key] = 0
+    page = st.session_state[page_key]
+
+    matches, has_more = search_companies(query, sector_code, page)
+    previous_col, next_col = st.sidebar.columns(2)
+    if previous_col.button("Previous", key=f"{key}_previous", disabled=page == 0):
+        st.session_state[page_key] = page - 1
+        st.rerun()
+    if next_col.button("Next", key=f"{key}_next", disabled=not has_more):
+        st.session_state[page_key] = page + 1
+        st.rerun()
+
+    if not matches:
+        st.sidebar.caption("No matching companies.")
+        return None
+    return st.sidebar.selectbox(f"{label} (page {page + 1})", matches, format_func=lambda x: f"{x[1]} ({x[0]})",
+                                key=f"{key}_choice")
@@ -0,0 +1,203 @@
+# Rebuild the per-sector analytics in parallel: the work is split into one partition per sector code
+# of utils.sector_attributes (plus one for companies without a known sector), each partition is
+# computed in a worker process on its own read-only connection, and the results are merged.
+#   rollup - the sector/year rollup behind the sector overview and financial health views, merged
+#            into the sector_year_rollup table
+#   store  - the analytics store frames (company-years with growth and ratios, sector averages)
+#            behind the store backend of every view; store.py uses this when CVR_STORE_BUILD_WORKERS > 1,
+#            and 'CVR_STORE_BUILD_WORKERS=8 python benchmark.py --db bench.db --only store.build_frames'
+#            times it
+#
+# Usage: python sector_rebuild.py [--db path/to/cvr_database.db] [--workers 8]
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from loader import LOAD_CHUNKSIZE, concat_frames, load_frame
+from pool import configure_pool, connect_read_only, get_pool, write_connection
+from rollup import compute_rollup_rows, create_rollup_schema, replace_sector_year_rollup, rollup_rows_query
+from snapshot import SNAPSHOT_SCHEMA
+from store import derive_company_columns, sector_year_averages
+from utils import sector_attributes
+
+logger = logging.getLogger(__name__)
+
+# Worker processes of a rebuild; set with the CVR_REBUILD_WORKERS environment variable
+REBUILD_WORKERS = int(os.environ.get('CVR_REBUILD_WORKERS', str(os.cpu_count() or 1)))
+# Partition label of the companies whose sector is missing or not in utils.sector_attributes
+OTHER_PARTITION = 'other'
+
+# Companies per sector code, to start the largest partitions first
+PARTITION_SIZES_QUERY = "SELECT industry_sector, COUNT(*) FROM company GROUP BY industry_sector"
+
+# The store's company-year columns (see snapshot.SNAPSHOT_QUERY) for the companies of one partition,
+# in (cvr, year) order. CROSS JOIN keeps company as the outer loop: the partition is found in the
+# company index and each company's years by key, instead of walking every financials row in key order.
+_COMPANY_YEARS_SQL = f"""
+    SELECT f.cvr, c.name AS company_name, c.industry_sector, f.year,
+           {', '.join('f.' + field.name for field in SNAPSHOT_SCHEMA if field.name not in ('cvr', 'company_name', 'industry_sector', 'year'))}
+    FROM company c
+    CROSS JOIN financials f ON f.cvr = c.cvr_number
+    WHERE {{partition}}
+    ORDER BY f.cvr, f.year;
+"""
+SECTOR_CONDITION = "c.industry_sector = ?"
+OTHER_CONDITION = f"(c.industry_sector IS NULL OR c.industry_sector NOT IN ({', '.join('?' * len(sector_attributes))}))"
+SECTOR_COMPANY_YEARS_QUERY = _COMPANY_YEARS_SQL.format(partition=SECTOR_CONDITION)
+OTHER_COMPANY_YEARS_QUERY = _COMPANY_YEARS_SQL.format(partition=OTHER_CONDITION)
+# Rollup rows of one partition, as compute_partition reads them through rollup.compute_rollup_rows
+SECTOR_ROLLUP_QUERY = rollup_rows_query(SECTOR_CONDITION)
+OTHER_ROLLUP_QUERY = rollup_rows_query(OTHER_CONDITION)
+
+
+# Condition on company c selecting a partition, with its parameters
+def partition_filter(partition):
+    if partition == OTHER_PARTITION:
+        return OTHER_CONDITION, tuple(sector_attributes)
+    return SECTOR_CONDITION, (partition,)
+
+
+# Partitions with at least one company as (partition, companies), largest first. An empty database
+# still gets one (empty) partition so the merged frames have their columns.
+def partition_plan(conn):
+    sizes = {}
+    for code, companies in conn.execute(PARTITION_SIZES_QUERY):
+        partition = code if code in sector_attributes else OTHER_PARTITION
+        sizes[partition] = sizes.get(partition, 0) + companies
+    return sorted(sizes.items(), key=lambda item: -item[1]) or [(OTHER_PARTITION, 0)]
+
+
+# Compute the requested parts for one partition. Runs in a worker process, so it opens its own
+# read-only connection instead of using the pool.
+def compute_partition(db_path, partition, parts):
+    started = time.perf_counter()
+    where, params = partition_filter(partition)
+    result = {'partition': partition, 'pid': os.getpid(), 'rows': 0}
+    timings = {}
+    conn = connect_read_only(db_path)
+    try:
+        if 'rollup' in parts:
+            step = time.perf_counter()
+            result['rollup'] = compute_rollup_rows(conn, where, params)
+            # row_count is the third column of a rollup row
+            result['rows'] = sum(row[2] for row in result['rollup'])
+            timings['rollup'] = time.perf_counter() - step
+        if 'store' in parts:
+            step = time.perf_counter()
+            query = SECTOR_COMPANY_YEARS_QUERY if partition != OTHER_PARTITION else OTHER_COMPANY_YEARS_QUERY
+            company_years = load_frame(query, params, chunksize=LOAD_CHUNKSIZE, conn=conn)
+            timings['load'] = time.perf_counter() - step
+            # Partitions hold whole companies, so growth within a partition is growth overall
+            step = time.perf_counter()
+            result['company_years'] = derive_company_columns(company_years)
+            result['sector_years'] = sector_year_averages(result['company_years'])
+            result['rows'] = len(company_years)
+            timings['derive'] = time.perf_counter() - step
+    finally:
+        conn.close()
+    result['timings'] = timings
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+
+# Compute parts for every partition in a pool of worker processes. Returns the partition results
+# (in completion order) and the wall time.
+def run_partitions(db_path, parts, workers=REBUILD_WORKERS):
+    conn = connect_read_only(db_path)
+    try:
+        partitions = partition_plan(conn)
+    finally:
+        conn.close()
+
+    started = time.perf_counter()
+    results = []
+    # Spawned rather than forked: the dashboard process runs threads (connection pool, prefetching,
+    # store warm-up) whose held locks a forked child would inherit
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(partitions))), mp_context=context) as executor:
+        futures = [executor.submit(compute_partition, db_path, partition, parts) for partition, _ in partitions]
+        for future in as_completed(futures):
+            result = future.result()
+            logger.debug("Partition %-5s %9d rows in %6.2f s (pid %d: %s)", result['partition'], result['rows'],
+                         result['seconds'], result['pid'],
+                         ', '.join(f"{name} {seconds:.2f} s" for name, seconds in result['timings'].items()))
+            results.append(result)
+    return results, time.perf_counter() - started
+
+
+# Merge the rollup rows of every partition into the sector_year_rollup table in one transaction
+def merge_rollup(results):
+    rows = [row for result in results for row in result['rollup']]
+    with write_connection() as conn:
+        create_rollup_schema(conn)
+        return replace_sector_year_rollup(conn, rows)
+
+
+# Merge the store frames of every partition into the frames store.build_frames returns
+def merge_frames(results):
+    company_years = concat_frames([result['company_years'] for result in results])
+    # The 'other' partition has no sector averages
+    sector_years = pd.concat([result['sector_years'] for result in results if not result['sector_years'].empty]
+                             or [results[0]['sector_years']], ignore_index=True)
+    return {
+        'company_years': company_years.sort_values(['cvr', 'year'], ignore_index=True),
+        'sector_years': sector_years.sort_values(['industry_sector', 'year'], ignore_index=True),
+    }
+
+
+# Per-partition timings of a run, slowest first, and the totals
+def timing_report(results, seconds, workers):
+    partition_seconds = sum(result['seconds'] for result in results)
+    return {
+        'workers': workers,
+        'seconds': seconds,
+        'partition_seconds': partition_seconds,
+        # How many partitions were computed at once on average
+        'parallelism': partition_seconds / seconds if seconds else 0.0,
+        'partitions': [{name: result[name] for name in ('partition', 'pid', 'rows', 'seconds', 'timings')}
+                       for result in sorted(results, key=lambda result: -result['seconds'])],
+    }
+
+
+# Build the analytics store frames partitioned by sector; the build function of the store
+# when CVR_STORE_BUILD_WORKERS > 1
+def build_frames_parallel(workers=REBUILD_WORKERS):
+    results, seconds = run_partitions(get_pool().db_path, ('store',), workers)
+    frames = merge_frames(results)
+    logger.info("Built the analytics store from %d partitions in %.2f s", len(results), seconds)
+    return frames
+
+
+# Rebuild the sector/year rollup across worker processes. Returns the timing report with the number
+# of rollup rows written.
+def rebuild_sector_analytics(workers=REBUILD_WORKERS):
+    results, seconds = run_partitions(get_pool().db_path, ('rollup',), workers)
+    report = timing_report(results, seconds, workers)
+    started = time.perf_counter()
+    report['rollup_rows'] = merge_rollup(results)
+    report['merge_seconds'] = time.perf_counter() - started
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild the per-sector analytics in parallel worker processes.")
+    parser.add_argument('--db', help="database file to rebuild (defaults to the application database)")
+    parser.add_argument('--workers', type=int, default=REBUILD_WORKERS,
+                        help="worker processes (default: %(default)s, the number of CPUs)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.db:
+        configure_pool(args.db)
+    report = rebuild_sector_analytics(args.workers)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+# Export the joined financials + company analytics columns to a year/sector partitioned Arrow IPC
+# (or Parquet) dataset, and read it back through memory maps.
+#
+# Usage: python snapshot.py [--db path/to/cvr_database.db] [--out snapshot_dir] [--format ipc|parquet]
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+from cache import db_version
+from loader import LOAD_CHUNKSIZE, apply_dtypes
+from pool import configure_pool, read_connection
+
+logger = logging.getLogger(__name__)
+
+# Where the snapshot lives; can be pointed elsewhere with the CVR_SNAPSHOT_DIR environment variable
+SNAPSHOT_DIR = os.environ.get('CVR_SNAPSHOT_DIR', os.path.join(os.path.dirname(__file__), 'snapshot'))
+# File describing the snapshot: format, row count and the database version it was taken from
+MANIFEST_NAME = '_manifest.json'
+
+# Column layout of the snapshot. Sector codes are kept as plain strings (they become the partition
+# directories); display names are applied by the loader when the data is read.
+SNAPSHOT_SCHEMA = pa.schema([
+    ('cvr', pa.int32()),
+    ('company_name', pa.string()),
+    ('industry_sector', pa.string()),
+    ('year', pa.int16()),
+    ('gross_profit_loss', pa.float64()),
+    ('profit_loss', pa.float64()),
+    ('equity', pa.float64()),
+    ('assets', pa.float64()),
+    ('revenue', pa.float64()),
+    ('external_expenses', pa.float64()),
+    ('employee_expense', pa.float64()),
+    ('profit_loss_from_ordinary_operating_activities', pa.float64()),
+    ('cash_and_cash_equivalents', pa.float64()),
+    ('solvency_ratio', pa.float32()),
+    ('return_on_assets', pa.float32()),
+    ('return_on_investment', pa.float32()),
+    ('current_ratio', pa.float32()),
+    ('profit_margin', pa.float32()),
+    # Year-over-year growth as stored on the financials rows (see schema.GROWTH_UPDATE)
+    ('equity_growth', pa.float32()),
+    ('assets_growth', pa.float32()),
+])
+
+PARTITIONING = ds.partitioning(
+    pa.schema([('year', pa.int16()), ('industry_sector', pa.string())]), flavor='hive')
+
+# Joined analytics columns, ordered so each company's years are contiguous within a partition
+SNAPSHOT_QUERY = f"""
+    SELECT f.cvr, c.name AS company_name, c.industry_sector, f.year,
+           {', '.join('f.' + field.name for field in SNAPSHOT_SCHEMA if field.name not in ('cvr', 'company_name', 'industry_sector', 'year'))}
+    FROM financials f
+    JOIN company c ON f.cvr = c.cvr_number
+    ORDER BY f.cvr, f.year;
+"""
+
+# Only numeric columns are converted while exporting; strings stay strings in Arrow
+_EXPORT_DTYPES = {field.name: field.type.to_pandas_dtype() for field in SNAPSHOT_SCHEMA
+                  if pa.types.is_integer(field.type) or pa.types.is_floating(field.type)}
+
+
+# Stream the analytics query on conn as Arrow record batches
+def _record_batches(conn, chunksize):
+    for chunk in pd.read_sql_query(SNAPSHOT_QUERY, conn, chunksize=chunksize):
+        # Rows without a sector still need a partition directory
+        chunk['industry_sector'] = chunk['industry_sector'].fillna('unknown')
+        apply_dtypes(chunk, _EXPORT_DTYPES)
+        yield pa.RecordBatch.from_pandas(chunk, schema=SNAPSHOT_SCHEMA, preserve_index=False)
+
+
+# Export the snapshot to path. The dataset is written next to the target and swapped in at the end,
+# so readers never see a half-written snapshot. Returns the manifest.
+def export_snapshot(path=SNAPSHOT_DIR, file_format='ipc', chunksize=LOAD_CHUNKSIZE):
+    started = time.perf_counter()
+    staging = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(staging, ignore_errors=True)
+
+    rows = 0
+
+    def counted(batches):
+        nonlocal rows
+        for batch in batches:
+            rows += batch.num_rows
+            yield batch
+
+    with read_connection() as conn:
+        # One read transaction for the version and the rows, so the manifest records the version of
+        # exactly the data exported; db_version() reuses this thread's checked-out connection
+        conn.execute("BEGIN")
+        try:
+            version = db_version()
+            # IPC files are written uncompressed so they can be memory-mapped and read without copying
+            ds.write_dataset(counted(_record_batches(conn, chunksize)), staging, schema=SNAPSHOT_SCHEMA,
+                             format=file_format, partitioning=PARTITIONING,
+                             existing_data_behavior='overwrite_or_ignore')
+        finally:
+            conn.rollback()
+
+    manifest = {
+        'format': file_format,
+        'rows': rows,
+        'db_version': version,
+        'created_at': time.time(),
+    }
+    with open(os.path.join(staging, MANIFEST_NAME), 'w') as handle:
+        json.dump(manifest, handle)
+
+    # Swap the new snapshot in
+    retired = f"{path}.old-{os.getpid()}"
+    if os.path.exists(path):
+        os.rename(path, retired)
+    os.rename(staging, path)
+    shutil.rmtree(retired, ignore_errors=True)
+
+    logger.info("Exported %d rows to %s (%s) in %.1f s", rows, path, file_format, time.perf_counter() - started)
+    return manifest
+
+
+# Manifest of the snapshot at path, or None when there is no snapshot
+def read_manifest(path=SNAPSHOT_DIR):
+    try:
+        with open(os.path.join(path, MANIFEST_NAME)) as handle:
+            return json.load(handle)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+# True when a snapshot exists and was taken from the current database contents
+def snapshot_is_fresh(path=SNAPSHOT_DIR):
+    manifest = read_manifest(path)
+    return manifest is not None and manifest['db_version'] == db_version()
+
+
+# Open the snapshot as a dataset whose files are memory-mapped, so column reads come straight from
+# the page cache and every process reading the snapshot shares the same pages
+def open_snapshot(path=SNAPSHOT_DIR):
+    manifest = read_manifest(path)
+    if manifest is None:
+        raise FileNotFoundError(f"No snapshot found at {path}; run 'python snapshot.py' first")
+    return ds.dataset(path, schema=SNAPSHOT_SCHEMA, format=manifest['format'], partitioning=PARTITIONING,
+                      filesystem=pafs.LocalFileSystem(use_mmap=True), exclude_invalid_files=True)
+
+
+# Read columns from the snapshot, optionally restricted to a year window and a sector code,
+# and return them with the loader's compact dtypes (sector display names as a categorical)
+def read_snapshot(columns, year_range=None, sector_code=None, path=SNAPSHOT_DIR):
+    dataset = open_snapshot(path)
+    condition = None
+    if year_range is not None:
+        condition = (ds.field('year') >= year_range[0]) & (ds.field('year') <= year_range[1])
+    if sector_code is not None:
+        sector_condition = ds.field('industry_sector') == sector_code
+        condition = sector_condition if condition is None else condition & sector_condition
+    table = dataset.to_table(columns=list(columns), filter=condition)
+    # split_blocks keeps each column in its own block so numeric columns are not consolidated (copied)
+    df = table.to_pandas(split_blocks=True)
+    if 'industry_sector' in df:
+        df['industry_sector'] = df['industry_sector'].replace('unknown', None)
+    return apply_dtypes(df)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the analytics tables to a partitioned Arrow/Parquet snapshot.")
+    parser.add_argument('--db', help="database file to export (defaults to the application database)")
+    parser.add_argument('--out', default=SNAPSHOT_DIR, help="snapshot directory")
+    parser.add_argument('--format', choices=['ipc', 'parquet'], default='ipc',
+                        help="ipc (memory-mappable, default) or parquet (smaller on disk)")
+    parser.add_argument('--chunksize', type=int, default=LOAD_CHUNKSIZE, help="rows per exported batch")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.db:
+        configure_pool(args.db)
+    manifest = export_snapshot(args.out, args.format, args.chunksize)
+    print(json.dumps(manifest, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
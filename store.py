@@ -0,0 +1,147 @@
+import logging
+import os
+import threading
+import time
+import numpy as np
+from cache import db_version
+from growth import add_growth_columns
+from loader import LOAD_CHUNKSIZE, apply_dtypes, frame_memory, load_frame, memory_report
+from rollup import ROLLUP_COLUMNS
+from snapshot import SNAPSHOT_QUERY, SNAPSHOT_SCHEMA, read_snapshot, snapshot_is_fresh
+
+logger = logging.getLogger(__name__)
+
+# Frames in the store are shared by every session. The entry points (main.py, reports.py and
+# benchmark.py) turn on pandas copy-on-write, under which selecting columns or rows from them shares
+# memory and any modification of a derived frame copies instead of writing through to the shared data.
+
+# Worker processes building the frames from the database; above 1 the build is split by sector
+# across processes (see sector_rebuild.py). Set with the CVR_STORE_BUILD_WORKERS environment variable.
+STORE_BUILD_WORKERS = int(os.environ.get('CVR_STORE_BUILD_WORKERS', '1'))
+
+
+# Add growth and efficiency ratios to company-years in (cvr, year) order; growth only looks at
+# the previous row of the same company, so any set of whole companies can be derived on its own
+def derive_company_columns(company_years):
+    company_years = add_growth_columns(company_years)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        company_years['operating_margin'] = (company_years['profit_loss_from_ordinary_operating_activities']
+                                             / company_years['revenue'])
+        company_years['expense_ratio'] = ((company_years['external_expenses'] + company_years['employee_expense'])
+                                          / company_years['revenue'])
+    return apply_dtypes(company_years)
+
+
+# Average of every rollup column per sector and year. Rows without a sector are left out, as in the rollup.
+def sector_year_averages(company_years):
+    sector_years = (company_years.groupby(['industry_sector', 'year'], observed=True, sort=True)[ROLLUP_COLUMNS]
+                    .mean().add_prefix('avg_').reset_index())
+    return apply_dtypes(sector_years)
+
+
+# Build the store's frames from the snapshot when it is current, otherwise from the database:
+#   company_years - every company-year with all analytics columns, growth and efficiency ratios,
+#                   in (cvr, year) order
+#   sector_years  - the average of every rollup column per sector and year
+def build_frames():
+    if snapshot_is_fresh():
+        company_years = read_snapshot([field.name for field in SNAPSHOT_SCHEMA])
+    elif STORE_BUILD_WORKERS > 1:
+        # Imported here: sector_rebuild builds on the functions above
+        from sector_rebuild import build_frames_parallel
+        return build_frames_parallel(STORE_BUILD_WORKERS)
+    else:
+        company_years = load_frame(SNAPSHOT_QUERY, chunksize=LOAD_CHUNKSIZE)
+
+    company_years = derive_company_columns(company_years)
+    return {'company_years': company_years, 'sector_years': sector_year_averages(company_years)}
+
+
+class AnalyticsStore:
+    # Process-wide, read-only analytics frames shared by reference across Streamlit sessions.
+    # The frames are loaded once and replaced as a whole when the database changes: a reload builds
+    # a complete new generation and swaps it in with a single assignment, so a reader sees either the
+    # old frames or the new ones, never a mix. Sessions holding the old frames keep them until they
+    # are done with them. Frames must never be modified in place.
+
+    def __init__(self, build=build_frames):
+        self._build = build
+        # (database version, frames) of the current generation, replaced as a whole
+        self._generation = None
+        # Serializes loads so a change of database version triggers a single reload
+        self._load_lock = threading.Lock()
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.loaded_at = None
+
+    def _load(self, version):
+        started = time.perf_counter()
+        frames = self._build()
+        self._generation = (version, frames)
+        self.loads += 1
+        self.load_seconds = time.perf_counter() - started
+        self.loaded_at = time.time()
+        logger.info("Loaded analytics store (%s) in %.2f s", ', '.join(
+            f"{name}: {len(df)} rows, {frame_memory(df) / 2**20:.1f} MiB" for name, df in frames.items()),
+            self.load_seconds)
+        # The per-column footprint shows which column to give a tighter dtype next
+        if logger.isEnabledFor(logging.DEBUG):
+            for name, df in frames.items():
+                logger.debug("Analytics store frame %s, bytes per column: %s", name, memory_report(df))
+
+    # Current frames, reloading them first if the database changed since they were built
+    def frames(self):
+        version = db_version()
+        generation = self._generation
+        if generation is not None and generation[0] == version:
+            return generation[1]
+        with self._load_lock:
+            # Another thread may have reloaded while this one was waiting
+            generation = self._generation
+            if generation is None or generation[0] != version:
+                self._load(version)
+            return self._generation[1]
+
+    # One frame of the current generation; select from it, never modify it
+    def frame(self, name):
+        return self.frames()[name]
+
+    # Load the frames now (at server start) unless they are already current
+    def warm(self):
+        self.frames()
+
+    def stats(self):
+        generation = self._generation
+        frames = generation[1] if generation else {}
+        return {
+            'loaded': generation is not None,
+            'loads': self.loads,
+            'load_seconds': self.load_seconds,
+            'loaded_at': self.loaded_at,
+            'frames': {name: {'rows': len(df), 'bytes': frame_memory(df)} for name, df in frames.items()},
+        }
+
+
+# Process-wide store shared by every Streamlit session
+analytics_store = AnalyticsStore()
+
+_warm_thread = None
+_warm_lock = threading.Lock()
+
+
+# Start loading the store in a background thread, once per process, so the first dashboard
+# render does not pay for the load; views that need the frames earlier wait for it
+def start_store():
+    global _warm_thread
+    with _warm_lock:
+        if _warm_thread is None:
+            _warm_thread = threading.Thread(target=analytics_store.warm, name='analytics-store-warm', daemon=True)
+            _warm_thread.start()
+
+
+def store_frame(name):
+    return analytics_store.frame(name)
+
+
+def store_stats():
+    return analytics_store.stats()
@@ -0,0 +1,184 @@
+# Generate a deterministic synthetic CVR database (company + financials) for benchmarks and load tests.
+# The same seed and scale always produce the same database, so timings from different runs are comparable.
+#
+# Usage: python synthetic_data.py path/to/bench.db [--scale 1k|100k|1m|<companies>] [--seed 42] [--force]
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+import numpy as np
+from schema import BASE_TABLES, backfill_derived_columns, migrate
+from utils import sector_attributes
+
+logger = logging.getLogger(__name__)
+
+# Named scales (number of companies); each company gets up to one financials row per year in YEARS
+SCALES = {'1k': 1_000, '100k': 100_000, '1m': 1_000_000}
+YEARS = range(2014, 2024)
+DEFAULT_SEED = 42
+# CVR numbers are 8 digits; synthetic companies are numbered upwards from here
+FIRST_CVR = 10_000_000
+# Companies generated and inserted per batch; bounds memory at the 1m scale
+BATCH_COMPANIES = 20_000
+
+# Relative number of companies per sector, roughly following the Danish register
+# (trade, knowledge services, construction and real estate dominate)
+SECTOR_WEIGHTS = {
+    'A': 4, 'B': 0.2, 'C': 6, 'D': 1, 'E': 0.4, 'F': 11, 'G': 17, 'H': 4, 'I': 5, 'J': 7,
+    'K': 6, 'L': 10, 'M': 13, 'N': 5, 'O': 0.1, 'P': 1.5, 'Q': 4, 'R': 2.5, 'S': 2.3, 'T': 0.1,
+}
+# Share of companies founded after the first year, and so missing the early years
+LATE_START_SHARE = 0.25
+# Share of financial values left NULL, as in incomplete annual reports
+NULL_SHARE = 0.02
+
+NAME_PREFIXES = ('Nordisk', 'Dansk', 'Jysk', 'Fyns', 'Sjællands', 'Øresund', 'Vestkyst', 'Limfjord', 'Grøn',
+                 'Ny', 'Skandinavisk', 'Bornholms', 'Midtjysk', 'Aarhus', 'Odense', 'Aalborg', 'Køge', 'Hav')
+NAME_SURNAMES = ('Jensen', 'Nielsen', 'Hansen', 'Pedersen', 'Andersen', 'Christensen', 'Larsen', 'Sørensen',
+                 'Rasmussen', 'Jørgensen', 'Petersen', 'Madsen', 'Kristensen', 'Olsen', 'Thomsen', 'Poulsen')
+NAME_STEMS = ('Byg', 'Handel', 'Transport', 'Consult', 'Invest', 'Ejendomme', 'Data', 'Energi', 'Service',
+              'Design', 'Holding', 'Teknik', 'Logistik', 'Rengøring', 'Tømrer', 'El', 'VVS', 'Software',
+              'Landbrug', 'Revision', 'Marketing', 'Food', 'Maskiner', 'Gruppen')
+NAME_SUFFIXES = ('ApS', 'ApS', 'ApS', 'A/S', 'I/S', 'IVS')
+
+INSERT_COMPANY = "INSERT INTO company VALUES (?, ?, ?, ?, ?, ?, ?)"
+INSERT_FINANCIALS = f"INSERT INTO financials VALUES ({', '.join('?' * 16)})"
+
+
+# Number of companies for a named scale or a plain number
+def parse_scale(scale):
+    if str(scale).lower() in SCALES:
+        return SCALES[str(scale).lower()]
+    companies = int(scale)
+    if companies <= 0:
+        raise ValueError(f"Scale must be positive, got {scale!r}")
+    return companies
+
+
+# Company rows for CVR numbers first_cvr .. first_cvr + count - 1
+def _company_rows(rng, first_cvr, count):
+    codes = list(SECTOR_WEIGHTS)
+    weights = np.array([SECTOR_WEIGHTS[code] for code in codes])
+    sectors = rng.choice(codes, size=count, p=weights / weights.sum())
+    prefix_kind = rng.random(count) < 0.5
+    prefixes = rng.choice(NAME_PREFIXES, size=count)
+    surnames = rng.choice(NAME_SURNAMES, size=count)
+    stems = rng.choice(NAME_STEMS, size=count)
+    suffixes = rng.choice(NAME_SUFFIXES, size=count)
+    founded = rng.integers(1950, YEARS[0] + 1, size=count)
+    months = rng.integers(1, 13, size=count)
+    phones = rng.integers(20_000_000, 99_999_999, size=count)
+
+    rows = []
+    for i in range(count):
+        cvr = first_cvr + i
+        owner = prefixes[i] if prefix_kind[i] else f"{surnames[i]}s"
+        name = f"{owner} {stems[i]} {suffixes[i]}"
+        rows.append((cvr, name, str(sectors[i]), f"info@{cvr}.dk", str(phones[i]),
+                     f"{founded[i]}-{months[i]:02d}-01", f"{stems[i]} in {sector_attributes[sectors[i]]}"))
+    return rows
+
+
+# Financials rows for count companies: assets follow a random walk per company and the other
+# values are derived from it, so ratios and amounts are consistent with each other
+def _financial_rows(rng, first_cvr, count):
+    years = np.array(YEARS)
+    shape = (count, len(years))
+
+    # Balance sheet: lognormal starting assets, yearly growth around 3 %
+    growth = rng.normal(0.03, 0.15, size=shape)
+    growth[:, 0] = 0.0
+    assets = rng.lognormal(15.0, 1.6, size=(count, 1)) * np.exp(np.cumsum(growth, axis=1))
+    solvency_ratio = np.clip(rng.normal(0.4, 0.2, size=(count, 1)) + rng.normal(0.0, 0.05, size=shape), -0.5, 0.98)
+    equity = assets * solvency_ratio
+    cash = assets * rng.uniform(0.02, 0.3, size=shape)
+    current_ratio = rng.lognormal(0.3, 0.5, size=(count, 1)) * rng.lognormal(0.0, 0.1, size=shape)
+
+    # Income statement: revenue from asset turnover, expenses and profit from it
+    revenue = assets * rng.lognormal(0.0, 0.6, size=(count, 1)) * rng.lognormal(0.0, 0.1, size=shape)
+    gross_profit_loss = revenue * rng.uniform(0.2, 0.6, size=shape)
+    external_expenses = revenue - gross_profit_loss
+    employee_expense = gross_profit_loss * rng.uniform(0.4, 0.95, size=shape)
+    operating = gross_profit_loss - employee_expense - assets * rng.uniform(0.01, 0.06, size=shape)
+    profit_loss = operating * rng.uniform(0.7, 0.85, size=shape)
+    profit_margin = profit_loss / revenue
+    return_on_assets = profit_loss / assets
+    return_on_investment = profit_loss / np.where(np.abs(equity) < 1.0, 1.0, equity)
+
+    # Column order of the financials table after cvr and year
+    values = np.stack([profit_loss, equity, return_on_assets, solvency_ratio * np.ones(shape), gross_profit_loss,
+                       assets, return_on_investment, current_ratio, profit_margin, revenue, external_expenses,
+                       employee_expense, operating, cash], axis=-1)
+    values[rng.random(values.shape) < NULL_SHARE] = np.nan
+
+    # Some companies were founded after the first year; drop their earlier years
+    first_year = np.where(rng.random(count) < LATE_START_SHARE, rng.integers(years[0] + 1, years[-1] + 1, size=count),
+                          years[0])
+    present = years[None, :] >= first_year[:, None]
+    cvrs = np.broadcast_to((first_cvr + np.arange(count))[:, None], shape)[present]
+    row_years = np.broadcast_to(years[None, :], shape)[present]
+    # SQLite stores NaN as NULL
+    return zip(cvrs.tolist(), row_years.tolist(), *values[present].T.tolist())
+
+
+# Write a synthetic database with the given number of companies to path. The tables are loaded
+# without a journal (the file is new, so there is nothing to protect), then the schema migrations
+# add the indexes and statistics the application expects. Returns (companies, financials rows).
+def generate_database(path, companies, seed=DEFAULT_SEED, force=False):
+    if os.path.exists(path):
+        if not force:
+            raise FileExistsError(f"{path} already exists; pass force=True (--force) to replace it")
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    rng = np.random.default_rng(seed)
+    started = time.perf_counter()
+    financial_rows = 0
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        for statement in BASE_TABLES:
+            conn.execute(statement)
+        for first in range(0, companies, BATCH_COMPANIES):
+            count = min(BATCH_COMPANIES, companies - first)
+            conn.executemany(INSERT_COMPANY, _company_rows(rng, FIRST_CVR + first, count))
+            cursor = conn.executemany(INSERT_FINANCIALS, _financial_rows(rng, FIRST_CVR + first, count))
+            financial_rows += cursor.rowcount
+            conn.commit()
+            logger.info("%d / %d companies", first + count, companies)
+
+        # Indexes, users tables and stored derived columns, as on a real database
+        migrate(conn)
+        backfill_derived_columns(conn)
+        conn.execute("ANALYZE")
+        conn.commit()
+        conn.execute("PRAGMA journal_mode = WAL")
+    finally:
+        conn.close()
+    logger.info("Wrote %d companies and %d financials rows to %s in %.1f s",
+                companies, financial_rows, path, time.perf_counter() - started)
+    return companies, financial_rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a deterministic synthetic CVR database.")
+    parser.add_argument('path', help="database file to write")
+    parser.add_argument('--scale', default='1k', help=f"{', '.join(SCALES)} or a number of companies (default 1k)")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help="random seed (default %(default)s)")
+    parser.add_argument('--force', action='store_true', help="replace an existing file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    try:
+        generate_database(args.path, parse_scale(args.scale), args.seed, args.force)
+    except (FileExistsError, ValueError) as error:
+        parser.error(str(error))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -21,7 +21,10 @@ sector_attributes = {
     'T': 'Private households with hired help; households’ production of goods and services for their own use'
 }
 
+# Reverse lookup: sector display name -> sector code
+sector_codes = {name: code for code, name in sector_attributes.items()}
+
 def get_company_codes(c_name):
-        return [code for code, name in sector_attributes.items() if name == c_name][0]
+        return sector_codes[c_name]
 
 